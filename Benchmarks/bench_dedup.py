@@ -0,0 +1,69 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server"))
+from chunk_store import ChunkStore
+
+WORDS = [b"storage", b"server", b"client", b"upload", b"download", b"chunk", b"file", b"owner",
+         b"the", b"a", b"of", b"to", b"data", b"list", b"delete", b"notification"]
+
+
+# Text-like content, as the system mostly stores text files
+def text_file(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return b" ".join(words)[:size]
+
+
+# Copy of data with a few small insertions, like a user's edited version of a shared file
+def edited(rng, data, edits=3):
+    data = bytearray(data)
+    for _ in range(edits):
+        position = rng.randrange(len(data))
+        data[position:position] = b"edited by a user "
+    return bytes(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dedup ratio and ingest throughput of the chunk store.")
+    parser.add_argument("--users", type=int, default=50, help="Users uploading the shared dataset")
+    parser.add_argument("--files", type=int, default=20, help="Files in the shared dataset")
+    parser.add_argument("--file-kb", type=int, default=512, help="Size of each dataset file")
+    parser.add_argument("--edited", type=float, default=0.2, help="Fraction of files each user edits")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    dataset = [text_file(rng, args.file_kb * 1024) if index % 2 else os.urandom(args.file_kb * 1024)
+               for index in range(args.files)]
+    with tempfile.TemporaryDirectory() as folder:
+        store = ChunkStore(folder)
+        store.load()
+        start = time.perf_counter()
+        for user in range(args.users):
+            for index, data in enumerate(dataset):
+                if rng.random() < args.edited:
+                    data = edited(rng, data)
+                writer = store.create(f"user{user}_file{index}")
+                for offset in range(0, len(data), 65536):
+                    writer.write(data[offset:offset + 65536])
+                writer.commit()
+        elapsed = time.perf_counter() - start
+        logical, stored = store.stats()
+
+    print(f"files ingested     {args.users * args.files}")
+    print(f"logical bytes      {logical / 1048576:10.1f} MB")
+    print(f"stored bytes       {stored / 1048576:10.1f} MB")
+    print(f"dedup ratio        {logical / stored:10.1f}x")
+    print(f"ingest throughput  {logical / 1048576 / elapsed:10.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server", "server_core.py")
+
+
+# Start a headless server in a subprocess and return it with its port
+def start_server(workdir):
+    proc = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, "--port", "0", "--host", "127.0.0.1", "--folder", "uploads"],
+        cwd=workdir, stdout=subprocess.PIPE, text=True)
+    for line in proc.stdout:
+        if line.startswith("Server listening on port"):
+            # Keep draining the server log so it never blocks on a full pipe
+            threading.Thread(target=proc.stdout.read, daemon=True).start()
+            return proc, int(line.split()[4].rstrip("."))
+    raise RuntimeError("Server did not start.")
+
+
+# Connect and log in, returning the socket and a buffered reader
+def connect(port, username):
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = sock.makefile("rb")
+    sock.sendall(f"{username}\n".encode())
+    assert reader.readline().strip() == b"OK"
+    return sock, reader
+
+
+# Download with the per-chunk DATA:<n> framing
+def download_framed(sock, reader, out):
+    sock.sendall(b"DOWNLOAD bench.bin bench\n")
+    reader.readline()  # RESPONSE:<size>
+    while True:
+        length = int(reader.readline()[len(b"DATA:"):])
+        if length == 0:
+            break
+        out.write(reader.read(length))
+
+
+# Download with a single FILE:<size> frame
+def download_fetch(sock, reader, out):
+    sock.sendall(b"FETCH bench.bin bench\n")
+    remaining = int(reader.readline()[len(b"FILE:"):])
+    chunk = bytearray(65536)
+    view = memoryview(chunk)
+    while remaining > 0:
+        received = reader.readinto(view[:min(len(chunk), remaining)])
+        out.write(view[:received])
+        remaining -= received
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare DOWNLOAD framing against FETCH (sendfile).")
+    parser.add_argument("--size-mb", type=int, default=256, help="Size of the test file")
+    parser.add_argument("--rounds", type=int, default=3, help="Downloads per mode")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        proc, port = start_server(workdir)
+        try:
+            sock, reader = connect(port, "bench")
+            size = args.size_mb * 1024 * 1024
+            sock.sendall(f"UPLOAD bench.bin {size}\n".encode())
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                sock.sendall(block)
+            reader.readline()
+
+            for name, download in (("DOWNLOAD (DATA framing)", download_framed), ("FETCH (sendfile)", download_fetch)):
+                best = None
+                for _ in range(args.rounds):
+                    with open(os.path.join(workdir, "out.bin"), "wb") as out:
+                        start = time.perf_counter()
+                        download(sock, reader, out)
+                        elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                print(f"{name:<24} {args.size_mb / best:8.1f} MB/s (best of {args.rounds})")
+            sock.sendall(b"EXIT\n")
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+if __name__ == "__main__":
+    main()
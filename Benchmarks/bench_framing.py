@@ -0,0 +1,113 @@
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from framing import RecvBuffer
+
+
+# Previous client-side framing: grows a bytes buffer and slices it on every read
+class LegacyBuffer:
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+
+    def recv_line(self):
+        while True:
+            if b'\n' in self.buffer:
+                line, self.buffer = self.buffer.split(b'\n', 1)
+                return line.decode().strip()
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("Connection lost.")
+            self.buffer += data
+
+    def recv_exact(self, num_bytes):
+        while len(self.buffer) < num_bytes:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("Connection lost.")
+            self.buffer += data
+        data, self.buffer = self.buffer[:num_bytes], self.buffer[num_bytes:]
+        return data
+
+
+# Shared RecvBuffer framing driven by recv_into
+class SharedBuffer:
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = RecvBuffer()
+
+    def fill(self):
+        received = self.sock.recv_into(self.buffer.writable())
+        if not received:
+            raise ConnectionError("Connection lost.")
+        self.buffer.commit(received)
+
+    def recv_line(self):
+        while True:
+            line = self.buffer.take_line()
+            if line is not None:
+                return line.strip()
+            self.fill()
+
+    def recv_exact(self, num_bytes):
+        while len(self.buffer) < num_bytes:
+            self.fill()
+        return self.buffer.take(num_bytes)
+
+
+# Pipelined short command lines, as sent by a busy client
+def line_workload(count):
+    payload = b"".join(b"DOWNLOAD file%d.txt owner%d\n" % (i, i % 50) for i in range(count))
+    return payload, lambda buf: [buf.recv_line() for _ in range(count)]
+
+
+# DATA:<n> headers followed by binary chunks, as in a framed download
+def bulk_workload(count, chunk_size):
+    chunk = os.urandom(chunk_size)
+    payload = (b"DATA:%d\n" % chunk_size + chunk) * count
+
+    def consume(buf):
+        for _ in range(count):
+            length = int(buf.recv_line()[len("DATA:"):])
+            buf.recv_exact(length)
+    return payload, consume
+
+
+# Time how long a reader takes to consume the payload from a socket pair
+def run(buffer_class, payload, consume):
+    reader_sock, writer_sock = socket.socketpair()
+    writer = threading.Thread(target=writer_sock.sendall, args=(payload,))
+    start = time.perf_counter()
+    writer.start()
+    consume(buffer_class(reader_sock))
+    elapsed = time.perf_counter() - start
+    writer.join()
+    reader_sock.close()
+    writer_sock.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the shared receive buffer.")
+    parser.add_argument("--lines", type=int, default=200000, help="Command lines in the line workload")
+    parser.add_argument("--chunks", type=int, default=4096, help="Chunks in the bulk workload")
+    parser.add_argument("--chunk-size", type=int, default=65536, help="Bytes per bulk chunk")
+    args = parser.parse_args()
+
+    workloads = (
+        ("lines", line_workload(args.lines), args.lines, "lines/s"),
+        ("bulk", bulk_workload(args.chunks, args.chunk_size), args.chunks * args.chunk_size / 1048576, "MB/s"),
+    )
+    for name, (payload, consume), amount, unit in workloads:
+        for label, buffer_class in (("legacy", LegacyBuffer), ("RecvBuffer", SharedBuffer)):
+            elapsed = min(run(buffer_class, payload, consume) for _ in range(3))
+            print(f"{name:<6} {label:<11} {amount / elapsed:14.1f} {unit}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server", "server_core.py")
+OPERATIONS = ("upload", "download", "list", "delete")
+UNITS = {"k": 1024, "m": 1024 * 1024}
+RSS_INTERVAL = 0.1  # Seconds between samples of the server's memory
+
+
+# Parse "name:weight,..." into ([name, ...], [weight, ...])
+def parse_weights(text):
+    names, weights = [], []
+    for item in text.split(","):
+        name, _, weight = item.partition(":")
+        names.append(name.strip().lower())
+        weights.append(float(weight or 1))
+    return names, weights
+
+
+# Parse a size such as 4096, 64k or 16m
+def parse_size(text):
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+# Start a headless server in a subprocess and return it with its port
+def start_server(workdir, workers, storage):
+    proc = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, "--port", "0", "--host", "127.0.0.1", "--folder", "uploads",
+         "--storage", storage, "--workers", str(workers)],
+        cwd=workdir, stdout=subprocess.PIPE, text=True)
+    for line in proc.stdout:
+        if line.startswith("Server listening on port"):
+            # Keep draining the server log so it never blocks on a full pipe
+            threading.Thread(target=proc.stdout.read, daemon=True).start()
+            return proc, int(line.split()[4].rstrip("."))
+    raise RuntimeError("Server did not start.")
+
+
+# Resident memory in bytes of a process and all of its descendants (Linux /proc)
+def tree_rss(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except (OSError, StopIteration):
+        return 0
+    return rss + sum(tree_rss(child) for child in children)
+
+
+# Sample the server's memory until stopped, keeping the peak
+class RssSampler:
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(RSS_INTERVAL):
+            self.peak = max(self.peak, tree_rss(self.pid))
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return tree_rss(self.pid)
+
+
+# One simulated user: a seeded sequence of operations on its own files, recording
+# (operation, seconds, bytes moved) for each
+def run_client(port, user, operations, seed, sizes, mix, payload, samples):
+    rng = random.Random(seed)
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = sock.makefile("rb")
+    sock.sendall(f"{user}\n".encode())
+    reader.readline()
+    files = {}  # Name -> size
+    for index in range(operations):
+        operation = rng.choices(mix[0], mix[1])[0]
+        if not files and operation in ("download", "delete"):
+            operation = "upload"
+        moved = 0
+        start = time.perf_counter()
+        if operation == "upload":
+            name = f"file{index}.bin"
+            size = rng.choices(sizes[0], sizes[1])[0]
+            offset = rng.randrange(len(payload) - size + 1)
+            sock.sendall(f"UPLOAD {name} {size}\n".encode())
+            sock.sendall(payload[offset:offset + size])
+            reader.readline()
+            files[name] = moved = size
+        elif operation == "download":
+            sock.sendall(f"DOWNLOAD {rng.choice(sorted(files))} {user}\n".encode())
+            reader.readline()  # RESPONSE:<size>
+            while True:
+                length = int(reader.readline()[len(b"DATA:"):])
+                if length == 0:
+                    break
+                moved += len(reader.read(length))
+        elif operation == "list":
+            sock.sendall(f"LIST - {user} - 100\n".encode())
+            count = int(reader.readline().split()[0][len(b"LISTING:"):])
+            for _ in range(count):
+                reader.readline()
+        else:
+            name = rng.choice(sorted(files))
+            del files[name]
+            sock.sendall(f"DELETE {name}\n".encode())
+            reader.readline()
+        samples.append((operation, time.perf_counter() - start, moved))
+    sock.sendall(b"EXIT\n")
+    sock.close()
+
+
+# Latency percentiles of a list of seconds, in milliseconds
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"p50_ms": None, "p99_ms": None}
+    return {"p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+            "p99_ms": round(latencies[len(latencies) * 99 // 100] * 1000, 3)}
+
+
+# Commit of the tree being measured, if it is a git checkout
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(SERVER_SCRIPT),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    sizes = parse_weights(args.sizes)
+    sizes = ([parse_size(size) for size in sizes[0]], sizes[1])
+    mix = parse_weights(args.mix)
+    for operation in mix[0]:
+        if operation not in OPERATIONS:
+            raise SystemExit(f"Unknown operation {operation}; choose from {', '.join(OPERATIONS)}.")
+    payload = random.Random(args.seed).randbytes(max(sizes[0]) * 2)  # Same file contents every run
+
+    with tempfile.TemporaryDirectory() as workdir:
+        proc, port = start_server(workdir, args.workers, args.storage)
+        try:
+            idle_rss = tree_rss(proc.pid)
+            sampler = RssSampler(proc.pid)
+            samples = []
+            threads = [threading.Thread(target=run_client,
+                                        args=(port, f"user{index}", args.operations, args.seed * 100003 + index,
+                                              sizes, mix, payload, samples))
+                       for index in range(args.clients)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            final_rss = sampler.stop()
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    results = {"operations": len(samples), "seconds": round(elapsed, 3),
+               "ops_per_second": round(len(samples) / elapsed, 1),
+               "mb_per_second": round(sum(moved for _, _, moved in samples) / elapsed / 1e6, 2)}
+    results.update(percentiles([seconds for _, seconds, _ in samples]))
+    results.update(server_rss_idle_bytes=idle_rss, server_rss_peak_bytes=max(sampler.peak, final_rss),
+                   server_rss_final_bytes=final_rss)
+    by_operation = {}
+    for operation in OPERATIONS:
+        latencies = [seconds for name, seconds, _ in samples if name == operation]
+        if latencies:
+            by_operation[operation] = dict(count=len(latencies), **percentiles(latencies))
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": {"clients": args.clients, "operations": args.operations, "seed": args.seed,
+                   "sizes": args.sizes, "mix": args.mix, "workers": args.workers, "storage": args.storage},
+        "results": results,
+        "by_operation": by_operation,
+    }
+
+
+def print_report(report):
+    results = report["results"]
+    print(f"{results['operations']} operations in {results['seconds']:.2f} s: {results['ops_per_second']:.0f} ops/s, "
+          f"{results['mb_per_second']:.1f} MB/s, p50 {results['p50_ms']:.2f} ms, p99 {results['p99_ms']:.2f} ms")
+    for operation, stats in report["by_operation"].items():
+        print(f"  {operation:<9} {stats['count']:7d}   p50 {stats['p50_ms']:8.2f} ms   p99 {stats['p99_ms']:8.2f} ms")
+    print(f"server RSS: idle {results['server_rss_idle_bytes'] / 1e6:.1f} MB, "
+          f"peak {results['server_rss_peak_bytes'] / 1e6:.1f} MB, final {results['server_rss_final_bytes'] / 1e6:.1f} MB")
+
+
+# Print how throughput, latency and memory moved against an earlier report
+def compare(report, baseline):
+    print(f"against {baseline.get('commit') or 'baseline'}:")
+    for key in ("ops_per_second", "mb_per_second", "p50_ms", "p99_ms", "server_rss_peak_bytes"):
+        old, new = baseline["results"].get(key), report["results"].get(key)
+        if old and new is not None:
+            print(f"  {key:<22} {old:>14} -> {new:<14} {(new - old) / old * 100:+7.1f}%")
+    if baseline.get("config") != report["config"]:
+        print("  (configurations differ)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a headless server with simulated clients over loopback.")
+    parser.add_argument("--clients", type=int, default=32, help="Concurrent simulated clients")
+    parser.add_argument("--operations", type=int, default=100, help="Operations per client")
+    parser.add_argument("--sizes", default="1k:60,64k:30,1m:9,16m:1",
+                        help="Upload size distribution as size:weight pairs (k and m suffixes)")
+    parser.add_argument("--mix", default="upload:30,download:40,list:20,delete:10",
+                        help="Operation mix as operation:weight pairs")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the operations and file contents")
+    parser.add_argument("--workers", type=int, default=1, help="Server worker processes")
+    parser.add_argument("--storage", choices=("files", "chunks", "tiered"), default="files", help="Server storage backend")
+    parser.add_argument("--output", help="Save the report as JSON to this file")
+    parser.add_argument("--baseline", help="Earlier JSON report to compare against")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(report, json.load(f))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
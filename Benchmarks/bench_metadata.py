@@ -0,0 +1,154 @@
+import argparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server", "server_core.py")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server"))
+from metadata import MetadataStore
+
+BODY = os.urandom(1024)  # Contents of every uploaded file
+
+
+# Start a headless server in a subprocess and return it with its port
+def start_server(workdir, shards):
+    proc = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, "--port", "0", "--host", "127.0.0.1", "--folder", "uploads",
+         "--metadata-shards", str(shards)],
+        cwd=workdir, stdout=subprocess.PIPE, text=True)
+    for line in proc.stdout:
+        if line.startswith("Server listening on port"):
+            # Keep draining the server log so it never blocks on a full pipe
+            threading.Thread(target=proc.stdout.read, daemon=True).start()
+            return proc, int(line.split()[4].rstrip("."))
+    raise RuntimeError("Server did not start.")
+
+
+# One client doing a mix of uploads, listings, downloads and deletes, recording latencies
+def run_client(port, user, operations, seed, latencies):
+    rng = random.Random(seed)
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = sock.makefile("rb")
+    sock.sendall(f"{user}\n".encode())
+    reader.readline()
+    files = []
+    for index in range(operations):
+        choice = rng.random()
+        start = time.perf_counter()
+        if choice < 0.4 or not files:
+            name = f"file{index}.bin"
+            sock.sendall(f"UPLOAD {name} {len(BODY)}\n".encode() + BODY)
+            reader.readline()
+            files.append(name)
+        elif choice < 0.55:
+            sock.sendall(f"LIST - {user} - 100\n".encode())
+            count = int(reader.readline().split()[0][len(b"LISTING:"):])
+            for _ in range(count):
+                reader.readline()
+        elif choice < 0.7:
+            sock.sendall(b"LIST f - - 100\n")
+            count = int(reader.readline().split()[0][len(b"LISTING:"):])
+            for _ in range(count):
+                reader.readline()
+        elif choice < 0.9:
+            sock.sendall(f"FETCH {rng.choice(files)} {user}\n".encode())
+            reader.read(int(reader.readline()[len(b"FILE:"):]))
+        else:
+            sock.sendall(f"DELETE {files.pop(rng.randrange(len(files)))}\n".encode())
+            reader.readline()
+        latencies.append(time.perf_counter() - start)
+    sock.sendall(b"EXIT\n")
+    sock.close()
+
+
+# Read the metadata lock wait counter from STATS
+def lock_wait(port):
+    sock = socket.create_connection(("127.0.0.1", port))
+    reader = sock.makefile("rb")
+    sock.sendall(b"stats\nSTATS\n")
+    reader.readline()
+    lines = [reader.readline().decode() for _ in range(int(reader.readline()[len(b"STATS:"):]))]
+    sock.close()
+    return next(float(line.split()[1]) for line in lines if line.startswith("cfs_metadata_lock_wait_seconds_total"))
+
+
+# Many clients against a server process with the given shard count
+def bench_server(shards, clients, operations):
+    with tempfile.TemporaryDirectory() as workdir:
+        proc, port = start_server(workdir, shards)
+        try:
+            latencies = []
+            threads = [threading.Thread(target=run_client, args=(port, f"user{index}", operations, index, latencies))
+                       for index in range(clients)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            waited = lock_wait(port)
+        finally:
+            proc.terminate()
+            proc.wait()
+    latencies.sort()
+    print(f"server  shards={shards:<3} {len(latencies) / elapsed:9.0f} ops/s   "
+          f"p50 {latencies[len(latencies) // 2] * 1000:6.2f} ms   p99 {latencies[len(latencies) * 99 // 100] * 1000:6.2f} ms   "
+          f"lock wait {waited * 1000:8.1f} ms")
+
+
+# Threads hitting the metadata store directly, one owner each
+def store_worker(store, user, operations, seed):
+    rng = random.Random(seed)
+    for index in range(operations):
+        choice = rng.random()
+        key = (f"file{rng.randrange(200)}", user)
+        if choice < 0.4:
+            store.put(key, f"{user}_{key[0]}")
+        elif choice < 0.6:
+            store.list_keys("", user, None, 100)
+        elif choice < 0.7:
+            store.list_keys("file1", None, None, 100)
+        elif choice < 0.9:
+            store.get(key)
+        else:
+            store.pop(key)
+
+
+def bench_store(shards, clients, operations):
+    with tempfile.TemporaryDirectory() as workdir:
+        store = MetadataStore(os.path.join(workdir, "map"), shards=shards)
+        store.load()
+        threads = [threading.Thread(target=store_worker, args=(store, f"user{index}", operations, index))
+                   for index in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        store.flush()
+    print(f"store   shards={shards:<3} {clients * operations / elapsed:9.0f} ops/s   "
+          f"lock wait {store.lock_wait_seconds() * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Metadata contention with many concurrent clients.")
+    parser.add_argument("--clients", type=int, default=64, help="Concurrent clients")
+    parser.add_argument("--operations", type=int, default=200, help="Operations per client")
+    parser.add_argument("--shards", default="1,16", help="Comma-separated shard counts to compare")
+    args = parser.parse_args()
+
+    for shards in (int(value) for value in args.shards.split(",")):
+        bench_store(shards, args.clients, args.operations * 10)
+    for shards in (int(value) for value in args.shards.split(",")):
+        bench_server(shards, args.clients, args.operations)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server"))
+from map_snapshot import write_snapshot
+from metadata import MetadataStore
+
+FORMATS = ("text", "json", "binary")
+LOOKUPS = 1000  # Random lookups timed right after load() returns
+OWNERS = 1000  # Distinct owners in the generated maps
+
+
+# The (filename, owner) key, stored name and checksum of generated entry number index
+def entry(index):
+    filename, owner = f"file{index}.dat", f"user{index % OWNERS}"
+    return (filename, owner), f"{owner}_{index:08x}_{filename}", f"blake2b:{index:032x}"
+
+
+# Write a map of count entries in one format under workdir and return its base path.
+# text is the old pipe-separated file, json the JSON-lines snapshot used until now.
+def generate(workdir, kind, count):
+    base = os.path.join(workdir, kind, "map")
+    os.makedirs(os.path.dirname(base))
+    if kind == "text":
+        with open(base + ".txt", "w") as f:
+            for index in range(count):
+                key, unique_filename, _ = entry(index)
+                f.write(f"{key[0]}|{key[1]}|{unique_filename}\n")
+    elif kind == "json":
+        with open(base + ".snapshot", "w", encoding="utf-8") as f:
+            for index in range(count):
+                key, unique_filename, checksum = entry(index)
+                f.write(json.dumps({"op": "put", "name": key[0], "owner": key[1], "file": unique_filename,
+                                    "checksum": checksum}) + "\n")
+    else:
+        entries, checksums = {}, {}
+        for index in range(count):
+            key, entries[key], checksums[key] = entry(index)
+        write_snapshot(base + ".snapshot", entries, checksums)
+    return base
+
+
+# Resident memory of this process in bytes (Linux /proc)
+def rss():
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+
+
+# Load a map in a fresh process and report (ready, lookup, loaded, rss) over a pipe:
+# seconds until load() returned, mean seconds per lookup right after, seconds until the
+# whole map was in memory, and resident memory then
+def measure(base, count, seed):
+    keys = [entry(random.Random(seed + number).randrange(count))[0] for number in range(LOOKUPS)]
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        # Copy the map aside: loading an old format rewrites the snapshot as binary
+        workdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.dirname(base)))
+        for suffix in (".txt", ".snapshot"):
+            if os.path.exists(base + suffix):
+                os.link(base + suffix, os.path.join(workdir, "map" + suffix))
+        store = MetadataStore(os.path.join(workdir, "map"), compact_every=sys.maxsize)
+        start = time.perf_counter()
+        store.load()
+        ready = time.perf_counter() - start
+        lookup_start = time.perf_counter()
+        for key in keys:
+            store.get(key)
+        lookup = (time.perf_counter() - lookup_start) / len(keys)
+        store.wait_loaded()
+        loaded = time.perf_counter() - start
+        os.write(write_end, json.dumps([ready, lookup, loaded, rss()]).encode())
+        os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as f:
+        result = json.loads(f.read())
+    os.waitpid(pid, 0)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Metadata load time of the text, JSON-lines and binary map formats.")
+    parser.add_argument("--entries", default="10000,1000000,10000000", help="Comma-separated map sizes to compare")
+    parser.add_argument("--formats", default=",".join(FORMATS), help="Comma-separated formats to load")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the looked-up keys")
+    args = parser.parse_args()
+
+    print(f"{'entries':>10} {'format':<7} {'file MB':>8} {'ready s':>9} {'lookup us':>10} {'loaded s':>9} {'RSS MB':>8}")
+    for count in (int(value) for value in args.entries.split(",")):
+        with tempfile.TemporaryDirectory() as workdir:
+            for kind in args.formats.split(","):
+                base = generate(workdir, kind, count)
+                path = base + (".txt" if kind == "text" else ".snapshot")
+                ready, lookup, loaded, resident = measure(base, count, args.seed)
+                print(f"{count:>10} {kind:<7} {os.path.getsize(path) / 1e6:8.1f} {ready:9.3f} {lookup * 1e6:10.1f} "
+                      f"{loaded:9.3f} {resident / 1e6:8.0f}")
+
+
+if __name__ == "__main__":
+    main()
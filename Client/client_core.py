@@ -0,0 +1,929 @@
+import argparse
+import fnmatch
+import json
+import os
+import queue
+import socket
+import sys
+import threading
+from collections import deque
+from urllib.parse import quote, unquote
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from framing import RecvBuffer
+from chunking import DEDUP, chunk_file
+from compression import FRAME_HEADER, PREFERENCE, choose_codec, decode_payload, encode_stream, looks_compressible
+from integrity import CHECKSUM, ChecksumReader, ChecksumWriter, StreamChecksum, file_checksum, split_checksum
+from multiplex import (CONTROL_STREAM, DATA, END, INITIAL_WINDOW, MAX_FRAME, MUX_HEADER, WINDOW,
+                       WINDOW_INCREMENT, pack_frame)
+
+LIST_PAGE_SIZE = 1000  # Files requested per LIST page
+UPLOAD_STREAMS = 4  # Parallel connections used for large uploads
+RANGE_SIZE = 8 * 1024 * 1024  # Bytes sent per SESSION_PUT
+SESSIONS_FILE = "upload_sessions.json"  # Unfinished uploads that can be resumed
+HAVE_BATCH = 1000  # Chunk hashes asked about per HAVE command
+DEFAULT_WORKERS = 4  # Streams used by the bulk commands
+PIPELINE_DEPTH = 16  # Requests a bulk worker keeps in flight on its stream
+SYNC_STATE_FILE = ".cloud_sync.json"  # What sync last uploaded from a folder
+SEGMENT_MIN = 16 * 1024 * 1024  # Smallest remainder worth splitting into parallel segments
+
+
+# Raised when the server answers a request with an ERROR line
+class ServerError(Exception):
+    pass
+
+
+# Class to handle socket operations with thread-safe buffer
+class SocketBuffer:
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()  # Serializes writers; only the reader thread receives
+        self.buffer = RecvBuffer()
+
+    # Receive more data from the socket into the buffer
+    def fill(self):
+        received = self.sock.recv_into(self.buffer.writable())
+        if not received:
+            raise ConnectionError("Connection to server lost.")
+        self.buffer.commit(received)
+
+    # Receive one line of data (ending with '\n')
+    def recv_line(self):
+        while True:
+            line = self.buffer.take_line()
+            if line is not None:
+                return line.strip()
+            self.fill()
+
+    # Receive exact number of bytes
+    def recv_exact(self, num_bytes):
+        while len(self.buffer) < num_bytes:
+            self.fill()
+        return self.buffer.take(num_bytes)
+
+    # Receive exactly num_bytes straight into a file, bypassing the data queue
+    def recv_to_file(self, f, num_bytes):
+        remaining = num_bytes
+        while remaining > 0:
+            if not self.buffer:
+                self.fill()
+            view = self.buffer.peek(remaining)
+            f.write(view)
+            self.buffer.consume(len(view))
+            remaining -= len(view)
+
+    # Receive a compressed body frame by frame, writing the decoded data to a file
+    def recv_frames_to_file(self, f, codec):
+        received = 0
+        while True:
+            kind, length = FRAME_HEADER.unpack(self.recv_exact(FRAME_HEADER.size))
+            if length == 0:
+                return received
+            block = decode_payload(codec, kind, self.recv_exact(length))
+            f.write(block)
+            received += len(block)
+
+    # Send data on the socket; the caller holds self.lock
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+    # Send a line of data (ending with '\n')
+    def send_line(self, line):
+        with self.lock:
+            self.sendall((line + '\n').encode())
+
+    # Send raw data
+    def send_data(self, data):
+        with self.lock:
+            self.sendall(data)
+
+
+# One stream of the multiplexed connection. It offers the same methods as SocketBuffer,
+# so each operation talks to the server as if it had a connection of its own.
+class Stream(SocketBuffer):
+    def __init__(self, mux, stream_id):
+        super().__init__(mux.sock_buf.sock)
+        self.mux = mux
+        self.stream_id = stream_id
+        self.incoming = deque()  # Payloads from the reader thread not yet moved into the buffer
+        self.condition = threading.Condition()
+        self.closed = False
+        self.send_window = INITIAL_WINDOW  # Bytes the server still accepts on this stream
+        self.consumed = 0  # Bytes taken since the last WINDOW update
+
+    # Queue a DATA payload; called by the reader thread
+    def deliver(self, payload):
+        with self.condition:
+            self.incoming.append(payload)
+            self.condition.notify_all()
+
+    # Add credit from a WINDOW frame
+    def grant(self, increment):
+        with self.condition:
+            self.send_window += increment
+            self.condition.notify_all()
+
+    # The server ended the stream or the connection was lost
+    def close_remote(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def fill(self):
+        with self.condition:
+            while not self.incoming and not self.closed:
+                self.condition.wait()
+            if not self.incoming:
+                raise ConnectionError("Stream closed by server.")
+            payload = self.incoming.popleft()
+        self.buffer.feed(payload)
+        self.consumed += len(payload)
+        if self.consumed >= INITIAL_WINDOW // 2:
+            # Let the server send as much again as has been taken
+            self.mux.send_frame(self.stream_id, WINDOW, WINDOW_INCREMENT.pack(self.consumed))
+            self.consumed = 0
+
+    def sendall(self, data):
+        view = memoryview(data)
+        while view:
+            with self.condition:
+                while self.send_window <= 0 and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    raise ConnectionError("Stream closed by server.")
+                count = min(len(view), self.send_window, MAX_FRAME)
+                self.send_window -= count
+            self.mux.send_frame(self.stream_id, DATA, view[:count])
+            view = view[count:]
+
+    def __enter__(self):
+        return self
+
+    # EXIT ends the server's command loop for this stream, and the server answers with END
+    def __exit__(self, *exc):
+        try:
+            self.send_line("EXIT")
+        except OSError:
+            pass
+
+
+# Multiplexed connection: every operation opens its own stream, and one reader thread
+# routes incoming frames to them, so transfers and commands run side by side
+class Multiplexer:
+    def __init__(self, sock_buf):
+        self.sock_buf = sock_buf
+        self.streams = {}  # Stream id -> Stream
+        self.next_stream_id = 1
+        self.lock = threading.Lock()
+
+    # Open a stream with an empty DATA frame, sent under the lock so that stream ids reach
+    # the server in increasing order
+    def open_stream(self):
+        with self.lock:
+            stream = Stream(self, self.next_stream_id)
+            self.streams[stream.stream_id] = stream
+            self.next_stream_id += 1
+            self.send_frame(stream.stream_id, DATA)
+        return stream
+
+    # Send one whole frame; the socket lock keeps frames from interleaving
+    def send_frame(self, stream_id, kind, payload=b''):
+        self.sock_buf.send_data(pack_frame(stream_id, kind, payload))
+
+    # Tell the server the connection is finished
+    def close(self):
+        self.send_frame(CONTROL_STREAM, END)
+
+    # Route frames until the connection ends, passing control stream lines to notify
+    def run(self, notify):
+        control = RecvBuffer()  # Lines arriving on the control stream
+        try:
+            while True:
+                stream_id, kind, length = MUX_HEADER.unpack(self.sock_buf.recv_exact(MUX_HEADER.size))
+                payload = self.sock_buf.recv_exact(length)
+                if stream_id == CONTROL_STREAM:
+                    control.feed(payload)
+                    message = control.take_line()
+                    while message is not None:
+                        notify(message)
+                        message = control.take_line()
+                    continue
+                with self.lock:
+                    stream = self.streams.pop(stream_id, None) if kind == END else self.streams.get(stream_id)
+                if stream is None:
+                    continue
+                if kind == DATA:
+                    stream.deliver(payload)
+                elif kind == WINDOW:
+                    stream.grant(WINDOW_INCREMENT.unpack(payload)[0])
+                elif kind == END:
+                    stream.close_remote()
+        finally:
+            with self.lock:
+                streams = list(self.streams.values())
+                self.streams.clear()
+            for stream in streams:
+                stream.close_remote()
+
+
+# File-like object writing consecutive bytes at an offset with pwrite
+class RangeWriter:
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, self.offset)
+            self.offset += written
+            view = view[written:]
+
+
+# Split a FILE: download header into (body length, codec or None, key=value options)
+def parse_download_header(message):
+    fields = message[len("FILE:"):].split()
+    options = dict(field.split("=", 1) for field in fields[1:] if "=" in field)
+    codecs = [field for field in fields[1:] if "=" not in field]
+    return int(fields[0]), codecs[0] if codecs else None, options
+
+
+# Read the reply to a command: the text after RESPONSE:, or the whole ERROR line
+def recv_response(conn):
+    message = conn.recv_line()
+    return message[len("RESPONSE:"):] if message.startswith("RESPONSE:") else message
+
+
+# Check the start of a file to see whether compressing it is worthwhile
+def is_compressible(file_path):
+    with open(file_path, "rb") as f:
+        sample = f.read(65536)
+    return bool(sample) and looks_compressible(sample)
+
+
+# Load the unfinished upload sessions saved by earlier runs
+def load_saved_sessions():
+    try:
+        with open(SESSIONS_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# Save the unfinished upload sessions
+def save_sessions(sessions):
+    with open(SESSIONS_FILE, "w", encoding="utf-8") as f:
+        json.dump(sessions, f)
+
+
+# Byte ranges of a file of the given size not covered by "start-end,..." committed ranges
+def missing_ranges(filesize, committed):
+    missing = []
+    position = 0
+    if committed != "-":
+        for part in committed.split(","):
+            start, end = (int(value) for value in part.split("-"))
+            if start > position:
+                missing.append((position, start - position))
+            position = max(position, end)
+    if position < filesize:
+        missing.append((position, filesize - position))
+    # Split into pieces so parallel connections share the work
+    return [(offset + start, min(RANGE_SIZE, length - start))
+            for offset, length in missing for start in range(0, length, RANGE_SIZE)]
+
+
+# Raise ServerError for an ERROR reply, otherwise return it
+def check(message):
+    if message.startswith("ERROR"):
+        raise ServerError(message)
+    return message
+
+
+# Every file below folder, in a stable order
+def walk_files(folder):
+    for directory, subdirectories, filenames in os.walk(folder):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            if filename != SYNC_STATE_FILE:
+                yield os.path.join(directory, filename)
+
+
+# Name under which a file below folder is stored: its relative path, percent-encoded so
+# that separators and spaces survive the space-separated protocol
+def remote_name(folder, path):
+    return quote(os.path.relpath(path, folder).replace(os.sep, "/"), safe="")
+
+
+# Local path below folder for a stored name, refusing names that would escape it
+def local_path(folder, name):
+    parts = unquote(name).split("/")
+    if any(part in ("", ".", "..") for part in parts) or os.path.isabs(parts[0]):
+        raise ValueError(f"Refusing to save {name} outside {folder}.")
+    return os.path.join(folder, *parts)
+
+
+# Run worker(work, results) on up to workers threads, each with its own stream, until
+# the items are used up; returns (name, ok, message) for every item
+def run_workers(worker, items, workers):
+    work = queue.Queue()
+    for item in items:
+        work.put(item)
+    results = []
+    threads = [threading.Thread(target=worker, args=(work, results), daemon=True)
+               for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# Headless client for the file server. The GUI in client.py and the command line below
+# are both front-ends for it. Every call opens its own stream on the multiplexed
+# connection, so calls from several threads run at the same time.
+class CloudClient:
+    def __init__(self, on_message=None):
+        self.on_message = on_message  # Called with notifications and connection errors
+        self.sock_buf = None
+        self.mux = None
+        self.username = None
+        self.server_address = None  # (host, port) used to open extra upload connections
+        self.compression = None  # Codec negotiated with the server for compressed transfers
+        self.dedup_supported = False  # Whether the server stores chunks
+        self.verify = False  # Whether the server sends checksums to verify transfers against
+
+    # Connect, log in and switch to a multiplexed connection
+    def connect(self, host, port, username):
+        self.server_address = (host, int(port))
+        sock = socket.create_connection(self.server_address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock_buf = SocketBuffer(sock)
+        try:
+            # Send username to server, offering the compression codecs available here and
+            # asking for checksums and whether it deduplicates chunks
+            self.sock_buf.send_line(f"{username} CAPS={','.join(PREFERENCE + [CHECKSUM, DEDUP])}")
+            response = check(self.sock_buf.recv_line())
+            if response != "OK" and not response.startswith("OK "):
+                raise ServerError(f"Received unknown response from server: {response}")
+            caps = response.partition("CAPS=")[2]
+            self.compression = choose_codec(caps.split(",")) if caps else None
+            self.verify = CHECKSUM in caps.split(",")
+            self.dedup_supported = DEDUP in caps.split(",")
+            # Switch to multiplexed frames so several operations can run at once
+            self.sock_buf.send_line("MUX")
+            if self.sock_buf.recv_line() != "OK MUX":
+                raise ServerError("Server does not support multiplexed connections.")
+        except Exception:
+            sock.close()
+            self.sock_buf = None
+            raise
+        self.username = username
+        self.mux = Multiplexer(self.sock_buf)
+        threading.Thread(target=self.reader, daemon=True).start()
+
+    # Route frames until the connection ends
+    def reader(self):
+        mux = self.mux
+        try:
+            mux.run(self.notify)
+        except Exception as e:
+            if self.mux is mux:  # Not closed on purpose
+                self.notify(f"Connection error: {e}")
+
+    def notify(self, message):
+        if self.on_message is not None:
+            self.on_message(message)
+
+    def close(self):
+        if self.mux is not None:
+            mux, self.mux = self.mux, None
+            try:
+                mux.close()  # Close the connection's control stream
+            except OSError:
+                pass
+            self.sock_buf.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open_stream(self):
+        if self.mux is None:
+            raise ConnectionError("Not connected to server!")
+        return self.mux.open_stream()
+
+    # Upload a file, returning the server's reply. Deduplicating servers only get the
+    # missing chunks, compressible files go compressed and large files go as a
+    # resumable session.
+    def upload(self, file_path, filename=None):
+        filename = filename or os.path.basename(file_path)
+        filesize = os.path.getsize(file_path)
+        with self.open_stream() as conn:
+            if self.dedup_supported and filesize:
+                return check(self.upload_deduplicated(conn, file_path, filename, filesize))
+            if filesize >= RANGE_SIZE and not self.use_compression(file_path):
+                return check(self.upload_in_session(conn, file_path, filename, filesize))
+            checksum = self.send_upload(conn, file_path, filename, filesize)
+            return check(self.upload_reply(conn, filename, checksum))
+
+    # Whether a file should be sent compressed; bandwidth is then the bottleneck, so it
+    # goes over one stream instead of parallel ranges
+    def use_compression(self, file_path):
+        return bool(self.compression) and is_compressible(file_path)
+
+    # Send an UPLOAD command and the file body without waiting for the reply, returning
+    # the checksum of what was read from the file
+    def send_upload(self, conn, file_path, filename, filesize):
+        with open(file_path, "rb") as raw:
+            f = ChecksumReader(raw)
+            if self.use_compression(file_path):
+                conn.send_line(f"UPLOAD {filename} {filesize} codec={self.compression}")
+                for frame in encode_stream(self.compression, f):
+                    conn.send_data(frame)
+                return f.checksum.value()
+            # Send upload command with filename and size, then the data in chunks
+            conn.send_line(f"UPLOAD {filename} {filesize}")
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                conn.send_data(chunk)
+            return f.checksum.value()
+
+    # Read the reply to an upload, turning it into an error if the server stored
+    # something other than what was sent
+    def upload_reply(self, conn, filename, checksum):
+        message, stored = split_checksum(recv_response(conn))
+        if stored is not None and stored != checksum:
+            return f"ERROR {filename} was damaged in transit; the server's checksum does not match. Upload it again."
+        return message
+
+    # Send ranges of the file over one extra connection until the work queue is empty
+    def send_ranges(self, file_path, session_id, work, errors):
+        try:
+            with socket.create_connection(self.server_address) as sock, open(file_path, "rb") as f:
+                conn = SocketBuffer(sock)
+                conn.send_line(f"ATTACH {session_id}")
+                response = conn.recv_line()
+                if response != "OK":
+                    raise ConnectionError(response)
+                while True:
+                    try:
+                        offset, length = work.get_nowait()
+                    except queue.Empty:
+                        break
+                    conn.send_line(f"SESSION_PUT {session_id} {offset} {length}")
+                    sock.sendfile(f, offset, length)
+                    response = conn.recv_line()
+                    if response.startswith("ERROR"):
+                        raise ConnectionError(response)
+                conn.send_line("EXIT")
+        except Exception as e:
+            errors.append(e)
+
+    # Upload a large file as a resumable session over several parallel connections
+    def upload_in_session(self, conn, file_path, filename, filesize):
+        saved = load_saved_sessions()
+        key = os.path.abspath(file_path)
+        mtime = os.path.getmtime(file_path)
+        session_id = None
+        committed = "-"
+        entry = saved.get(key)
+        if entry and entry["size"] == filesize and entry["mtime"] == mtime:
+            # Resume: ask the server which ranges it already has
+            conn.send_line(f"SESSION_STATUS {entry['session']}")
+            message = recv_response(conn)
+            if not message.startswith("ERROR"):
+                session_id = entry["session"]
+                committed = message.split()[1]
+                self.notify(f"Resuming upload of {filename}...")
+        if session_id is None:
+            conn.send_line(f"SESSION_CREATE {filename} {filesize}")
+            message = recv_response(conn)
+            if message.startswith("ERROR"):
+                return message
+            session_id = message
+            saved[key] = {"session": session_id, "size": filesize, "mtime": mtime}
+            save_sessions(saved)
+
+        work = queue.Queue()
+        for piece in missing_ranges(filesize, committed):
+            work.put(piece)
+        errors = []
+        senders = [threading.Thread(target=self.send_ranges, args=(file_path, session_id, work, errors), daemon=True)
+                   for _ in range(min(UPLOAD_STREAMS, work.qsize()))]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        if errors:
+            return f"ERROR Upload of {filename} interrupted ({errors[0]}); upload it again to resume."
+
+        conn.send_line(f"SESSION_COMMIT {session_id}")
+        message = split_checksum(recv_response(conn))[0]
+        if not message.startswith("ERROR"):
+            saved = load_saved_sessions()
+            saved.pop(key, None)
+            save_sessions(saved)
+        return message
+
+    # Upload only the chunks the server does not already have
+    def upload_deduplicated(self, conn, file_path, filename, filesize):
+        chunks = []  # (hash, offset, size) in file order
+        checksum = StreamChecksum()  # Whole-file checksum for the server to record
+        with open(file_path, "rb") as f:
+            offset = 0
+            for digest, data in chunk_file(f):
+                chunks.append((digest, offset, len(data)))
+                checksum.update(data)
+                offset += len(data)
+        unique = list(dict.fromkeys(digest for digest, _, _ in chunks))
+        have = set()
+        for start in range(0, len(unique), HAVE_BATCH):
+            batch = unique[start:start + HAVE_BATCH]
+            conn.send_line("HAVE " + " ".join(batch))
+            message = recv_response(conn)
+            if message.startswith("ERROR"):
+                return message
+            have.update(digest for digest, bit in zip(batch, message) if bit == "1")
+
+        # Pipeline the missing chunks, reading replies once PIPELINE_DEPTH are in flight so
+        # the server never stalls on a full send window
+        sent = set()
+        replies = []
+        with open(file_path, "rb") as f:
+            for digest, offset, size in chunks:
+                if digest in have or digest in sent:
+                    continue
+                f.seek(offset)
+                conn.send_line(f"CHUNK_PUT {digest} {size}")
+                conn.send_data(f.read(size))
+                sent.add(digest)
+                if len(sent) - len(replies) >= PIPELINE_DEPTH:
+                    replies.append(recv_response(conn))
+        replies += [recv_response(conn) for _ in range(len(sent) - len(replies))]
+        errors = [message for message in replies if message.startswith("ERROR")]
+        if errors:
+            return errors[0]
+        self.notify(f"Sent {len(sent)} of {len(unique)} chunks of {filename}; the server had the rest.")
+
+        lines = [f"UPLOAD_MANIFEST {filename} {filesize} {len(chunks)} checksum={checksum.value()}"]
+        lines += [f"{digest} {size}" for digest, _, size in chunks]
+        conn.send_data(("\n".join(lines) + "\n").encode())
+        return split_checksum(recv_response(conn))[0]
+
+    # FETCH command for a file, or for the range from offset if offset or length is given
+    def fetch_command(self, filename, owner, offset=0, length=None):
+        command = f"FETCH {filename} {owner}"
+        if offset or length is not None:
+            command += f" {offset}" if length is None else f" {offset} {length}"
+        if self.compression:
+            command += f" codec={self.compression}"  # Ask for a compressed body
+        return command
+
+    # Download a file into file_path, returning its size. With resume, a partial file_path
+    # is continued from its end; with segments > 1, a large download is split into that
+    # many ranges fetched over parallel connections.
+    def download(self, filename, owner, file_path, resume=False, segments=1):
+        offset = os.path.getsize(file_path) if resume and os.path.isfile(file_path) else 0
+        with self.open_stream() as conn:
+            if offset or segments > 1:
+                # An empty range tells the current size and checksum
+                conn.send_line(f"FETCH {filename} {owner} 0 0")
+                _, _, options = parse_download_header(check(conn.recv_line()))
+                total = int(options["range"].split("/")[1])
+                if offset > total:
+                    offset = 0  # The local file is not a prefix of this version
+                if segments > 1 and total - offset >= SEGMENT_MIN:
+                    return self.download_segments(filename, owner, file_path, offset, total, segments,
+                                                  options.get("checksum"))
+            conn.send_line(self.fetch_command(filename, owner, offset))
+            return self.recv_download(conn, file_path, offset)
+
+    # Read one FETCH reply, streaming the body straight to disk and checking it against
+    # the checksum in the reply; a damaged file is removed. A reply to a range from
+    # offset is appended to the first offset bytes already in file_path.
+    def recv_download(self, conn, file_path, offset=0):
+        length, codec, options = parse_download_header(check(conn.recv_line()))
+        checksum = options.get("checksum")
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        with open(file_path, "r+b" if offset else "wb") as raw:
+            f = ChecksumWriter(raw)
+            if offset:
+                # Hash the part already on disk so the whole file is still verified
+                while raw.tell() < offset:
+                    f.checksum.update(raw.read(min(RANGE_SIZE, offset - raw.tell())))
+                raw.truncate()
+            if codec:
+                conn.recv_frames_to_file(f, codec)
+            else:
+                conn.recv_to_file(f, length)
+        if checksum is not None and f.checksum.value() != checksum:
+            os.remove(file_path)
+            raise ServerError(f"Download of {os.path.basename(file_path)} was damaged; its checksum does not match.")
+        return offset + length
+
+    # Fetch everything from offset to total as parallel ranges, each over its own
+    # connection and written in place with pwrite, then verify the whole file. If a range
+    # fails, the file is cut back to the part received in order so it can be resumed.
+    def download_segments(self, filename, owner, file_path, offset, total, segments, checksum):
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        with open(file_path, "r+b" if offset else "wb") as f:
+            f.truncate(total)
+        size = -(-(total - offset) // segments)
+        ranges = [(start, min(size, total - start)) for start in range(offset, total, size)]
+        done = set()
+        errors = []
+        fd = os.open(file_path, os.O_WRONLY)
+        try:
+            fetchers = [threading.Thread(target=self.fetch_range,
+                                         args=(filename, owner, fd, start, length, checksum, done, errors), daemon=True)
+                        for start, length in ranges]
+            for fetcher in fetchers:
+                fetcher.start()
+            for fetcher in fetchers:
+                fetcher.join()
+        finally:
+            os.close(fd)
+        if errors:
+            received = offset
+            for start, length in ranges:
+                if start not in done:
+                    break
+                received = start + length
+            os.truncate(file_path, received)
+            raise errors[0]
+        if checksum is not None:
+            with open(file_path, "rb") as f:
+                if file_checksum(f) != checksum:
+                    os.remove(file_path)
+                    raise ServerError(f"Download of {os.path.basename(file_path)} was damaged; its checksum does not match.")
+        return total
+
+    # Fetch one range over a download-only connection into fd
+    def fetch_range(self, filename, owner, fd, start, length, checksum, done, errors):
+        try:
+            with socket.create_connection(self.server_address) as sock:
+                conn = SocketBuffer(sock)
+                conn.send_line(f"READER {self.username} CAPS={','.join(PREFERENCE + [CHECKSUM])}")
+                check(conn.recv_line())
+                conn.send_line(self.fetch_command(filename, owner, start, length))
+                received, codec, options = parse_download_header(check(conn.recv_line()))
+                if options.get("checksum") != checksum or received != length:
+                    raise ServerError(f"{filename} changed on the server during the download.")
+                if codec:
+                    conn.recv_frames_to_file(RangeWriter(fd, start), codec)
+                else:
+                    conn.recv_to_file(RangeWriter(fd, start), length)
+                conn.send_line("EXIT")
+            done.add(start)
+        except Exception as e:
+            errors.append(e)
+
+    # List stored files as (filename, owner) pairs, page by page
+    def list_files(self, prefix=None, owner=None):
+        files = []
+        cursor = "-"
+        with self.open_stream() as conn:
+            while True:
+                conn.send_line(f"LIST {prefix or '-'} {owner or '-'} {cursor} {LIST_PAGE_SIZE}")  # Request the next page
+                message = check(conn.recv_line())
+                count, cursor = message[len("LISTING:"):].split()
+                for _ in range(int(count)):
+                    filename, _, entry_owner = conn.recv_line().partition(" (Owner: ")
+                    files.append((filename, entry_owner[:-1]))
+                if cursor == "-":
+                    return files
+
+    # Delete one of our files, returning the server's reply
+    def delete(self, filename):
+        with self.open_stream() as conn:
+            conn.send_line(f"DELETE {filename}")
+            return check(recv_response(conn))
+
+    # Ask for EVENT lines about uploads, deletes and downloads (all by default) of one
+    # owner's files or of names starting with prefix; they reach on_message
+    def subscribe(self, events=None, owner=None, prefix=None):
+        options = [f"events={','.join(events)}"] if events else []
+        options += [f"owner={owner}"] if owner else []
+        options += [f"prefix={prefix}"] if prefix else []
+        with self.open_stream() as conn:
+            conn.send_line(" ".join(["SUBSCRIBE"] + options))
+            return check(recv_response(conn))
+
+    def unsubscribe(self):
+        with self.open_stream() as conn:
+            conn.send_line("UNSUBSCRIBE")
+            return check(recv_response(conn))
+
+    # Upload every file below folder, keeping relative paths in the stored names
+    def upload_tree(self, folder, workers=DEFAULT_WORKERS):
+        files = [(path, remote_name(folder, path)) for path in walk_files(folder)]
+        return run_workers(self.upload_worker, files, workers)
+
+    # Bulk upload worker: plain and compressed uploads are pipelined on one stream, while
+    # deduplicated and session uploads need their replies as they go
+    def upload_worker(self, work, results):
+        try:
+            with self.open_stream() as conn:
+                in_flight = deque()  # (name, checksum) of uploads whose replies are still to come
+                while True:
+                    try:
+                        file_path, filename = work.get_nowait()
+                    except queue.Empty:
+                        break
+                    try:
+                        filesize = os.path.getsize(file_path)
+                        if (self.dedup_supported and filesize) or (filesize >= RANGE_SIZE and not self.use_compression(file_path)):
+                            self.collect_replies(conn, in_flight, results, 0)
+                            if self.dedup_supported and filesize:
+                                message = self.upload_deduplicated(conn, file_path, filename, filesize)
+                            else:
+                                message = self.upload_in_session(conn, file_path, filename, filesize)
+                            results.append((filename, not message.startswith("ERROR"), message))
+                            continue
+                        checksum = self.send_upload(conn, file_path, filename, filesize)
+                    except OSError as e:
+                        results.append((filename, False, str(e)))
+                        continue
+                    in_flight.append((filename, checksum))
+                    self.collect_replies(conn, in_flight, results, PIPELINE_DEPTH - 1)
+                self.collect_replies(conn, in_flight, results, 0)
+        except Exception as e:
+            results.append((None, False, f"Worker stopped: {e}"))
+
+    # Read replies until at most keep requests are still in flight
+    def collect_replies(self, conn, in_flight, results, keep):
+        while len(in_flight) > keep:
+            filename, checksum = in_flight.popleft()
+            message = self.upload_reply(conn, filename, checksum)
+            results.append((filename, not message.startswith("ERROR"), message))
+
+    # Download every stored file whose decoded name matches a shell pattern into folder.
+    # Files of other users go below a folder named after the owner unless owner is given.
+    # With resume or segments the files are fetched one at a time through download().
+    def download_matching(self, pattern, folder, owner=None, workers=DEFAULT_WORKERS, resume=False, segments=1):
+        files = []
+        for filename, file_owner in self.list_files(owner=owner):
+            if fnmatch.fnmatchcase(unquote(filename), pattern):
+                files.append((filename, file_owner, local_path(folder if owner else os.path.join(folder, file_owner), filename)))
+        if resume or segments > 1:
+            return run_workers(lambda work, results: self.download_each(work, results, resume, segments), files, workers)
+        return run_workers(self.download_worker, files, workers)
+
+    # Download worker resuming partial files and splitting large ones into segments
+    def download_each(self, work, results, resume, segments):
+        while True:
+            try:
+                filename, owner, file_path = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results.append((filename, True, f"{self.download(filename, owner, file_path, resume, segments)} bytes"))
+            except (OSError, ServerError) as e:
+                results.append((filename, False, str(e)))
+
+    # Bulk download worker: keeps up to PIPELINE_DEPTH FETCH requests in flight on its stream
+    def download_worker(self, work, results):
+        try:
+            with self.open_stream() as conn:
+                in_flight = deque()  # (filename, local path) whose replies are still to come
+                while True:
+                    try:
+                        filename, owner, file_path = work.get_nowait()
+                    except queue.Empty:
+                        break
+                    conn.send_line(self.fetch_command(filename, owner))
+                    in_flight.append((filename, file_path))
+                    if len(in_flight) >= PIPELINE_DEPTH:
+                        self.collect_download(conn, in_flight, results)
+                while in_flight:
+                    self.collect_download(conn, in_flight, results)
+        except Exception as e:
+            results.append((None, False, f"Worker stopped: {e}"))
+
+    def collect_download(self, conn, in_flight, results):
+        filename, file_path = in_flight.popleft()
+        try:
+            results.append((filename, True, f"{self.recv_download(conn, file_path)} bytes"))
+        except ServerError as e:
+            results.append((filename, False, str(e)))
+
+    # Upload the files below folder that are new or changed since the last sync, or
+    # missing on the server. What was uploaded is remembered in SYNC_STATE_FILE.
+    def sync(self, folder, workers=DEFAULT_WORKERS):
+        state_path = os.path.join(folder, SYNC_STATE_FILE)
+        try:
+            with open(state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        stored = {filename for filename, _ in self.list_files(owner=self.username)}
+        signatures = {}
+        changed = []
+        for file_path in walk_files(folder):
+            filename = remote_name(folder, file_path)
+            stat = os.stat(file_path)
+            signatures[filename] = [stat.st_size, stat.st_mtime_ns]
+            if filename not in stored or state.get(filename) != signatures[filename]:
+                changed.append((file_path, filename))
+        results = run_workers(self.upload_worker, changed, workers)
+        state = {filename: signature for filename, signature in state.items() if filename in signatures}
+        for filename, ok, _ in results:
+            if ok:
+                state[filename] = signatures[filename]
+        with open(state_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        return results
+
+
+# Print bulk results and return the process exit status
+def report(results):
+    failed = 0
+    for filename, ok, message in results:
+        if not ok:
+            failed += 1
+        print(f"{'ok' if ok else 'FAILED'} {unquote(filename) if filename else '-'}: {message}")
+    print(f"{len(results) - failed} succeeded, {failed} failed.")
+    return 1 if failed else 0
+
+
+# Command-line entry point for scripted and bulk transfers
+def main():
+    parser = argparse.ArgumentParser(description="Headless cloud file storage client.")
+    parser.add_argument("--host", required=True, help="Server address")
+    parser.add_argument("--port", type=int, required=True, help="Server port")
+    parser.add_argument("--user", required=True, help="Username to log in as")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Streams used by bulk commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+    upload = commands.add_parser("upload", help="Upload files, or whole folders with their relative paths")
+    upload.add_argument("paths", nargs="+")
+    download = commands.add_parser("download", help="Download every file matching a shell pattern")
+    download.add_argument("pattern")
+    download.add_argument("folder")
+    download.add_argument("--owner", help="Only files of this user")
+    download.add_argument("--resume", action="store_true", help="Continue partial files instead of starting over")
+    download.add_argument("--segments", type=int, default=1,
+                          help="Fetch files of 16 MB or more as this many ranges over parallel connections")
+    listing = commands.add_parser("list", help="List stored files")
+    listing.add_argument("--prefix")
+    listing.add_argument("--owner")
+    delete = commands.add_parser("delete", help="Delete your files")
+    delete.add_argument("filenames", nargs="+")
+    sync = commands.add_parser("sync", help="Upload new and changed files of a folder")
+    sync.add_argument("folder")
+    watch = commands.add_parser("watch", help="Print file events until interrupted")
+    watch.add_argument("--events", help="Comma-separated kinds: upload, delete, download (default all)")
+    watch.add_argument("--owner", help="Only files of this user")
+    watch.add_argument("--prefix", help="Only files whose names start with this")
+    args = parser.parse_args()
+
+    with CloudClient(on_message=print) as client:
+        try:
+            client.connect(args.host, args.port, args.user)
+        except (OSError, ServerError) as e:
+            print(f"Connection error: {e}")
+            return 1
+        if args.command == "upload":
+            results = []
+            files = []
+            for path in args.paths:
+                if os.path.isdir(path):
+                    results += client.upload_tree(path, args.workers)
+                else:
+                    files.append((path, os.path.basename(path)))
+            results += run_workers(client.upload_worker, files, args.workers)
+            return report(results)
+        if args.command == "download":
+            return report(client.download_matching(args.pattern, args.folder, args.owner, args.workers,
+                                                   args.resume, args.segments))
+        if args.command == "list":
+            for filename, owner in client.list_files(args.prefix, args.owner):
+                print(f"{filename} (Owner: {owner})")
+            return 0
+        if args.command == "delete":
+            results = []
+            for filename in args.filenames:
+                try:
+                    results.append((filename, True, client.delete(filename)))
+                except ServerError as e:
+                    results.append((filename, False, str(e)))
+            return report(results)
+        if args.command == "watch":
+            try:
+                client.subscribe(args.events.split(",") if args.events else None, args.owner, args.prefix)
+            except ServerError as e:
+                print(e)
+                return 1
+            try:
+                threading.Event().wait()  # Events are printed by the reader thread
+            except KeyboardInterrupt:
+                return 0
+        return report(client.sync(args.folder, args.workers))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
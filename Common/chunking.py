@@ -0,0 +1,78 @@
+import hashlib
+
+MIN_CHUNK = 2048  # No cut point closer than this to the previous one
+MAX_CHUNK = 65536  # Forced cut point if the content offers none
+DEDUP = "dedup"  # Login capability accepted by servers that store chunks
+
+# Every byte is mapped to 0 or 1 with bytes.translate, and a chunk ends where the
+# mapped stream matches CUT_PATTERN. Both steps run in C, and a 13-symbol pattern
+# matches about once every 8 KB of random data.
+MARKER_TABLE = bytes(hashlib.sha256(bytes([value])).digest()[0] & 1 for value in range(256))
+CUT_PATTERN = bytes([1, 1, 0, 1, 0, 0, 0, 1, 0, 1, 1, 0, 0])
+
+
+# Hash naming a chunk in the content-addressed store
+def chunk_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# Content-defined chunker: cut points depend only on the 13 bytes before them, so an
+# insertion or deletion only changes the chunks around the edit.
+class Chunker:
+    def __init__(self):
+        self.pending = bytearray()  # Bytes not yet emitted as a chunk
+        self.marks = bytearray()  # Pending bytes mapped through MARKER_TABLE
+        self.scan = MIN_CHUNK  # Next position to examine for a cut point
+
+    # Add data and return the chunks it completes
+    def feed(self, data):
+        self.pending += data
+        self.marks += bytes(data).translate(MARKER_TABLE)
+        chunks = []
+        start = 0
+        with memoryview(self.pending) as view:
+            while True:
+                cut = self.find_cut(start)
+                if cut is None:
+                    break
+                chunks.append(bytes(view[start:cut]))
+                start = cut
+                self.scan = start + MIN_CHUNK
+        del self.pending[:start]
+        del self.marks[:start]
+        self.scan -= start
+        return chunks
+
+    # Return the remaining bytes as the final chunk (None if empty)
+    def finish(self):
+        chunk = bytes(self.pending) if self.pending else None
+        self.pending.clear()
+        self.marks.clear()
+        self.scan = MIN_CHUNK
+        return chunk
+
+    # Next cut point after start, or None if more data is needed to decide
+    def find_cut(self, start):
+        limit = start + MAX_CHUNK
+        end = min(len(self.pending), limit)
+        position = self.marks.find(CUT_PATTERN, max(self.scan, start + MIN_CHUNK) - len(CUT_PATTERN), end)
+        if position >= 0:
+            return position + len(CUT_PATTERN)
+        if len(self.pending) >= limit:
+            return limit
+        self.scan = max(self.scan, end)
+        return None
+
+
+# Split a whole file into chunks, yielding (hash, data) pairs
+def chunk_file(f, read_size=1048576):
+    chunker = Chunker()
+    while True:
+        data = f.read(read_size)
+        if not data:
+            break
+        for chunk in chunker.feed(data):
+            yield chunk_hash(chunk), chunk
+    chunk = chunker.finish()
+    if chunk is not None:
+        yield chunk_hash(chunk), chunk
@@ -0,0 +1,87 @@
+import struct
+import zlib
+
+BLOCK_SIZE = 262144  # Uncompressed bytes per frame
+SAMPLE_SIZE = 4096  # Bytes test-compressed to decide whether a block is worth compressing
+MIN_SAVING = 0.1  # Blocks whose sample shrinks less than this are sent as-is
+
+RAW = 0  # Frame payload is stored uncompressed
+COMPRESSED = 1  # Frame payload is compressed with the transfer's codec
+FRAME_HEADER = struct.Struct("!BI")  # Frame kind, payload length; a zero length ends the body
+END_FRAME = FRAME_HEADER.pack(RAW, 0)  # Marks the end of a compressed body
+
+
+# Refuse a decompressed frame larger than any block a peer could have compressed
+def bounded(block):
+    if len(block) > BLOCK_SIZE:
+        raise ValueError("Compressed frame expands beyond the block size.")
+    return block
+
+
+# Decompress at most one byte past BLOCK_SIZE, so a frame that would expand further fails
+def zlib_decompress(data):
+    decompressor = zlib.decompressobj()
+    block = decompressor.decompress(data, BLOCK_SIZE + 1)
+    if decompressor.unconsumed_tail:
+        raise ValueError("Compressed frame expands beyond the block size.")
+    return bounded(block)
+
+
+# Codecs by name as (compress, decompress); optional ones are used only when installed.
+# Decompression stops just past BLOCK_SIZE so a hostile frame cannot expand without bound.
+CODECS = {"zlib": (lambda data: zlib.compress(data, 1), zlib_decompress)}
+try:
+    import zstandard
+    # decompress() trusts the content size in the frame header, so read through a stream
+    CODECS["zstd"] = (lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                      lambda data: bounded(zstandard.ZstdDecompressor().stream_reader(data).read(BLOCK_SIZE + 1)))
+except ImportError:
+    pass
+try:
+    import lz4.frame
+    CODECS["lz4"] = (lz4.frame.compress,
+                     lambda data: bounded(lz4.frame.LZ4FrameDecompressor().decompress(data, max_length=BLOCK_SIZE + 1)))
+except ImportError:
+    pass
+
+PREFERENCE = [name for name in ("zstd", "lz4", "zlib") if name in CODECS]  # Best first
+
+
+# Pick the first codec from offered (in the peer's order) that is available here
+def choose_codec(offered):
+    for name in offered:
+        if name in CODECS:
+            return name
+    return None
+
+
+# Cheap check on a sample so incompressible data does not cost a full compression
+def looks_compressible(block):
+    sample = block[:SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) < len(sample) * (1 - MIN_SAVING)
+
+
+# Encode one block of data as a frame, falling back to raw if compression does not pay
+def encode_frame(codec, block):
+    if looks_compressible(block):
+        payload = CODECS[codec][0](block)
+        if len(payload) < len(block):
+            return FRAME_HEADER.pack(COMPRESSED, len(payload)) + payload
+    return FRAME_HEADER.pack(RAW, len(block)) + bytes(block)
+
+
+# Decode a frame payload given its kind
+def decode_payload(codec, kind, payload):
+    if kind == COMPRESSED:
+        return CODECS[codec][1](payload)
+    return payload
+
+
+# Yield the frames for everything read from f, ending with END_FRAME
+def encode_stream(codec, f):
+    while True:
+        block = f.read(BLOCK_SIZE)
+        if not block:
+            break
+        yield encode_frame(codec, block)
+    yield END_FRAME
@@ -0,0 +1,76 @@
+BUFFER_SIZE = 262144  # Initial capacity of a receive buffer
+MAX_LINE = 1048576  # Longest text line accepted before the peer is considered broken
+
+
+# Reusable receive buffer filled with recv_into, shared by the client and the server.
+# Unread bytes live between self.start and self.end; they are moved back to the front
+# only when the free tail gets too small, so reads never copy the remaining data.
+class RecvBuffer:
+    def __init__(self, size=BUFFER_SIZE):
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.start = 0
+        self.end = 0
+        self.scanned = 0  # Bytes already searched for a newline
+
+    def __len__(self):
+        return self.end - self.start
+
+    # Return the free space to receive into, compacting or growing first if needed
+    def writable(self, min_free=4096):
+        if len(self.data) - self.end < min_free:
+            pending = self.end - self.start
+            if pending + min_free > len(self.data):
+                # A single frame is larger than the buffer, so allocate a bigger one
+                grown = bytearray(max(len(self.data) * 2, pending + min_free))
+                grown[:pending] = self.view[self.start:self.end]
+                self.data = grown
+                self.view = memoryview(grown)
+            elif pending:
+                self.data[:pending] = self.data[self.start:self.end]
+            self.scanned -= self.start
+            self.start = 0
+            self.end = pending
+        return self.view[self.end:]
+
+    # Mark num_bytes written into the view returned by writable() as received
+    def commit(self, num_bytes):
+        self.end += num_bytes
+
+    # Append bytes that were received some other way, e.g. from a multiplexed stream
+    def feed(self, data):
+        self.writable(len(data))[:len(data)] = data
+        self.commit(len(data))
+
+    # Pop one line without its newline, or return None if no full line is buffered
+    def take_line(self):
+        index = self.data.find(b'\n', self.scanned, self.end)
+        if index < 0:
+            self.scanned = self.end
+            if self.end - self.start > MAX_LINE:
+                raise ValueError("Line too long.")
+            return None
+        line = self.data[self.start:index].decode()
+        self.start = index + 1
+        self.scanned = self.start
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+        return line
+
+    # View of up to num_bytes of buffered data, valid until the next writable() call
+    def peek(self, num_bytes):
+        return self.view[self.start:min(self.end, self.start + num_bytes)]
+
+    # Drop num_bytes from the front of the buffered data
+    def consume(self, num_bytes):
+        self.start += num_bytes
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+        elif self.scanned < self.start:
+            self.scanned = self.start
+
+    # Pop up to num_bytes of buffered data as bytes
+    def take(self, num_bytes):
+        data = bytes(self.peek(num_bytes))
+        self.consume(len(data))
+        return data
@@ -0,0 +1,56 @@
+import hashlib
+
+CHECKSUM = "blake2b"  # Algorithm of file checksums; also the capability offered at login
+BLOCK = 1024 * 1024  # Bytes hashed per read when checksumming a whole file
+
+
+# Running checksum of a stream, fed with the data as it goes by
+class StreamChecksum:
+    def __init__(self):
+        self.hash = hashlib.blake2b(digest_size=16)
+
+    def update(self, data):
+        self.hash.update(data)
+
+    # Checksum text as stored and sent: "<algorithm>:<hex digest>"
+    def value(self):
+        return f"{CHECKSUM}:{self.hash.hexdigest()}"
+
+
+# File wrapper that checksums everything written through it
+class ChecksumWriter:
+    def __init__(self, f):
+        self.file = f
+        self.checksum = StreamChecksum()
+
+    def write(self, data):
+        self.checksum.update(data)
+        return self.file.write(data)
+
+
+# File wrapper that checksums everything read through it
+class ChecksumReader:
+    def __init__(self, f):
+        self.file = f
+        self.checksum = StreamChecksum()
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.checksum.update(data)
+        return data
+
+
+# Checksum of everything left in f
+def file_checksum(f):
+    checksum = StreamChecksum()
+    while True:
+        data = f.read(BLOCK)
+        if not data:
+            return checksum.value()
+        checksum.update(data)
+
+
+# Pull a trailing checksum=<value> option off a reply, returning (text, checksum or None)
+def split_checksum(message):
+    text, found, checksum = message.rpartition(" checksum=")
+    return (text, checksum) if found else (message, None)
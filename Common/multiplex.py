@@ -0,0 +1,21 @@
+import struct
+
+# Framing of a multiplexed connection. After the client sends MUX (answered with
+# "OK MUX"), both sides exchange only frames. Every stream carries the bytes of an
+# ordinary connection after login (command lines and bodies), so the server runs its
+# normal command loop on each stream, and streams interleave frame by frame.
+MUX_HEADER = struct.Struct("!IBI")  # Stream id, frame kind, payload length
+WINDOW_INCREMENT = struct.Struct("!I")  # Payload of a WINDOW frame
+
+DATA = 0  # Payload bytes for the stream; the client opens streams in increasing id order with an empty one
+WINDOW = 1  # The receiver consumed this many more bytes, so the sender may send them
+END = 2  # The sender is done with the stream; END on the control stream closes the connection
+
+CONTROL_STREAM = 0  # Carries server notifications; not flow controlled
+MAX_FRAME = 65536  # Largest payload per frame, so a big transfer never holds up other streams for long
+INITIAL_WINDOW = 1048576  # Bytes a sender may have unacknowledged on one stream
+
+
+# Encode one frame
+def pack_frame(stream_id, kind, payload=b''):
+    return MUX_HEADER.pack(stream_id, kind, len(payload)) + payload
@@ -0,0 +1,216 @@
+import asyncio
+import heapq
+import math
+import time
+from contextlib import contextmanager
+
+QUANTUM = 65536  # Most bytes sent with sendfile between two grants of the scheduler
+BURST_SECONDS = 0.1  # A bucket holds this much of its rate, so short replies go out at once
+SHORT_TRANSFER = 1024 * 1024  # Transfers up to this many bytes count as short
+SHORT_WEIGHT = 8  # Share of a congested limit a short transfer gets against one bulk transfer
+MAX_USERS = 4096  # Per-user buckets kept before idle ones are forgotten
+DIRECTIONS = ("egress", "ingress")
+SETTINGS = ("egress", "ingress", "user_egress", "user_ingress", "short_weight")
+
+
+# Token bucket of rate bytes per second; a rate of 0 means no limit. take() never
+# refuses: it returns how long to wait before the bytes may move and lets the bucket go
+# into debt, so a request larger than the burst is not starved.
+class TokenBucket:
+    def __init__(self, rate=0):
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.burst = max(rate * BURST_SECONDS, QUANTUM)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until count bytes may be taken, without taking them. A count larger than
+    # the burst only waits for a full bucket and then goes into debt, as the bucket can
+    # never hold it.
+    def delay(self, count):
+        if not self.rate:
+            return 0.0
+        self.refill()
+        return max(0.0, (min(count, self.burst) - self.tokens) / self.rate)
+
+    def take(self, count):
+        if not self.rate:
+            return 0.0
+        self.refill()
+        self.tokens -= count
+        return max(0.0, -self.tokens / self.rate)
+
+    def full(self):
+        self.refill()
+        return self.tokens >= self.burst
+
+
+# One request's data in one direction, paced by a Link. Short transfers get a larger
+# weight and so a larger share of the link while bulk transfers are running.
+class Transfer:
+    def __init__(self, link, username, weight):
+        self.link = link
+        self.username = username
+        self.weight = weight
+        self.finish = 0.0  # Virtual finish time of the last grant
+
+    def limited(self):
+        return bool(self.link.bucket.rate or self.link.user_rate)
+
+    # Wait until count more bytes may move
+    async def acquire(self, count):
+        self.link.bytes += count
+        if self.limited():
+            await self.link.acquire(self, count)
+
+
+# One direction of the server's traffic: a bucket for the whole server and one per user.
+# Transfers waiting on the server bucket are served by weighted fair queuing: each grant
+# is stamped with a virtual finish time, the transfer's previous finish (or the current
+# virtual time if it was idle) plus count / weight, and the smallest stamp goes next.
+# A short transfer therefore overtakes bulk ones instead of queuing behind them.
+class Link:
+    def __init__(self, direction):
+        self.direction = direction
+        self.bucket = TokenBucket()
+        self.user_rate = 0
+        self.users = {}  # Username -> TokenBucket
+        self.queue = []  # (finish, sequence, count, future) waiting for the server bucket
+        self.sequence = 0
+        self.virtual_time = 0.0
+        self.dispatcher = None
+        self.wakeup = None  # Future the dispatcher waits on while the bucket refills
+        self.bytes = 0  # Bytes of every transfer, paced or not
+        self.throttled_seconds = 0.0
+
+    def set_user_rate(self, rate):
+        self.user_rate = rate
+        for bucket in self.users.values():
+            bucket.set_rate(rate)
+
+    def user_bucket(self, username):
+        bucket = self.users.get(username)
+        if bucket is None:
+            if len(self.users) >= MAX_USERS:
+                self.users = {name: kept for name, kept in self.users.items() if not kept.full()}
+            bucket = self.users[username] = TokenBucket(self.user_rate)
+        return bucket
+
+    async def acquire(self, transfer, count):
+        started = time.perf_counter()
+        if self.user_rate:
+            delay = self.user_bucket(transfer.username).take(count)
+            if delay:
+                await asyncio.sleep(delay)
+        if self.bucket.rate:
+            finish = max(self.virtual_time, transfer.finish) + count / transfer.weight
+            transfer.finish = finish
+            if not self.queue and not self.bucket.delay(count):
+                self.bucket.take(count)
+                self.virtual_time = finish
+            else:
+                future = asyncio.get_running_loop().create_future()
+                self.sequence += 1
+                heapq.heappush(self.queue, (finish, self.sequence, count, future))
+                if self.dispatcher is None:
+                    self.dispatcher = asyncio.get_running_loop().create_task(self.dispatch())
+                elif self.queue[0][3] is future:
+                    self.wake()  # Waiting for a larger grant than this one needs
+                await future
+        self.throttled_seconds += time.perf_counter() - started
+
+    # Grant the queued request with the smallest finish time whenever the server bucket
+    # covers it. A request arriving at the head of the queue ends the wait early, so it
+    # is not held up by the refill a larger grant needed.
+    async def dispatch(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.queue:
+                finish, _, count, future = self.queue[0]
+                if future.done():  # Its connection went away
+                    heapq.heappop(self.queue)
+                    continue
+                delay = self.bucket.delay(count)
+                if delay:
+                    self.wakeup = loop.create_future()
+                    timer = loop.call_later(delay, self.wake)
+                    await self.wakeup
+                    timer.cancel()
+                    continue
+                heapq.heappop(self.queue)
+                self.bucket.take(count)
+                self.virtual_time = finish
+                future.set_result(None)
+        finally:
+            self.dispatcher = None
+
+    def wake(self):
+        if self.wakeup is not None and not self.wakeup.done():
+            self.wakeup.set_result(None)
+
+
+# Transfer scheduler for uploads and downloads. egress and ingress cap the whole server
+# in bytes per second, user_egress and user_ingress each user, and short_weight is how
+# strongly short transfers are favoured; 0 means no limit. As one of several worker
+# processes a server enforces its share of the server-wide limits.
+class BandwidthScheduler:
+    def __init__(self, limits=None, share=1.0):
+        self.share = share
+        self.links = {direction: Link(direction) for direction in DIRECTIONS}
+        self.limits = dict.fromkeys(SETTINGS, 0)
+        self.limits["short_weight"] = SHORT_WEIGHT
+        self.configure(limits or {})
+
+    # Change some of the settings; raises ValueError and changes nothing if one is invalid
+    def configure(self, settings):
+        limits = dict(self.limits)
+        for name, value in settings.items():
+            if name not in SETTINGS:
+                raise ValueError(f"Unknown bandwidth setting {name}.")
+            value = float(value)
+            if not math.isfinite(value) or value < 0 or (name == "short_weight" and value < 1):
+                raise ValueError(f"Invalid value for {name}.")
+            limits[name] = value
+        self.limits = limits
+        for direction, link in self.links.items():
+            if link.bucket.rate != limits[direction] * self.share:
+                link.bucket.set_rate(limits[direction] * self.share)
+            if link.user_rate != limits[f"user_{direction}"]:
+                link.set_user_rate(limits[f"user_{direction}"])
+
+    # Settings as "name=value ..." text
+    def describe(self):
+        return " ".join(f"{name}={value:g}" if name == "short_weight" else f"{name}={value:.0f}"
+                        for name, value in self.limits.items())
+
+    # Pace what sock_buf sends or receives for one request of size bytes while in the block
+    @contextmanager
+    def transfer(self, sock_buf, username, direction, size):
+        weight = self.limits["short_weight"] if size <= SHORT_TRANSFER else 1
+        transfer = Transfer(self.links[direction], username, weight)
+        attribute = "sending" if direction == "egress" else "receiving"
+        setattr(sock_buf, attribute, transfer)
+        try:
+            yield transfer
+        finally:
+            setattr(sock_buf, attribute, None)
+
+    # Prometheus exposition lines, one series per direction
+    def render(self):
+        lines = []
+        for name, kind, value in (
+                ("cfs_bandwidth_limit_bytes", "gauge", lambda link: int(self.limits[link.direction])),
+                ("cfs_bandwidth_user_limit_bytes", "gauge", lambda link: int(link.user_rate)),
+                ("cfs_bandwidth_bytes_total", "counter", lambda link: link.bytes),
+                ("cfs_bandwidth_throttled_seconds_total", "counter", lambda link: round(link.throttled_seconds, 6)),
+                ("cfs_bandwidth_queued_requests", "gauge", lambda link: len(link.queue))):
+            lines.append(f"# TYPE {name} {kind}")
+            lines += [f'{name}{{direction="{link.direction}"}} {value(link)}' for link in self.links.values()]
+        return lines
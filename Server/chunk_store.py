@@ -0,0 +1,245 @@
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from chunking import Chunker, chunk_hash
+from storage import sync_directory, sync_file
+
+CHUNK_FOLDER = ".chunks"  # Chunk files named by their SHA-256, fanned out by the first two hex digits
+MANIFEST_FOLDER = ".manifests"  # One JSON manifest per stored file
+
+
+# Reads a stored file back by concatenating the chunks listed in its manifest
+class ManifestReader:
+    def __init__(self, store, chunks):
+        self.store = store
+        self.chunks = chunks  # [[hash, size], ...]
+        self.index = 0
+        self.current = b''
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if not self.current:
+                if self.index == len(self.chunks):
+                    break
+                with open(self.store.chunk_path(self.chunks[self.index][0]), "rb") as f:
+                    self.current = f.read()
+                self.index += 1
+            piece = self.current if size < 0 else self.current[:size]
+            self.current = self.current[len(piece):]
+            parts.append(piece)
+            if size > 0:
+                size -= len(piece)
+        return b''.join(parts)
+
+    # Continue reading at offset, skipping whole chunks without opening them
+    def seek(self, offset):
+        self.index = 0
+        self.current = b''
+        while self.index < len(self.chunks) and offset >= self.chunks[self.index][1]:
+            offset -= self.chunks[self.index][1]
+            self.index += 1
+        if offset:
+            with open(self.store.chunk_path(self.chunks[self.index][0]), "rb") as f:
+                self.current = f.read()[offset:]
+            self.index += 1
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Streams an upload through the chunker, storing chunks as they complete
+class ChunkWriter:
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.chunker = Chunker()
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        for chunk in self.chunker.feed(data):
+            self.add(chunk)
+
+    def add(self, chunk):
+        digest = chunk_hash(chunk)
+        self.store.put_chunk(digest, chunk)
+        self.chunks.append([digest, len(chunk)])
+
+    def commit(self):
+        chunk = self.chunker.finish()
+        if chunk is not None:
+            self.add(chunk)
+        self.store.commit_manifest(self.name, self.size, self.chunks)
+
+    def abort(self):
+        pass  # Chunks nobody references are swept on the next start
+
+
+# Content-addressed storage backend: files are split into content-defined chunks and
+# stored as manifests, so identical data uploaded by many users is kept once.
+class ChunkStore:
+    def __init__(self, folder):
+        self.folder = folder
+        self.chunk_dir = os.path.join(folder, CHUNK_FOLDER)
+        self.manifest_dir = os.path.join(folder, MANIFEST_FOLDER)
+        self.refcounts = {}  # Chunk hash -> number of manifest entries using it
+        self.chunk_sizes = {}  # Chunk hash -> size, for every referenced chunk
+        self.logical_bytes = 0  # Total size of all stored files
+        self.unsynced = set()  # Chunks written since start that no committed manifest made durable yet
+        self.lock = threading.Lock()
+
+    # Rebuild the reference counts from the manifests and sweep unreferenced chunks
+    def load(self):
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        with self.lock:
+            self.refcounts.clear()
+            self.chunk_sizes.clear()
+            self.logical_bytes = 0
+            for entry in os.scandir(self.manifest_dir):
+                manifest = self.read_manifest_path(entry.path)
+                self.logical_bytes += manifest["size"]
+                for digest, size in manifest["chunks"]:
+                    self.refcounts[digest] = self.refcounts.get(digest, 0) + 1
+                    self.chunk_sizes[digest] = size
+            for fan_out in os.scandir(self.chunk_dir):
+                for entry in os.scandir(fan_out.path):
+                    if entry.name not in self.refcounts:
+                        os.remove(entry.path)  # Left behind by an interrupted upload
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunk_dir, digest[:2], digest)
+
+    def manifest_path(self, name):
+        return os.path.join(self.manifest_dir, name + ".json")
+
+    def read_manifest_path(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def has_chunk(self, digest):
+        return os.path.exists(self.chunk_path(digest))
+
+    # Store a chunk unless it is already present; returns False if data does not match
+    # digest. The chunk is fsynced only when a manifest using it is committed: chunks
+    # no manifest refers to are swept on start anyway.
+    def put_chunk(self, digest, data):
+        if chunk_hash(data) != digest:
+            return False
+        path = self.chunk_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            with self.lock:
+                self.unsynced.add(digest)
+        return True
+
+    # fsync the chunks of a manifest still only written, and their folders
+    def sync_chunks(self, chunks):
+        with self.lock:
+            pending = {digest for digest, _ in chunks if digest in self.unsynced}
+        for digest in pending:
+            with open(self.chunk_path(digest), "rb") as f:
+                os.fsync(f.fileno())
+        for folder in {digest[:2] for digest in pending}:
+            sync_directory(os.path.join(self.chunk_dir, folder))
+        with self.lock:
+            self.unsynced -= pending
+
+    # Point name at a list of [hash, size] chunks, releasing the chunks of any previous
+    # version. The chunks and the manifest are on disk before it returns.
+    def commit_manifest(self, name, size, chunks):
+        missing = [digest for digest, _ in chunks if not self.has_chunk(digest)]
+        if missing:
+            raise FileNotFoundError(f"{len(missing)} chunks are missing.")
+        self.sync_chunks(chunks)
+        old = self.read_manifest(name)
+        temp_path = self.manifest_path(name) + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"size": size, "chunks": chunks}, f)
+            sync_file(f)
+        os.replace(temp_path, self.manifest_path(name))
+        sync_directory(self.manifest_dir)
+        with self.lock:
+            self.logical_bytes += size
+            for digest, chunk_size in chunks:
+                self.refcounts[digest] = self.refcounts.get(digest, 0) + 1
+                self.chunk_sizes[digest] = chunk_size
+        if old is not None:
+            self.release(old)
+
+    def read_manifest(self, name):
+        try:
+            return self.read_manifest_path(self.manifest_path(name))
+        except FileNotFoundError:
+            return None
+
+    # Drop one reference per chunk of a manifest and delete chunks nobody uses
+    def release(self, manifest):
+        unused = []
+        with self.lock:
+            self.logical_bytes -= manifest["size"]
+            for digest, _ in manifest["chunks"]:
+                self.refcounts[digest] -= 1
+                if self.refcounts[digest] == 0:
+                    del self.refcounts[digest]
+                    del self.chunk_sizes[digest]
+                    self.unsynced.discard(digest)
+                    unused.append(digest)
+        for digest in unused:
+            if os.path.exists(self.chunk_path(digest)):
+                os.remove(self.chunk_path(digest))
+
+    # Logical bytes stored and bytes actually kept in chunks
+    def stats(self):
+        with self.lock:
+            return self.logical_bytes, sum(self.chunk_sizes.values())
+
+    def exists(self, name):
+        return os.path.exists(self.manifest_path(name))
+
+    def size(self, name):
+        return self.read_manifest(name)["size"]
+
+    # Open a stored file for reading, returning (reader, size); touch is unused here
+    def open(self, name, touch=True):
+        manifest = self.read_manifest(name)
+        if manifest is None:
+            raise FileNotFoundError(name)
+        return ManifestReader(self, manifest["chunks"]), manifest["size"]
+
+    # Start writing a file that becomes visible on commit; chunks need no size hint
+    def create(self, name, size=None):
+        return ChunkWriter(self, name)
+
+    # Chunk a complete file written elsewhere and remove the original
+    def ingest(self, staged_path, name):
+        writer = self.create(name)
+        with open(staged_path, "rb") as f:
+            while True:
+                data = f.read(1048576)
+                if not data:
+                    break
+                writer.write(data)
+        writer.commit()
+        os.remove(staged_path)
+
+    def delete(self, name):
+        manifest = self.read_manifest(name)
+        if manifest is not None:
+            os.remove(self.manifest_path(name))
+            self.release(manifest)
@@ -0,0 +1,156 @@
+import asyncio
+from collections import deque
+
+EVENT_KINDS = ("upload", "delete", "download")
+QUEUE_LIMIT = 1000  # Lines waiting for one user before the oldest are dropped
+COALESCE_WINDOW = 10.0  # Seconds over which repeated downloads of a file are reported together
+MAX_SUBSCRIPTIONS = 32  # Subscriptions one user may hold
+
+
+# Outbound event lines for one connected user. Publishing only appends to a bounded
+# queue; a task of its own sends the lines, so a slow or stalled connection never
+# holds up the request that caused the event. When the queue overflows the oldest
+# lines are dropped and the user is told how many were lost.
+class Subscriber:
+    def __init__(self, bus, username):
+        self.bus = bus
+        self.username = username
+        self.subscriptions = []  # (kinds, owner or None, prefix)
+        self.queue = deque()
+        self.dropped = 0  # Lines dropped since the user was last told
+        self.windows = {}  # Coalescing key -> events held back in its window
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    # True if a subscription asks for this event
+    def wants(self, kind, filename, owner):
+        return any(kind in kinds and owner_filter in (None, owner) and filename.startswith(prefix)
+                   for kinds, owner_filter, prefix in self.subscriptions)
+
+    def push(self, line):
+        if len(self.queue) >= self.bus.limit:
+            self.queue.popleft()
+            self.dropped += 1
+            self.bus.dropped += 1
+        self.queue.append(line)
+        self.wakeup.set()
+
+    # Send the first event of a key at once and hold back the rest for the coalescing
+    # window, then report them together. line(None) builds the text for the first event,
+    # line(count) the one for count events held back.
+    def coalesce(self, key, line):
+        if key in self.windows:
+            self.windows[key] += 1
+            return
+        self.push(line(None))
+        self.windows[key] = 0
+        asyncio.get_running_loop().call_later(self.bus.window, self.close_window, key, line)
+
+    def close_window(self, key, line):
+        count = self.windows.pop(key, 0)
+        if count and self.task is not None:
+            self.push(line(count))
+            self.windows[key] = 0  # Keep coalescing while the events continue
+            asyncio.get_running_loop().call_later(self.bus.window, self.close_window, key, line)
+
+    # Sender task: write queued lines to the user's current connection
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.queue:
+                sink = self.bus.sink(self.username)
+                try:
+                    if sink is None:
+                        raise ConnectionError("User is not connected.")
+                    if self.dropped:
+                        dropped, self.dropped = self.dropped, 0
+                        await sink.send_line(f"EVENT:dropped {dropped}")
+                    await sink.send_line(self.queue.popleft())
+                except (ConnectionError, OSError):
+                    self.queue.clear()  # The connection is going away; so is this subscriber
+
+    def close(self):
+        self.task.cancel()
+        self.task = None
+
+
+# Publishes file events to connected users: owners hear about downloads of their files
+# as NOTIFICATION lines, and SUBSCRIBE asks for EVENT lines about uploads, deletes and
+# downloads of one owner's files or of names with a prefix. Downloads are coalesced per
+# file. Only the event loop thread uses it.
+class EventBus:
+    def __init__(self, sink, window=COALESCE_WINDOW, limit=QUEUE_LIMIT):
+        self.sink = sink  # username -> object with async send_line, or None if not connected
+        self.window = window
+        self.limit = limit
+        self.subscribers = {}  # Username -> Subscriber
+        self.by_owner = {}  # Owner -> subscribers with a subscription to that owner
+        self.everyone = set()  # Subscribers with a subscription to any owner
+        self.published = 0
+        self.dropped = 0
+
+    # Subscriber of a connected user, created on first use
+    def subscriber(self, username):
+        subscriber = self.subscribers.get(username)
+        if subscriber is None:
+            subscriber = self.subscribers[username] = Subscriber(self, username)
+        return subscriber
+
+    # Add a subscription for a user; returns False if they hold too many already
+    def subscribe(self, username, kinds, owner=None, prefix=""):
+        subscriber = self.subscriber(username)
+        if len(subscriber.subscriptions) >= MAX_SUBSCRIPTIONS:
+            return False
+        subscriber.subscriptions.append((frozenset(kinds), owner, prefix))
+        if owner is None:
+            self.everyone.add(subscriber)
+        else:
+            self.by_owner.setdefault(owner, set()).add(subscriber)
+        return True
+
+    # Drop every subscription of a user
+    def unsubscribe(self, username):
+        subscriber = self.subscribers.get(username)
+        if subscriber is None:
+            return
+        for _, owner, _ in subscriber.subscriptions:
+            if owner is None:
+                self.everyone.discard(subscriber)
+            else:
+                owners = self.by_owner.get(owner, set())
+                owners.discard(subscriber)
+                if not owners:
+                    self.by_owner.pop(owner, None)
+        subscriber.subscriptions = []
+
+    # Forget a user whose connection closed
+    def detach(self, username):
+        self.unsubscribe(username)
+        subscriber = self.subscribers.pop(username, None)
+        if subscriber is not None:
+            subscriber.close()
+
+    # Announce that actor uploaded, deleted or downloaded owner's filename
+    def publish(self, kind, filename, owner, actor):
+        self.published += 1
+        if kind == "download" and owner != actor and self.sink(owner) is not None:
+            self.subscriber(owner).coalesce(("notify", filename), lambda count: (
+                f"NOTIFICATION: Your file '{filename}' was downloaded by {actor}." if count is None else
+                f"NOTIFICATION: Your file '{filename}' was downloaded {count} more time{'s' * (count > 1)} "
+                f"in the last {self.window:g} s."))
+        for subscriber in self.everyone | self.by_owner.get(owner, set()):
+            if not subscriber.wants(kind, filename, owner):
+                continue
+            if kind == "download":
+                subscriber.coalesce(("download", filename, owner), lambda count: (
+                    f"EVENT:download {filename} {owner} {count or 1}"))
+            else:
+                subscriber.push(f"EVENT:{kind} {filename} {owner}")
+
+    # Prometheus exposition lines for the bus counters
+    def render(self):
+        return ["# TYPE cfs_events_published_total counter", f"cfs_events_published_total {self.published}",
+                "# TYPE cfs_events_dropped_total counter", f"cfs_events_dropped_total {self.dropped}",
+                "# TYPE cfs_event_subscribers gauge",
+                f"cfs_event_subscribers {sum(1 for s in self.subscribers.values() if s.subscriptions)}"]
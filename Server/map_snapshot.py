@@ -0,0 +1,106 @@
+import mmap
+import os
+import struct
+
+MAGIC = b"CFSMAP1\n"  # First bytes of a binary snapshot; older snapshots are JSON lines
+FOOTER_MAGIC = b"CFSEND1\n"
+RECORD = struct.Struct("!HHHB")  # Lengths of the filename, owner, stored name and checksum
+FOOTER = struct.Struct("!QQQ8s")  # Record count, index offset, index entries, magic
+OFFSET = struct.Struct("!Q")
+BLOCK = 64  # Records per index entry; a lookup scans at most one block
+
+
+# True if path holds a binary snapshot
+def is_binary(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+# Write entries ({(filename, owner): stored name}) with their checksums as a binary
+# snapshot: length-prefixed records sorted by key, then an index holding the offset of
+# every BLOCK-th record, then a fixed-size footer locating the index
+def write_snapshot(path, entries, checksums):
+    index = []
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        offset = len(MAGIC)
+        buffer = bytearray()
+        for number, key in enumerate(sorted(entries)):
+            if number % BLOCK == 0:
+                index.append(offset + len(buffer))
+            fields = [key[0].encode(), key[1].encode(), entries[key].encode(), (checksums.get(key) or "").encode()]
+            buffer += RECORD.pack(*map(len, fields))
+            for field in fields:
+                buffer += field
+            if len(buffer) >= 1024 * 1024:
+                f.write(buffer)
+                offset += len(buffer)
+                buffer.clear()
+        f.write(buffer)
+        index_offset = offset + len(buffer)
+        f.write(b"".join(OFFSET.pack(position) for position in index))
+        f.write(FOOTER.pack(len(entries), index_offset, len(index), FOOTER_MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# Read-only view of a binary snapshot through a memory map. Opening it costs the same
+# for any size; lookups binary search the index and scan one block. Safe to share
+# between threads.
+class SnapshotReader:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < len(MAGIC) + FOOTER.size or self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a binary snapshot.")
+        self.count, self.index_offset, self.blocks, magic = FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+        if magic != FOOTER_MAGIC:
+            raise ValueError(f"{path} is truncated.")
+
+    def __len__(self):
+        return self.count
+
+    # Decode the record at offset into (key, stored name, checksum or None, next offset)
+    def record(self, offset):
+        lengths = RECORD.unpack_from(self.map, offset)
+        offset += RECORD.size
+        fields = []
+        for length in lengths:
+            fields.append(self.map[offset:offset + length].decode())
+            offset += length
+        name, owner, unique_filename, checksum = fields
+        return (name, owner), unique_filename, checksum or None, offset
+
+    def block_offset(self, block):
+        return OFFSET.unpack_from(self.map, self.index_offset + block * OFFSET.size)[0]
+
+    # (stored name, checksum or None) of a key, or None if it is not in the snapshot
+    def find(self, key):
+        low, high = 0, self.blocks
+        while low < high:  # First block whose first key is greater than key
+            middle = (low + high) // 2
+            if self.record(self.block_offset(middle))[0] <= key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return None
+        offset = self.block_offset(low - 1)
+        end = self.block_offset(low) if low < self.blocks else self.index_offset
+        while offset < end:
+            found, unique_filename, checksum, offset = self.record(offset)
+            if found == key:
+                return unique_filename, checksum
+            if found > key:
+                return None
+        return None
+
+    # Every record in key order as (key, stored name, checksum or None)
+    def records(self):
+        offset = len(MAGIC)
+        while offset < self.index_offset:
+            key, unique_filename, checksum, offset = self.record(offset)
+            yield key, unique_filename, checksum
+
+    def close(self):
+        self.map.close()
@@ -0,0 +1,445 @@
+import bisect
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+from map_snapshot import SnapshotReader, is_binary, write_snapshot
+from server_log import LogPipeline
+
+COMPACT_EVERY = 100000  # Journal records written before the journal is folded into a snapshot
+SHARDS = 1  # Independently locked slices of the map; more only add lock overhead under the GIL
+
+
+# Lock that adds up how long its users waited to acquire it
+class TimedLock:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wait_seconds = 0.0  # Only updated while the lock is held
+
+    def acquire(self, blocking=True, timeout=-1):
+        started = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        if acquired:
+            self.wait_seconds += time.perf_counter() - started
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# Slice of the map holding the files of the owners hashed to it, with their sorted
+# indexes, behind a lock of its own. Until the binary snapshot has been merged in
+# (base is set), entries and the indexes only hold what changed since the snapshot,
+# deleted the snapshot keys removed since, and lookups of other keys go to the snapshot.
+class MetadataShard:
+    def __init__(self):
+        self.lock = TimedLock()
+        self.entries = {}
+        self.checksums = {}  # Key -> checksum of the stored contents, when known
+        self.by_name = []  # Sorted (filename, owner) keys
+        self.by_owner = {}  # Owner -> sorted filenames
+        self.base = None  # SnapshotReader still to be merged in
+        self.deleted = set()
+
+    # Replace the contents and rebuild the indexes; caller holds self.lock
+    def reset(self, entries, checksums):
+        self.entries = entries
+        self.checksums = checksums
+        self.by_name = sorted(entries)
+        self.by_owner = {}
+        for filename, owner in self.by_name:
+            self.by_owner.setdefault(owner, []).append(filename)
+
+    # (stored name, checksum or None) of a key, or None; caller holds self.lock
+    def lookup(self, key):
+        if key in self.entries:
+            return self.entries[key], self.checksums.get(key)
+        if self.base is None or key in self.deleted:
+            return None
+        return self.base.find(key)
+
+    # Take the snapshot's share of this shard, keeping every change made since; caller
+    # holds self.lock
+    def merge(self, entries, checksums):
+        for key in self.deleted:
+            entries.pop(key, None)
+            checksums.pop(key, None)
+        for key, unique_filename in self.entries.items():
+            entries[key] = unique_filename
+            checksums.pop(key, None)
+            if key in self.checksums:
+                checksums[key] = self.checksums[key]
+        self.reset(entries, checksums)  # The snapshot's keys come sorted, so sorting is cheap
+        self.base = None
+        self.deleted = set()
+
+    # Add a key to the indexes unless present; caller holds self.lock
+    def add(self, key):
+        if key in self.entries:
+            return False
+        bisect.insort(self.by_name, key)
+        bisect.insort(self.by_owner.setdefault(key[1], []), key[0])
+        return True
+
+    # Remove a key from the entries and indexes; caller holds self.lock
+    def remove(self, key):
+        unique_filename = self.entries.pop(key, None)
+        self.checksums.pop(key, None)
+        if unique_filename is not None:
+            del self.by_name[bisect.bisect_left(self.by_name, key)]
+            names = self.by_owner[key[1]]
+            del names[bisect.bisect_left(names, key[0])]
+            if not names:
+                del self.by_owner[key[1]]
+        return unique_filename
+
+
+# Mapping of (filename, owner) to the stored file name and its checksum, persisted as a
+# snapshot plus an append-only journal. The map is split into shards by owner, so requests
+# for different users lock different shards, and the journal queue has a lock of its own.
+# Changes are visible immediately and made durable by a background writer that appends
+# and fsyncs whole batches (group commit); no lock is held during disk I/O.
+# The snapshot is binary (see map_snapshot) and memory-mapped on load, so lookups work
+# as soon as the journal is replayed; a background thread then reads it into the shards.
+# Listings and whole-map reads wait for that to finish.
+class MetadataStore:
+    def __init__(self, base_path, compact_every=COMPACT_EVERY, shards=SHARDS, log=None):
+        self.log = log if log is not None else LogPipeline()
+        self.snapshot_path = base_path + '.snapshot'
+        self.journal_path = base_path + '.journal'
+        self.legacy_path = base_path + '.txt'  # Old pipe-separated format, imported once
+        self.compact_every = compact_every
+        self.shards = [MetadataShard() for _ in range(shards)]
+        self.versions = itertools.count(1)  # next() is atomic, so no lock is needed
+        self.version = 0  # Changes whenever the set of listed files changes
+        self.journal_lock = threading.Lock()  # Taken after a shard lock, never before
+        self.wakeup = threading.Condition(self.journal_lock)
+        self.pending = []  # (journal line, future) waiting for the writer
+        self.journal = None  # Unbuffered, so a failed write can be cut back exactly
+        self.journal_records = 0
+        self.failed = None  # Error that left the journal in an unknown state; no more changes are written
+        self.last_future = None  # Most recent record; futures complete in order
+        self.writer = None
+        self.loaded = threading.Event()  # Set once the whole snapshot is in the shards
+        self.upgrade = False  # Whether the snapshot is in an older format and is to be rewritten
+
+    # Shard holding the files of an owner; crc32 keeps the choice stable across processes
+    def shard(self, owner):
+        return self.shards[zlib.crc32(owner.encode()) % len(self.shards)]
+
+    # Map the snapshot, replay the journal over it and start the background writer and,
+    # for a binary snapshot, the thread reading it into the shards. Snapshots in the
+    # older JSON-lines and pipe-separated formats are read in full and then rewritten.
+    def load(self):
+        entries = {}
+        checksums = {}
+        deleted = set()  # Snapshot keys the journal removes
+        base = None
+        self.loaded.clear()
+        if os.path.exists(self.snapshot_path) and is_binary(self.snapshot_path):
+            base = SnapshotReader(self.snapshot_path)
+        elif os.path.exists(self.snapshot_path):
+            self.replay(self.snapshot_path, entries, checksums)
+            self.upgrade = True
+        elif os.path.exists(self.legacy_path):
+            with open(self.legacy_path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        filename, owner, unique_filename = line.strip().split('|')
+                        entries[(filename, owner)] = unique_filename
+            self.upgrade = True
+        else:
+            self.upgrade = True  # Start with an empty snapshot
+        self.journal_records = 0
+        if os.path.exists(self.journal_path):
+            self.journal_records, intact = self.replay(self.journal_path, entries, checksums, deleted)
+            if intact < os.path.getsize(self.journal_path):
+                # Cut off a torn final record, or new records would be appended to it
+                # and lost with it on the next load
+                os.truncate(self.journal_path, intact)
+        split = [({}, {}, set()) for _ in self.shards]
+        for key, unique_filename in entries.items():
+            shard_entries, shard_checksums, _ = split[self.shards.index(self.shard(key[1]))]
+            shard_entries[key] = unique_filename
+            if key in checksums:
+                shard_checksums[key] = checksums[key]
+        for key in deleted:
+            split[self.shards.index(self.shard(key[1]))][2].add(key)
+        for shard, (shard_entries, shard_checksums, shard_deleted) in zip(self.shards, split):
+            with shard.lock:
+                shard.reset(shard_entries, shard_checksums)
+                shard.base = base
+                shard.deleted = shard_deleted if base is not None else set()
+        self.version = next(self.versions)
+        self.journal = open(self.journal_path, 'ab', buffering=0)
+        if base is None:
+            self.loaded.set()
+        else:
+            threading.Thread(target=self.hydrate, args=(base,), daemon=True).start()
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.writer_loop, daemon=True)
+            self.writer.start()
+        if self.upgrade:
+            with self.journal_lock:
+                self.wakeup.notify()
+
+    # Read a binary snapshot into the shards, one shard at a time, then unmap it
+    def hydrate(self, base):
+        split = [({}, {}) for _ in self.shards]
+        shard_numbers = {}  # Owner -> shard position, so each owner is hashed once
+        for key, unique_filename, checksum in base.records():
+            number = shard_numbers.get(key[1])
+            if number is None:
+                number = shard_numbers[key[1]] = self.shards.index(self.shard(key[1]))
+            shard_entries, shard_checksums = split[number]
+            shard_entries[key] = unique_filename
+            if checksum:
+                shard_checksums[key] = checksum
+        for shard, (shard_entries, shard_checksums) in zip(self.shards, split):
+            with shard.lock:
+                shard.merge(shard_entries, shard_checksums)
+        self.version = next(self.versions)
+        self.loaded.set()
+        base.close()
+
+    # Wait until the whole map is in memory
+    def wait_loaded(self):
+        self.loaded.wait()
+
+    # Apply every record of a JSON-lines file to entries and checksums, returning how
+    # many were read and the size of the intact part of the file; deleted, if given,
+    # collects the keys removed
+    def replay(self, path, entries, checksums, deleted=None):
+        count = 0
+        intact = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError("Unterminated record.")
+                    record = json.loads(line)
+                except ValueError:
+                    break  # Torn final write from a crash; everything before it is intact
+                key = (record['name'], record['owner'])
+                checksums.pop(key, None)
+                if record['op'] == 'put':
+                    entries[key] = record['file']
+                    if record.get('checksum'):
+                        checksums[key] = record['checksum']
+                    if deleted is not None:
+                        deleted.discard(key)
+                else:
+                    entries.pop(key, None)
+                    if deleted is not None:
+                        deleted.add(key)
+                count += 1
+                intact += len(line)
+        return count, intact
+
+    def __len__(self):
+        self.loaded.wait()
+        return sum(len(shard.entries) for shard in self.shards)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    # Look up the stored file name for (filename, owner)
+    def get(self, key, default=None):
+        shard = self.shard(key[1])
+        with shard.lock:
+            found = shard.lookup(key)
+        return default if found is None else found[0]
+
+    # Checksum recorded for (filename, owner), or None
+    def checksum(self, key):
+        shard = self.shard(key[1])
+        with shard.lock:
+            found = shard.lookup(key)
+        return None if found is None else found[1]
+
+    # Snapshot of all entries as a list of ((filename, owner), unique_filename)
+    def items(self):
+        self.loaded.wait()
+        items = []
+        for shard in self.shards:
+            with shard.lock:
+                items.extend(shard.entries.items())
+        return items
+
+    # Snapshot of all entries with their checksums as
+    # ((filename, owner), unique_filename, checksum or None)
+    def items_with_checksums(self):
+        self.loaded.wait()
+        items = []
+        for shard in self.shards:
+            with shard.lock:
+                items.extend((key, unique_filename, shard.checksums.get(key))
+                             for key, unique_filename in shard.entries.items())
+        return items
+
+    # Total time spent waiting for shard locks
+    def lock_wait_seconds(self):
+        return sum(shard.lock.wait_seconds for shard in self.shards)
+
+    # Page through keys in name order, optionally restricted to a prefix and an owner.
+    # Returns (keys, more) where more tells whether entries follow the last key.
+    def list_keys(self, prefix='', owner=None, after=None, limit=None):
+        self.loaded.wait()
+        if owner is not None:
+            shard = self.shard(owner)
+            with shard.lock:
+                names = shard.by_owner.get(owner, [])
+                start = bisect.bisect_left(names, prefix)
+                if after is not None:
+                    start = max(start, bisect.bisect_right(names, after[0]))
+                end = None if limit is None else start + limit + 1
+                keys = [(name, owner) for name in names[start:end]]
+        else:
+            # Take the first limit + 1 candidates of every shard, then merge them in order
+            slices = []
+            for shard in self.shards:
+                with shard.lock:
+                    start = bisect.bisect_left(shard.by_name, (prefix,))
+                    if after is not None:
+                        start = max(start, bisect.bisect_right(shard.by_name, after))
+                    end = None if limit is None else start + limit + 1
+                    slices.append(shard.by_name[start:end])
+            keys = heapq.merge(*slices)
+        page = []  # Filter the copied slices outside the locks
+        for key in keys:
+            if not key[0].startswith(prefix):
+                break
+            if limit is not None and len(page) == limit:
+                return page, True
+            page.append(key)
+        return page, False
+
+    # Set an entry; the returned future completes once the change is on disk
+    def put(self, key, unique_filename, checksum=None):
+        record = {'op': 'put', 'name': key[0], 'owner': key[1], 'file': unique_filename}
+        if checksum:
+            record['checksum'] = checksum
+        shard = self.shard(key[1])
+        with shard.lock:
+            if shard.add(key):
+                self.version = next(self.versions)
+            shard.entries[key] = unique_filename
+            shard.deleted.discard(key)
+            if checksum:
+                shard.checksums[key] = checksum
+            else:
+                shard.checksums.pop(key, None)
+            # Queued under the shard lock so the journal order of a key matches the map
+            return self.append(record)
+
+    # Remove an entry, returning (old value, durability future) or (None, None) if absent
+    def pop(self, key):
+        shard = self.shard(key[1])
+        with shard.lock:
+            found = shard.lookup(key)
+            if found is None:
+                return None, None
+            shard.remove(key)
+            if shard.base is not None:
+                shard.deleted.add(key)  # Hide the snapshot's copy too
+            unique_filename = found[0]
+            self.version = next(self.versions)
+            return unique_filename, self.append({'op': 'del', 'name': key[0], 'owner': key[1]})
+
+    # Queue a journal record for the writer
+    def append(self, record):
+        line = json.dumps(record) + '\n'
+        future = Future()
+        with self.journal_lock:
+            self.last_future = future
+            self.pending.append((line, future))
+            self.wakeup.notify()
+        return future
+
+    # Background writer: append and fsync everything queued since the last batch, and
+    # fold the journal into the snapshot when it has grown or the snapshot is outdated
+    def writer_loop(self):
+        while True:
+            with self.journal_lock:
+                while not self.pending and not self.upgrade:
+                    self.wakeup.wait()
+                batch, self.pending = self.pending, []
+            if batch:
+                try:
+                    self.write_journal(''.join(line for line, _ in batch).encode())
+                except OSError as e:
+                    for _, future in batch:
+                        future.set_exception(e)
+                    continue
+                for _, future in batch:
+                    future.set_result(None)
+                self.journal_records += len(batch)
+            # Never while a snapshot is still being read in; that would hold up the journal
+            if (self.upgrade or self.journal_records >= self.compact_every) and self.loaded.is_set():
+                self.upgrade = False
+                try:
+                    self.compact()
+                except OSError as e:
+                    # The journal still holds every change; try again after another round
+                    self.log.error("Metadata compaction failed: %s", e)
+                    self.journal_records = 0
+
+    # Append data to the journal and fsync it. If that fails the journal is cut back to
+    # its previous end, so no torn record is left for later ones to be appended after;
+    # if even that fails every later change is refused.
+    def write_journal(self, data):
+        if self.failed is not None:
+            raise self.failed
+        fd = self.journal.fileno()
+        end = os.fstat(fd).st_size
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            os.fsync(fd)
+        except OSError as e:
+            try:
+                os.ftruncate(fd, end)
+                os.lseek(fd, end, os.SEEK_SET)
+                os.fsync(fd)
+            except OSError:
+                self.failed = e
+            self.log.error("Metadata journal write failed: %s", e)
+            raise
+
+    # Fold the journal into a fresh snapshot and start an empty journal
+    def compact(self):
+        items = self.items_with_checksums()
+        entries = {key: unique_filename for key, unique_filename, _ in items}
+        checksums = {key: checksum for key, _, checksum in items if checksum}
+        # Records still queued are already part of this snapshot; replaying them
+        # again from the new journal sets the same values, so nothing is lost.
+        self.write_snapshot(entries, checksums)
+        journal = open(self.journal_path, 'wb', buffering=0)
+        self.journal.close()
+        self.journal = journal
+        self.journal_records = 0
+
+    # Atomically replace the snapshot file with the given entries and checksums
+    def write_snapshot(self, entries, checksums):
+        temp_path = self.snapshot_path + '.tmp'
+        write_snapshot(temp_path, entries, checksums)
+        os.replace(temp_path, self.snapshot_path)
+
+    # Wait for every change made so far to reach disk
+    def flush(self):
+        with self.journal_lock:
+            future = self.last_future
+        if future is not None:
+            future.result()
@@ -0,0 +1,338 @@
+import json
+import mmap
+import os
+import threading
+import time
+
+from read_cache import MemoryReader
+from storage import FileStorage, FileWriter
+
+PACK_FOLDER = ".packs"  # Pack files and their index, inside the upload folder
+INDEX_FILE = "index"  # JSON lines: {"name", "pack", "offset", "size"}, or {"name", "deleted": true}
+PACK_SIZE = 256 * 1024 * 1024  # A pack takes no new files once it has grown this large
+PACK_FILE_LIMIT = 1024 * 1024  # Only loose files up to this size are packed
+PACK_AFTER = 24 * 3600  # Seconds since a loose file was last written or read before it is packed
+PACK_INTERVAL = 600  # Seconds between two compaction passes
+PACK_BATCH = 64 * 1024 * 1024  # Bytes appended to a pack between two fsyncs
+REPACK_RATIO = 0.5  # Full packs with at least this share of deleted bytes are repacked
+
+
+# Writer for a loose file of tiered storage: committing it also retires a packed copy
+class TieredWriter(FileWriter):
+    def __init__(self, storage, name, size=None):
+        super().__init__(storage.path(name), storage.staging_dir, size)
+        self.storage = storage
+        self.name = name
+
+    def commit(self):
+        with self.storage.lock:
+            super().commit()
+            self.storage.unpack(self.name)
+
+
+# Storage with a hot and a cold tier. New uploads are loose files as in FileStorage; the
+# compactor later appends small files that have gone cold to large append-only pack
+# files and drops the loose copies, so millions of small uploads do not mean millions
+# of inodes. The index of packed files is an append-only JSON-lines journal, rewritten
+# on every start; packed files are read through a memory map of their pack. Deleting or
+# replacing a packed file writes a tombstone, and packs that are mostly tombstones are
+# repacked. A loose file always wins over a packed copy of the same name.
+class TieredStorage(FileStorage):
+    def __init__(self, folder):
+        super().__init__(folder)
+        self.pack_dir = os.path.join(folder, PACK_FOLDER)
+        self.index_path = os.path.join(self.pack_dir, INDEX_FILE)
+        self.lock = threading.Lock()  # Guards the index, the pack totals and loose-file commits
+        self.index = {}  # Name -> (pack number, offset, size) of packed files
+        self.packs = {}  # Pack number -> [bytes in the pack, bytes of live files]
+        self.maps = {}  # Pack number -> memory map of the pack, as long as it was when mapped
+        self.touched = {}  # Name -> time it was last opened, so files being read stay loose
+        self.index_file = None
+        self.current = 0  # Pack new files are appended to
+
+    def pack_path(self, number):
+        return os.path.join(self.pack_dir, f"{number:06d}.pack")
+
+    # Replay the index, drop entries that a loose file overrides, remove packs nothing
+    # lives in any more and rewrite the index with only the live entries
+    def load(self):
+        super().load()
+        os.makedirs(self.pack_dir, exist_ok=True)
+        index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # Torn last record of a crash
+                    if record.get("deleted"):
+                        index.pop(record["name"], None)
+                    else:
+                        index[record["name"]] = (record["pack"], record["offset"], record["size"])
+        # A loose copy is a newer upload, or a packing interrupted before the loose file went
+        index = {name: entry for name, entry in index.items() if not os.path.exists(self.path(name))}
+        packs = {}
+        for entry in os.scandir(self.pack_dir):
+            if entry.name.endswith(".pack"):
+                packs[int(entry.name[:-len(".pack")])] = [entry.stat().st_size, 0]
+        for name, (number, offset, size) in list(index.items()):
+            if number not in packs or offset + size > packs[number][0]:
+                del index[name]  # Its pack is gone or short; nothing to read it from
+                continue
+            packs[number][1] += size
+        for number, (total, live) in list(packs.items()):
+            if not live:
+                os.remove(self.pack_path(number))
+                del packs[number]
+        self.index, self.packs, self.maps = index, packs, {}
+        self.current = max(packs, default=0)
+        if not packs or packs[self.current][0] >= PACK_SIZE:
+            self.current += 1
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for name, entry in index.items():
+                f.write(self.record(name, entry))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.index_path)
+        if self.index_file is not None:
+            self.index_file.close()
+        self.index_file = open(self.index_path, "a", encoding="utf-8")
+
+    def record(self, name, entry=None):
+        if entry is None:
+            return json.dumps({"name": name, "deleted": True}) + "\n"
+        number, offset, size = entry
+        return json.dumps({"name": name, "pack": number, "offset": offset, "size": size}) + "\n"
+
+    def exists(self, name):
+        return name in self.index or super().exists(name)
+
+    def size(self, name):
+        entry = self.index.get(name)
+        return entry[2] if entry is not None else super().size(name)
+
+    # Open a loose file, or else a packed one as a zero-copy view of its pack. A touched
+    # file counts as read and stays loose for another pack_after seconds.
+    def open(self, name, touch=True):
+        if touch:
+            self.touched[name] = time.time()
+        try:
+            return super().open(name)
+        except FileNotFoundError:
+            with self.lock:
+                entry = self.index.get(name)
+                if entry is None:
+                    raise
+                return MemoryReader(self.view(entry)), entry[2]
+
+    # View of a packed file's bytes; the caller holds self.lock. A pack is mapped again
+    # when it has grown past its mapping; readers of the old map keep it alive.
+    def view(self, entry):
+        number, offset, size = entry
+        if not size:
+            return memoryview(b"")  # Empty files need no map, and an empty pack cannot be mapped
+        mapped = self.maps.get(number)
+        if mapped is None or len(mapped) < offset + size:
+            with open(self.pack_path(number), "rb") as f:
+                mapped = self.maps[number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mapped)[offset:offset + size]
+
+    def create(self, name, size=None):
+        return TieredWriter(self, name, size)
+
+    def ingest(self, staged_path, name):
+        with self.lock:
+            super().ingest(staged_path, name)
+            self.unpack(name)
+
+    def delete(self, name):
+        with self.lock:
+            super().delete(name)
+            self.unpack(name)
+        self.touched.pop(name, None)
+
+    # Tombstone the packed copy of a name that was replaced or deleted; caller holds self.lock
+    def unpack(self, name):
+        entry = self.index.pop(name, None)
+        if entry is None:
+            return
+        self.index_file.write(self.record(name))
+        self.index_file.flush()
+        self.packs[entry[0]][1] -= entry[2]
+
+    # Make index records written so far durable
+    def sync_index(self):
+        with self.lock:
+            self.index_file.flush()
+        os.fsync(self.index_file.fileno())
+
+    # Loose files small enough to pack that were not written or read for cold_after
+    # seconds, as (name, stat)
+    def cold_files(self, cold_after):
+        cutoff = time.time() - cold_after
+        for entry in os.scandir(self.folder):
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            stat = entry.stat()
+            if stat.st_size <= PACK_FILE_LIMIT and max(stat.st_mtime, self.touched.get(entry.name, 0)) < cutoff:
+                yield entry.name, stat
+
+    # Append (name, bytes) pairs to the current pack and fsync it, returning
+    # (name, new entry) pairs; starts a new pack once the current one is full
+    def append(self, files):
+        with self.lock:
+            if self.packs.get(self.current, [0])[0] >= PACK_SIZE:
+                self.current += 1
+            number = self.current
+            self.packs.setdefault(number, [0, 0])
+        placed = []
+        with open(self.pack_path(number), "ab") as out:
+            for name, data in files:
+                placed.append((name, (number, out.tell(), len(data))))
+                out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+            with self.lock:
+                self.packs[number][0] = out.tell()
+        return placed
+
+    # Move a batch of cold loose files, given as (name, stat), into the current pack.
+    # A file replaced since it was listed is left alone. The loose copies are removed
+    # only after the index records reached disk. Returns (files, bytes) packed.
+    def pack(self, candidates):
+        files, stamps = [], {}
+        for name, stat in candidates:
+            try:
+                with open(self.path(name), "rb") as f:
+                    data = f.read()
+                    now = os.fstat(f.fileno())
+            except FileNotFoundError:
+                continue  # Deleted since it was listed
+            if (now.st_ino, now.st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns):
+                files.append((name, data))
+                stamps[name] = (stat.st_ino, stat.st_mtime_ns)
+        placed = self.append(files)
+        packed = []
+        with self.lock:
+            for name, entry in placed:
+                if self.loose_stamp(name) == stamps[name] and name not in self.index:
+                    self.index[name] = entry
+                    self.index_file.write(self.record(name, entry))
+                    self.packs[entry[0]][1] += entry[2]
+                    packed.append((name, entry))
+        self.sync_index()
+        with self.lock:
+            for name, entry in packed:
+                # Still the same file on both sides: no upload replaced it in the meantime
+                if self.index.get(name) == entry and self.loose_stamp(name) == stamps[name]:
+                    os.remove(self.path(name))
+                    self.touched.pop(name, None)
+        return len(packed), sum(entry[2] for _, entry in packed)
+
+    # (inode, mtime) of a loose file, or None if there is none
+    def loose_stamp(self, name):
+        try:
+            stat = os.stat(self.path(name))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    # Full packs whose share of deleted bytes reached REPACK_RATIO
+    def sparse_packs(self):
+        with self.lock:
+            return [number for number, (total, live) in self.packs.items()
+                    if number != self.current and total and live <= total * (1 - REPACK_RATIO)]
+
+    # Copy the live files of a pack into the current pack and remove it. Returns the
+    # number of bytes copied.
+    def repack(self, number):
+        with self.lock:
+            entries = [(name, entry) for name, entry in self.index.items() if entry[0] == number]
+            files = [(name, self.view(entry)) for name, entry in entries]  # Written straight from the map
+        placed = self.append(files)
+        old = dict(entries)
+        with self.lock:
+            for name, entry in placed:
+                if self.index.get(name) == old[name]:  # Not deleted or replaced meanwhile
+                    self.index[name] = entry
+                    self.index_file.write(self.record(name, entry))
+                    self.packs[entry[0]][1] += entry[2]
+                    self.packs[number][1] -= entry[2]
+        self.sync_index()
+        with self.lock:
+            if not self.packs[number][1]:
+                del self.packs[number]
+                self.maps.pop(number, None)  # Closed once the last reader lets go of it
+                os.remove(self.pack_path(number))
+        return sum(entry[2] for _, entry in placed)
+
+    # (packed files, packs, bytes in packs, bytes of live packed files)
+    def pack_stats(self):
+        with self.lock:
+            return (len(self.index), len(self.packs), sum(total for total, _ in self.packs.values()),
+                    sum(live for _, live in self.packs.values()))
+
+
+# Background migration of cold files into packs. A pass runs on its own thread: it packs
+# cold loose files in batches of PACK_BATCH bytes, then repacks sparse packs.
+class Compactor:
+    def __init__(self, storage, log, pack_after=PACK_AFTER):
+        self.storage = storage
+        self.log = log
+        self.pack_after = pack_after
+        self.thread = None
+        self.passes = 0
+        self.packed_files = 0
+        self.packed_bytes = 0
+        self.repacked_bytes = 0
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # Start a pass in the background; returns False if one is already running
+    def start(self):
+        if self.running():
+            return False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return True
+
+    def run(self):
+        try:
+            files = packed = 0
+            batch, size = [], 0
+            for name, stat in self.storage.cold_files(self.pack_after):
+                batch.append((name, stat))
+                size += stat.st_size
+                if size >= PACK_BATCH:
+                    count, moved = self.storage.pack(batch)
+                    files, packed = files + count, packed + moved
+                    batch, size = [], 0
+            if batch:
+                count, moved = self.storage.pack(batch)
+                files, packed = files + count, packed + moved
+            repacked = sum(self.storage.repack(number) for number in self.storage.sparse_packs())
+        except OSError as e:
+            self.log.error("Compaction failed: %s", e)
+            return
+        self.passes += 1
+        self.packed_files += files
+        self.packed_bytes += packed
+        self.repacked_bytes += repacked
+        if packed or repacked:
+            self.log.info("Compaction packed %d files (%d bytes) and repacked %d bytes.", files, packed, repacked)
+
+    # Prometheus exposition lines for the packs and the compaction passes
+    def render(self):
+        files, packs, total, live = self.storage.pack_stats()
+        return ["# TYPE cfs_packed_files gauge", f"cfs_packed_files {files}",
+                "# TYPE cfs_pack_files gauge", f"cfs_pack_files {packs}",
+                "# TYPE cfs_pack_bytes gauge", f"cfs_pack_bytes {total}",
+                "# TYPE cfs_pack_live_bytes gauge", f"cfs_pack_live_bytes {live}",
+                "# TYPE cfs_compaction_passes_total counter", f"cfs_compaction_passes_total {self.passes}",
+                "# TYPE cfs_compaction_packed_bytes_total counter",
+                f"cfs_compaction_packed_bytes_total {self.packed_bytes}",
+                "# TYPE cfs_compaction_repacked_bytes_total counter",
+                f"cfs_compaction_repacked_bytes_total {self.repacked_bytes}"]
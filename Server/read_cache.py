@@ -0,0 +1,214 @@
+import io
+import os
+from collections import OrderedDict
+
+CACHE_BYTES = 128 * 1024 * 1024  # Memory budget for cached file contents
+CACHE_FILES = 256  # Larger hot files kept open, at most this many descriptors
+MEMORY_FILE_LIMIT = 1024 * 1024  # Files up to this size are cached in memory
+HOT_AFTER = 2  # Requests for a file before it is cached
+RECENT_MISSES = 4096  # Uncached names whose requests are counted toward HOT_AFTER
+
+
+# Reads a file cached in memory; every download gets its own position and
+# zero-copy slices of the shared contents
+class MemoryReader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.position = 0
+
+    def read(self, size=-1):
+        end = len(self.data) if size < 0 else self.position + size
+        chunk = self.data[self.position:end]
+        self.position += len(chunk)
+        return chunk
+
+    def seek(self, offset):
+        self.position = offset
+        return offset
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Reads a cached open file with pread, so downloads sharing the descriptor do not
+# move each other's position; fileno() lets sendfile use it directly
+class SharedFileReader:
+    def __init__(self, entry):
+        self.entry = entry
+        self.fd = entry.fd
+        self.position = 0
+        entry.readers += 1
+
+    def fileno(self):
+        return self.fd
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.entry.size
+        self.position = offset
+        return offset
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.entry.size - self.position
+        data = os.pread(self.fd, size, self.position)
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self.entry is not None:
+            self.entry.release()
+            self.entry = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# One cached file: its contents in memory, or an open descriptor that is closed once it
+# has left the cache and no download is still reading it
+class CacheEntry:
+    def __init__(self, size, data=None, fd=None, stamp=None):
+        self.size = size
+        self.data = data
+        self.fd = fd
+        self.stamp = stamp  # Identity of the stored file when it was cached, if validated
+        self.readers = 0
+        self.retired = False
+
+    def reader(self):
+        return MemoryReader(self.data) if self.data is not None else SharedFileReader(self)
+
+    def release(self):
+        self.readers -= 1
+        if self.retired and not self.readers:
+            os.close(self.fd)
+
+    def retire(self):
+        self.retired = True
+        if self.fd is not None and not self.readers:
+            os.close(self.fd)
+
+
+# LRU cache of hot downloads in front of a storage backend. A file is cached on its
+# second request: small files (after decompression or chunk assembly) are kept in memory
+# within a byte budget, larger plain files keep an open descriptor, so hits skip the
+# exists/stat/open path entirely. The server invalidates a name whenever it is
+# re-uploaded or deleted. Only the event loop thread uses it.
+# When other processes change the same files (validate=True), a hit first stats the
+# stored file and is only used if its inode and mtime are the ones that were cached;
+# every upload replaces the file, so that catches changes made anywhere.
+class ReadCache:
+    def __init__(self, storage, max_bytes=CACHE_BYTES, max_files=CACHE_FILES, validate=False):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.validate = validate
+        self.entries = OrderedDict()  # Name -> CacheEntry, least recently used first
+        self.requests = OrderedDict()  # Recently requested uncached names -> request count
+        self.memory_bytes = 0
+        self.open_files = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def exists(self, name):
+        return (name in self.entries and not self.validate) or self.storage.exists(name)
+
+    # Identity of a stored file for validating hits; raises FileNotFoundError if it is gone
+    def stamp(self, name):
+        stat = os.stat(self.storage.path(name))
+        return stat.st_ino, stat.st_mtime_ns
+
+    # Open a stored file for reading, returning (file, size) like the storage backend
+    def open(self, name):
+        entry = self.entries.get(name)
+        # Stamped before opening, so a file replaced in between is only reloaded early
+        stamp = self.stamp(name) if self.validate else None
+        if entry is not None and entry.stamp != stamp:
+            self.invalidate(name)
+            entry = None
+        if entry is not None:
+            self.entries.move_to_end(name)
+            self.hits += 1
+            return entry.reader(), entry.size
+        self.misses += 1
+        f, size = self.storage.open(name)
+        count = self.requests.pop(name, 0) + 1
+        if count < HOT_AFTER:
+            self.requests[name] = count
+            if len(self.requests) > RECENT_MISSES:
+                self.requests.popitem(last=False)
+            return f, size
+        reader = self.admit(name, f, size, stamp)
+        return (f, size) if reader is None else (reader, size)
+
+    # Cache a file just opened from storage and return a reader for it, or None if it
+    # does not fit the cache (f is then left untouched)
+    def admit(self, name, f, size, stamp=None):
+        if size <= MEMORY_FILE_LIMIT and size <= self.max_bytes:
+            with f:
+                data = f.read()
+            if len(data) != size:
+                return MemoryReader(data)  # Changed while being read; serve it uncached
+            entry = CacheEntry(size, data=data, stamp=stamp)
+            self.memory_bytes += size
+        elif isinstance(f, io.BufferedReader) and self.max_files:
+            with f:
+                entry = CacheEntry(size, fd=os.dup(f.fileno()), stamp=stamp)
+            self.open_files += 1
+        else:
+            return None
+        self.entries[name] = entry
+        reader = entry.reader()
+        self.evict()
+        return reader
+
+    # Drop least recently used files until the cache is within its limits
+    def evict(self):
+        while self.memory_bytes > self.max_bytes or self.open_files > self.max_files:
+            _, entry = self.entries.popitem(last=False)
+            self.drop(entry)
+            self.evictions += 1
+
+    def drop(self, entry):
+        if entry.data is not None:
+            self.memory_bytes -= entry.size
+        else:
+            self.open_files -= 1
+        entry.retire()
+
+    # Forget a file that is being replaced or was deleted; downloads already reading it
+    # finish with the contents they started with
+    def invalidate(self, name):
+        self.requests.pop(name, None)
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.drop(entry)
+            self.invalidations += 1
+
+    # Prometheus exposition lines for the cache counters
+    def render(self):
+        return ["# TYPE cfs_read_cache_hits_total counter", f"cfs_read_cache_hits_total {self.hits}",
+                "# TYPE cfs_read_cache_misses_total counter", f"cfs_read_cache_misses_total {self.misses}",
+                "# TYPE cfs_read_cache_evictions_total counter", f"cfs_read_cache_evictions_total {self.evictions}",
+                "# TYPE cfs_read_cache_invalidations_total counter",
+                f"cfs_read_cache_invalidations_total {self.invalidations}",
+                "# TYPE cfs_read_cache_bytes gauge", f"cfs_read_cache_bytes {self.memory_bytes}",
+                "# TYPE cfs_read_cache_open_files gauge", f"cfs_read_cache_open_files {self.open_files}"]
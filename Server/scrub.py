@@ -0,0 +1,97 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from integrity import StreamChecksum
+
+SCRUB_RATE = 20 * 1024 * 1024  # Bytes per second a scrub may read
+SCRUB_BLOCK = 1024 * 1024  # Bytes read and hashed at a time
+
+
+# Background verification of every stored file against the checksum recorded when it
+# was uploaded. A pass runs on its own thread and sleeps as needed to stay under its
+# read rate, so client transfers keep the disk. Damaged and missing files are logged
+# as errors and counted for STATS.
+class Scrubber:
+    def __init__(self, metadata, storage, log, rate=SCRUB_RATE):
+        self.metadata = metadata
+        self.storage = storage
+        self.log = log
+        self.rate = rate
+        self.thread = None
+        self.passes = 0  # Completed passes
+        self.reset()
+
+    # Clear the counters of the current pass
+    def reset(self):
+        self.checked = 0
+        self.corrupt = 0
+        self.missing = 0
+        self.unchecked = 0  # Files stored before checksums were recorded
+        self.bytes_read = 0
+        self.began = time.perf_counter()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # Start a pass in the background; returns False if one is already running
+    def start(self):
+        if self.running():
+            return False
+        self.reset()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return True
+
+    def run(self):
+        self.log.info("Scrub started.")
+        for key, unique_filename, checksum in self.metadata.items_with_checksums():
+            if checksum is None:
+                self.unchecked += 1
+                continue
+            try:
+                f, _ = self.storage.open(unique_filename, touch=False)  # Not a use; the file may still go cold
+                with f:
+                    actual = self.checksum(f)
+            except FileNotFoundError:
+                if self.metadata.get(key) == unique_filename:  # Not just deleted
+                    self.missing += 1
+                    self.log.error("Scrub: %s of %s is missing from storage.", key[0], key[1])
+                continue
+            # A file replaced while it was being read is checked again on the next pass
+            if actual != checksum and self.metadata.checksum(key) == checksum:
+                self.corrupt += 1
+                self.log.error("Scrub: %s of %s does not match its checksum.", key[0], key[1])
+            self.checked += 1
+        self.passes += 1
+        self.log.info("Scrub finished: %d files checked, %d corrupt, %d missing, %d without checksum.",
+                      self.checked, self.corrupt, self.missing, self.unchecked)
+
+    # Checksum the rest of f, sleeping whenever the pass gets ahead of its rate
+    def checksum(self, f):
+        checksum = StreamChecksum()
+        while True:
+            data = f.read(SCRUB_BLOCK)
+            if not data:
+                return checksum.value()
+            checksum.update(data)
+            self.bytes_read += len(data)
+            ahead = self.bytes_read / self.rate - (time.perf_counter() - self.began)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    # One-line progress report for VERIFY
+    def status(self):
+        return (f"{'running' if self.running() else 'idle'} checked={self.checked} corrupt={self.corrupt} "
+                f"missing={self.missing} unchecked={self.unchecked} bytes={self.bytes_read}")
+
+    # Prometheus exposition lines for the current or last pass
+    def render(self):
+        return ["# TYPE cfs_scrub_running gauge", f"cfs_scrub_running {int(self.running())}",
+                "# TYPE cfs_scrub_passes_total counter", f"cfs_scrub_passes_total {self.passes}",
+                "# TYPE cfs_scrub_checked_files gauge", f"cfs_scrub_checked_files {self.checked}",
+                "# TYPE cfs_scrub_corrupt_files gauge", f"cfs_scrub_corrupt_files {self.corrupt}",
+                "# TYPE cfs_scrub_missing_files gauge", f"cfs_scrub_missing_files {self.missing}",
+                "# TYPE cfs_scrub_read_bytes gauge", f"cfs_scrub_read_bytes {self.bytes_read}"]
@@ -0,0 +1,1357 @@
+import argparse
+import asyncio
+import io
+import multiprocessing
+import multiprocessing.connection
+import os
+import secrets
+import signal
+import socket
+import sys
+import threading
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from framing import RecvBuffer
+from integrity import CHECKSUM, ChecksumWriter
+from bandwidth import QUANTUM, BandwidthScheduler
+from chunk_store import ChunkStore
+from chunking import DEDUP, MAX_CHUNK
+from compression import BLOCK_SIZE, CODECS, FRAME_HEADER, decode_payload, encode_frame, END_FRAME
+from events import EVENT_KINDS, EventBus
+from metadata import SHARDS, MetadataStore
+from multiplex import (CONTROL_STREAM, DATA, END, INITIAL_WINDOW, MAX_FRAME, MUX_HEADER, WINDOW,
+                       WINDOW_INCREMENT, pack_frame)
+from pack_store import PACK_AFTER, PACK_INTERVAL, Compactor, TieredStorage
+from read_cache import CACHE_BYTES, CACHE_FILES, ReadCache
+from scrub import SCRUB_RATE, Scrubber
+from server_log import DEBUG, ERROR, INFO, WARNING, LogPipeline
+from server_metrics import MAX_PROFILE_SECONDS, Metrics
+from storage import CompressedFileStorage, FileStorage
+from upload_sessions import EXPIRY_INTERVAL, MAX_SESSION_SIZE, SESSION_EXPIRY, SessionManager
+from worker_pool import SharedState, WorkerContext, reserve_port, start_services
+
+CHUNK_SIZE = 65536  # Size of file chunks in DATA framing
+LIST_CACHE_SIZE = 1024  # Encoded LIST responses kept until the map changes
+LIST_CACHE_BYTES = 16 * 1024 * 1024  # Memory budget for cached LIST responses
+LIST_CACHE_ENTRY_LIMIT = 1024 * 1024  # Larger LIST responses are rebuilt every time
+# Commands with their own metrics; anything else is counted as OTHER
+COMMANDS = ("UPLOAD", "LIST", "DOWNLOAD", "FETCH", "DELETE", "SESSION_CREATE", "SESSION_PUT", "SESSION_STATUS",
+            "SESSION_COMMIT", "SESSION_ABORT", "HAVE", "CHUNK_PUT", "UPLOAD_MANIFEST", "STATS", "VERIFY",
+            "SUBSCRIBE", "UNSUBSCRIBE", "BANDWIDTH")
+
+
+# Class to handle non-blocking socket operations on the event loop. It also counts the
+# bytes moved and the time spent waiting on the network and on disk, for the metrics.
+class AsyncSocketBuffer:
+    def __init__(self, sock, loop):
+        self.sock = sock
+        self.loop = loop
+        self.lock = asyncio.Lock()  # Keeps concurrent writers from interleaving
+        self.buffer = RecvBuffer()
+        self.codecs = []  # Compression codecs negotiated at login
+        self.checksums = False  # Whether the client asked for checksums in replies at login
+        self.sending = None  # Transfer pacing what the current request sends, if any
+        self.receiving = None  # Transfer pacing what the current request receives, if any
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.network_seconds = 0.0
+        self.disk_seconds = 0.0
+
+    # Send data on the socket; the caller holds self.lock
+    async def sendall(self, data):
+        if self.sending is not None:
+            await self.sending.acquire(len(data))
+        started = time.perf_counter()
+        await self.loop.sock_sendall(self.sock, data)
+        self.network_seconds += time.perf_counter() - started
+        self.bytes_out += len(data)
+
+    # Read up to size bytes from a file, counting the time as disk time
+    def read_file(self, f, size):
+        started = time.perf_counter()
+        data = f.read(size)
+        self.disk_seconds += time.perf_counter() - started
+        return data
+
+    # Write data to a file, counting the time as disk time
+    def write_file(self, f, data):
+        started = time.perf_counter()
+        f.write(data)
+        self.disk_seconds += time.perf_counter() - started
+
+    # Send a line of text data (ending with '\n')
+    async def send_line(self, line):
+        async with self.lock:
+            await self.sendall((line + '\n').encode())
+
+    # Send raw data
+    async def send_data(self, data):
+        async with self.lock:
+            await self.sendall(data)
+
+    # Send a header line followed by count bytes of a file from offset, through the
+    # kernel's sendfile when the body is a real file (its disk reads are then counted as
+    # network time)
+    async def send_file(self, line, f, count, offset=0):
+        async with self.lock:
+            await self.sendall((line + '\n').encode())
+            if not count:
+                return
+            if hasattr(f, 'fileno'):
+                await self.sendfile(f, offset, count)
+                return
+            skip_to(f, offset)
+            while count > 0:
+                chunk = self.read_file(f, min(CHUNK_SIZE, count))
+                if not chunk:
+                    raise ConnectionError("Stored file ended early.")
+                await self.sendall(chunk)
+                count -= len(chunk)
+
+    # Send count bytes of a real file from offset with sendfile; the caller holds self.lock.
+    # A paced transfer sends it in pieces, each granted by the bandwidth scheduler.
+    async def sendfile(self, f, offset, count):
+        end = offset + count
+        while offset < end:
+            length = end - offset
+            if self.sending is not None:
+                if self.sending.limited():
+                    length = min(QUANTUM, length)
+                await self.sending.acquire(length)
+            started = time.perf_counter()
+            await self.loop.sock_sendfile(self.sock, f, offset, length)
+            self.network_seconds += time.perf_counter() - started
+            offset += length
+        self.bytes_out += count
+
+    # Receive more data from the socket into the buffer
+    async def fill(self):
+        started = time.perf_counter()
+        received = await self.loop.sock_recv_into(self.sock, self.buffer.writable())
+        self.network_seconds += time.perf_counter() - started
+        if not received:
+            raise ConnectionError("Client connection lost.")
+        self.bytes_in += received
+        self.buffer.commit(received)
+        if self.receiving is not None:
+            await self.receiving.acquire(received)  # Not reading on holds the client back
+
+    # Receive a single line of text data
+    async def recv_line(self):
+        while True:
+            line = self.buffer.take_line()
+            if line is not None:
+                return line.strip()
+            await self.fill()
+
+    # Receive exactly num_bytes as bytes
+    async def recv_exact(self, num_bytes):
+        while len(self.buffer) < num_bytes:
+            await self.fill()
+        return self.buffer.take(num_bytes)
+
+    # Receive exactly num_bytes straight into a file
+    async def recv_to_file(self, f, num_bytes):
+        remaining = num_bytes
+        while remaining > 0:
+            if not self.buffer:
+                await self.fill()
+            view = self.buffer.peek(remaining)
+            self.write_file(f, view)
+            self.buffer.consume(len(view))
+            remaining -= len(view)
+
+    # Receive and drop num_bytes, keeping the stream in sync after a rejected request
+    async def discard(self, num_bytes):
+        while num_bytes > 0:
+            if not self.buffer:
+                await self.fill()
+            skipped = len(self.buffer.peek(num_bytes))
+            self.buffer.consume(skipped)
+            num_bytes -= skipped
+
+
+# One stream of a multiplexed connection. It behaves like AsyncSocketBuffer, so the
+# normal command loop runs on it; its bytes travel as DATA frames on the shared socket.
+class StreamBuffer(AsyncSocketBuffer):
+    def __init__(self, connection, stream_id):
+        super().__init__(connection.sock_buf.sock, connection.loop)
+        self.connection = connection
+        self.stream_id = stream_id
+        self.codecs = connection.sock_buf.codecs
+        self.checksums = connection.sock_buf.checksums
+        self.incoming = deque()  # Payloads received but not yet moved into the buffer
+        self.readable = asyncio.Event()
+        self.closed = False
+        self.receive_window = INITIAL_WINDOW  # Bytes the client may still send
+        self.consumed = 0  # Bytes taken since the last WINDOW update
+        # The control stream carries only notifications, so it is not flow controlled
+        self.send_window = INITIAL_WINDOW if stream_id != CONTROL_STREAM else float("inf")
+        self.window_open = asyncio.Event()
+
+    # Queue a DATA payload from the connection reader
+    def deliver(self, payload):
+        self.receive_window -= len(payload)
+        if self.receive_window < 0:
+            raise ValueError("Client exceeded the stream window.")
+        self.incoming.append(payload)
+        self.readable.set()
+
+    # Add credit from a WINDOW frame
+    def grant(self, increment):
+        self.send_window += increment
+        self.window_open.set()
+
+    # The stream ended; wake up anything waiting on it
+    def close(self):
+        self.closed = True
+        self.readable.set()
+        self.window_open.set()
+
+    async def fill(self):
+        started = time.perf_counter()
+        while not self.incoming:
+            if self.closed:
+                raise ConnectionError("Stream closed.")
+            self.readable.clear()
+            await self.readable.wait()
+        self.network_seconds += time.perf_counter() - started
+        payload = self.incoming.popleft()
+        if self.receiving is not None:
+            await self.receiving.acquire(len(payload))
+        self.buffer.feed(payload)
+        self.bytes_in += len(payload)
+        self.consumed += len(payload)
+        if self.consumed >= INITIAL_WINDOW // 2:
+            # Let the client send as much again as has been taken
+            self.receive_window += self.consumed
+            await self.connection.send_frame(self.stream_id, WINDOW, WINDOW_INCREMENT.pack(self.consumed))
+            self.consumed = 0
+
+    # Wait until the client allows sending on this stream; returns how many bytes may go
+    async def wait_writable(self, wanted):
+        while self.send_window <= 0:
+            if self.closed:
+                raise ConnectionError("Stream closed.")
+            self.window_open.clear()
+            await self.window_open.wait()
+        if self.closed:
+            raise ConnectionError("Stream closed.")
+        return int(min(wanted, self.send_window, MAX_FRAME))
+
+    async def sendall(self, data):
+        started = time.perf_counter()
+        view = memoryview(data)
+        while view:
+            count = await self.wait_writable(len(view))
+            if self.sending is not None:
+                await self.sending.acquire(count)
+            await self.connection.send_frame(self.stream_id, DATA, view[:count])
+            self.send_window -= count
+            view = view[count:]
+        self.network_seconds += time.perf_counter() - started
+        self.bytes_out += len(data)
+
+    async def sendfile(self, f, offset, count):
+        started = time.perf_counter()
+        end = offset + count
+        while offset < end:
+            length = await self.wait_writable(end - offset)
+            if self.sending is not None:
+                await self.sending.acquire(length)
+            await self.connection.send_file_frame(self.stream_id, f, offset, length)
+            self.send_window -= length
+            offset += length
+        self.network_seconds += time.perf_counter() - started
+        self.bytes_out += count
+
+
+# Shared socket of a multiplexed connection and its open streams
+class MultiplexedConnection:
+    def __init__(self, sock_buf):
+        self.sock_buf = sock_buf
+        self.loop = sock_buf.loop
+        self.streams = {}  # Stream id -> StreamBuffer
+        self.last_stream_id = CONTROL_STREAM  # Client stream ids only increase
+        self.control = StreamBuffer(self, CONTROL_STREAM)
+
+    # Send one whole frame; frames of different streams never interleave mid-frame
+    async def send_frame(self, stream_id, kind, payload=b''):
+        async with self.sock_buf.lock:
+            await self.sock_buf.sendall(pack_frame(stream_id, kind, payload))
+
+    # Send a DATA frame whose payload comes straight from a file with sendfile
+    async def send_file_frame(self, stream_id, f, offset, length):
+        async with self.sock_buf.lock:
+            await self.sock_buf.sendall(MUX_HEADER.pack(stream_id, DATA, length))
+            await self.sock_buf.sendfile(f, offset, length)
+
+
+# Move a reader that was just opened to offset; readers that cannot seek are read forward
+def skip_to(f, offset):
+    if hasattr(f, 'seek'):
+        f.seek(offset)
+        return
+    while offset > 0:
+        data = f.read(min(BLOCK_SIZE, offset))
+        if not data:
+            break
+        offset -= len(data)
+
+
+# Resolve the optional [offset] [length] arguments of a download against the file size,
+# returning (offset, length) or None if they do not describe a range of the file
+def byte_range(args, filesize):
+    if not all(arg.isdigit() for arg in args):
+        return None
+    offset = int(args[0]) if args else 0
+    if offset > filesize:
+        return None
+    length = int(args[1]) if len(args) > 1 else filesize
+    return offset, min(length, filesize - offset)
+
+
+# Split command arguments into positional ones and trailing key=value options
+def split_options(parts):
+    options = {}
+    while len(parts) > 1 and "=" in parts[-1]:
+        key, _, value = parts.pop().partition("=")
+        options[key] = value
+    return parts, options
+
+
+# Backend holding file contents: loose files (optionally compressed), deduplicated chunks,
+# or loose files whose cold ones are moved into packs
+def open_storage(upload_folder, storage='files', compress_at_rest=False):
+    if storage == 'chunks':
+        return ChunkStore(upload_folder)
+    if storage == 'tiered':
+        return TieredStorage(upload_folder)
+    if compress_at_rest:
+        return CompressedFileStorage(upload_folder)
+    return FileStorage(upload_folder)
+
+
+# Headless file server running every connection on a single event loop. As one of
+# several worker processes (worker is a WorkerContext) it shares the port with the
+# others and keeps the file-owner map and the connected users in the shared state.
+class FileServer:
+    def __init__(self, port, upload_folder, host='0.0.0.0', backlog=socket.SOMAXCONN,
+                 metadata_path='file_owner_map', storage='files', compress_at_rest=False, log=None,
+                 metrics_port=None, allow_profiling=False, metadata_shards=SHARDS,
+                 read_cache_bytes=CACHE_BYTES, scrub_rate=SCRUB_RATE, scrub_interval=None, worker=None,
+                 bandwidth_limits=None, allow_bandwidth_control=False, pack_after=PACK_AFTER,
+                 max_session_size=MAX_SESSION_SIZE, session_expiry=SESSION_EXPIRY):
+        self.port = port
+        self.host = host
+        self.backlog = backlog
+        self.metrics_port = metrics_port  # Local port for the Prometheus text endpoint, if any
+        self.allow_profiling = allow_profiling  # Whether clients may request a cProfile report
+        self.metrics = Metrics(COMMANDS)
+        self.upload_folder = upload_folder  # Directory for uploaded files
+        self.log = log if log is not None else LogPipeline()  # Structured, batched server log
+        self.connected_clients = {}  # Active clients dictionary
+        self.worker = worker  # Shared state when running as one of several worker processes
+        self.events = EventBus(self.connected_clients.get)  # Notifications and SUBSCRIBE events
+        # Mapping files to owners
+        if worker is not None:
+            self.file_owner_map = worker.metadata
+        else:
+            self.file_owner_map = MetadataStore(metadata_path, shards=metadata_shards, log=self.log)
+        self.storage = open_storage(upload_folder, storage, compress_at_rest)
+        # Hot downloads served without touching the filesystem; a zero budget disables it
+        # Hits are checked against the stored file when other workers may have replaced it
+        self.read_cache = ReadCache(self.storage, read_cache_bytes, CACHE_FILES if read_cache_bytes else 0,
+                                    validate=worker is not None)
+        self.scrubber = Scrubber(self.file_owner_map, self.storage, self.log, scrub_rate)  # Background VERIFY
+        self.scrub_interval = scrub_interval  # Seconds between automatic scrubs, if any
+        # Moves cold files of tiered storage into packs in the background
+        self.compactor = Compactor(self.storage, self.log, pack_after) if isinstance(self.storage, TieredStorage) else None
+        # Paces uploads and downloads; each worker of a pool takes its share of the server limits
+        self.bandwidth = BandwidthScheduler(bandwidth_limits, share=1 / worker.workers if worker else 1)
+        self.allow_bandwidth_control = allow_bandwidth_control  # Whether clients may change the limits
+        self.list_cache = {}  # LIST arguments -> encoded response
+        self.list_cache_version = None  # Map version the cached responses belong to
+        self.list_cache_bytes = 0
+        self.metadata_loaded = False  # Whether the map has been read in full since startup
+        # Resumable uploads in progress
+        self.upload_sessions = SessionManager(upload_folder, max_session_size, session_expiry)
+        self.ready = threading.Event()  # Set once the server is listening
+        self.loop = None
+        self.listener = None
+        self.scrub_task = None  # Timer starting periodic scrubs
+        self.compact_task = None  # Timer starting compaction passes
+        self.expiry_task = None  # Timer discarding abandoned upload sessions
+
+    # Handle communication with a connected client
+    async def handle_client(self, client_socket, client_address):
+        sock_buf = AsyncSocketBuffer(client_socket, self.loop)
+        username = None
+        self.metrics.connections_total += 1
+        self.metrics.connections_open += 1
+        try:
+            username = await sock_buf.recv_line()  # Receive the username
+            if not username:
+                return
+            if username.startswith("ATTACH "):
+                # Extra connection carrying ranges for an upload session
+                username = await self.serve_attached(sock_buf, username[len("ATTACH "):].strip())
+                return
+            # "READER <username>" opens an extra download-only connection for that user
+            reader = username.startswith("READER ")
+            if reader:
+                username = username[len("READER "):]
+            # Clients may append " CAPS=<codec>,..." to offer compression codecs, the
+            # checksum algorithm to get file checksums in upload and download replies, and
+            # "dedup" to learn whether chunks can be uploaded
+            username, has_caps, caps = username.partition(" CAPS=")
+            dedup = False
+            if has_caps:
+                sock_buf.codecs = [codec for codec in caps.split(",") if codec in CODECS]
+                sock_buf.checksums = CHECKSUM in caps.split(",")
+                dedup = DEDUP in caps.split(",") and isinstance(self.storage, ChunkStore)
+            accepted = sock_buf.codecs + [CHECKSUM] * sock_buf.checksums + [DEDUP] * dedup
+            if reader:
+                await sock_buf.send_line(f"OK CAPS={','.join(accepted)}" if has_caps else "OK")
+                await self.serve_reader(sock_buf, username)
+                return
+            if not await self.claim_username(username):
+                await sock_buf.send_line("ERROR Username already in use.")  # Username conflict
+                username = None
+                return
+
+            self.connected_clients[username] = sock_buf  # Add client to active clients
+            self.log.info("%s connected from %s", username, client_address)
+
+            # Send confirmation to client, listing the accepted capabilities if it offered any
+            await sock_buf.send_line(f"OK CAPS={','.join(accepted)}" if has_caps else "OK")
+
+            if await self.serve_commands(sock_buf, username):
+                self.log.info("%s disconnected.", username)
+
+        except ConnectionError:
+            pass
+        finally:
+            # Remove client from connected clients list
+            if username is not None and self.connected_clients.get(username) is sock_buf:
+                del self.connected_clients[username]
+                self.events.detach(username)
+                if self.worker is not None:
+                    await self.shared(self.worker.registry.release, username, self.worker.worker_id)
+            self.metrics.connections_open -= 1
+            client_socket.close()
+            self.log.info("Connection closed with %s.", username)
+
+    # Check that a username is free, here and on every other worker, and take it there
+    async def claim_username(self, username):
+        if username in self.connected_clients:
+            return False
+        return self.worker is None or await self.shared(self.worker.registry.claim, username, self.worker.worker_id)
+
+    # Run commands from a connection or multiplexed stream until it ends; returns True
+    # if the client ended it with EXIT
+    async def serve_commands(self, sock_buf, username):
+        while True:
+            try:
+                data = await sock_buf.recv_line()  # Receive command from client
+                if not data:
+                    return False
+
+                command = data.split(maxsplit=1)[0]
+                if data == "EXIT":
+                    return True
+                if data == "MUX" and not isinstance(sock_buf, StreamBuffer):
+                    # Switch this connection to multiplexed frames
+                    await sock_buf.send_line("OK MUX")
+                    return await self.serve_multiplexed(sock_buf, username)
+                started = self.metrics.start(sock_buf)
+                try:
+                    if command == "UPLOAD":
+                        await self.handle_upload(sock_buf, username, data)
+                    elif command == "LIST":
+                        await self.handle_list(sock_buf, username, data)
+                    elif command == "DOWNLOAD":
+                        await self.handle_download(sock_buf, username, data)
+                    elif command == "FETCH":
+                        await self.handle_fetch(sock_buf, username, data)
+                    elif command == "DELETE":
+                        await self.handle_delete(sock_buf, username, data)
+                    elif command.startswith("SESSION_"):
+                        await self.handle_session(sock_buf, username, data)
+                    elif command in ("HAVE", "CHUNK_PUT", "UPLOAD_MANIFEST") and isinstance(self.storage, ChunkStore):
+                        await self.handle_dedup(sock_buf, username, data)
+                    elif command == "STATS":
+                        await self.handle_stats(sock_buf, username, data)
+                    elif command == "VERIFY":
+                        await self.handle_verify(sock_buf, username, data)
+                    elif command in ("SUBSCRIBE", "UNSUBSCRIBE"):
+                        await self.handle_subscribe(sock_buf, username, data)
+                    elif command == "BANDWIDTH":
+                        await self.handle_bandwidth(sock_buf, username, data)
+                    else:
+                        # Handle unknown commands
+                        await sock_buf.send_line("ERROR Unknown command.")
+                        self.log.warning("%s sent an unknown command: %s", username, data)
+                finally:
+                    self.metrics.finish(command, sock_buf, started)
+
+            except Exception as e:
+                self.log.error("Error: %s", e)
+                return False
+
+    # Read frames from a multiplexed connection and run each stream's commands as its own
+    # task, so slow transfers do not hold up other requests. Returns True when the client
+    # closes the control stream.
+    async def serve_multiplexed(self, sock_buf, username):
+        connection = MultiplexedConnection(sock_buf)
+        self.connected_clients[username] = connection.control  # Notifications now go out as frames
+        tasks = set()
+        try:
+            while True:
+                stream_id, kind, length = MUX_HEADER.unpack(await sock_buf.recv_exact(MUX_HEADER.size))
+                if length > MAX_FRAME:
+                    raise ValueError("Frame too large.")
+                payload = await sock_buf.recv_exact(length)
+                if stream_id == CONTROL_STREAM:
+                    if kind == END:
+                        return True
+                    continue
+                stream = connection.streams.get(stream_id)
+                if kind == DATA:
+                    if stream is None:
+                        if stream_id <= connection.last_stream_id:
+                            continue  # Late data for a stream that already ended
+                        connection.last_stream_id = stream_id
+                        stream = connection.streams[stream_id] = StreamBuffer(connection, stream_id)
+                        task = self.loop.create_task(self.serve_stream(stream, username))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                    if payload:
+                        stream.deliver(payload)
+                elif kind == WINDOW and stream is not None:
+                    stream.grant(WINDOW_INCREMENT.unpack(payload)[0])
+                elif kind == END and stream is not None:
+                    stream.close()
+        finally:
+            for stream in list(connection.streams.values()):
+                stream.close()
+            if self.connected_clients.get(username) is connection.control:
+                self.connected_clients[username] = sock_buf  # Removed by handle_client as usual
+
+    # Serve one stream of a multiplexed connection, then tell the client it has ended
+    async def serve_stream(self, stream, username):
+        try:
+            await self.serve_commands(stream, username)
+        finally:
+            del stream.connection.streams[stream.stream_id]
+            stream.close()
+            try:
+                await stream.connection.send_frame(stream.stream_id, END)
+            except OSError:
+                pass  # The connection itself is gone
+
+    # Handle file upload: UPLOAD <filename> <size> [codec=<name>]
+    async def handle_upload(self, sock_buf, username, data):
+        parts, options = split_options(data.split())
+        if len(parts) != 3:
+            await sock_buf.send_line("ERROR Invalid UPLOAD command.")
+            return
+        _, filename, filesize = parts
+        if not filesize.isdecimal():
+            await sock_buf.send_line("ERROR Invalid file size.")  # Negative or not a number
+            return
+        filesize = int(filesize)
+        codec = options.get("codec")
+        unique_filename = f"{username}_{filename}"
+        self.log.debug("Receiving %s from %s...", filename, username)
+        # Save the file into staging; the stored version stays readable until the commit
+        writer = self.storage.create(unique_filename, filesize)
+        hashed = ChecksumWriter(writer)  # Checksums the data on its way to disk
+        try:
+            with self.bandwidth.transfer(sock_buf, username, "ingress", filesize):
+                if codec is None:
+                    await sock_buf.recv_to_file(hashed, filesize)
+                    received = filesize
+                else:
+                    received = await self.recv_frames(sock_buf, codec, hashed)
+        except ConnectionError as e:
+            self.log.warning("Connection lost while uploading %s. Error: %s", filename, e)
+            writer.abort()
+            raise
+        if codec is not None and codec not in CODECS:
+            writer.abort()
+            await sock_buf.send_line(f"ERROR Unsupported compression codec {codec}.")
+            return
+        if received != filesize:
+            writer.abort()
+            await sock_buf.send_line(f"ERROR {filename} could not be uploaded. Received {received} of {filesize} bytes.")
+            return
+        checksum = hashed.checksum.value()
+        if options.get("checksum", checksum) != checksum:
+            writer.abort()
+            await sock_buf.send_line(f"ERROR {filename} was damaged in transit; its checksum does not match.")
+            self.log.warning("Checksum mismatch uploading %s from %s.", filename, username)
+            return
+        await self.loop.run_in_executor(None, writer.commit)  # fsyncs, so off the event loop
+        self.read_cache.invalidate(unique_filename)
+        # Update file-owner map and wait for the journal to reach disk
+        committed = await self.shared(self.file_owner_map.put, (filename, username), unique_filename, checksum)
+        await self.wait_committed(committed)
+        self.log.info("%s uploaded by %s.", filename, username)
+        await self.publish("upload", filename, username, username)
+        await sock_buf.send_line(self.uploaded_reply(sock_buf, filename, checksum))
+
+    # Success reply to an upload, ending with the stored checksum for clients that asked
+    def uploaded_reply(self, sock_buf, filename, checksum):
+        reply = f"RESPONSE:{filename} uploaded successfully."
+        return f"{reply} checksum={checksum}" if sock_buf.checksums and checksum else reply
+
+    # Call a method of the file-owner map or user registry. With several workers every
+    # call is a round trip to the shared state process, so it runs on a thread instead
+    # of blocking the event loop.
+    async def shared(self, method, *args):
+        if self.worker is None:
+            return method(*args)
+        return await self.loop.run_in_executor(None, method, *args)
+
+    # Wait for a metadata change to reach disk, recording how long that took
+    async def wait_committed(self, future):
+        started = time.perf_counter()
+        await asyncio.wrap_future(future)
+        self.metrics.metadata_commit.observe(time.perf_counter() - started)
+
+    # Receive a compressed body frame by frame into writer, returning the uncompressed size.
+    # Frames of an unknown codec are still read to keep the stream in sync, but dropped.
+    async def recv_frames(self, sock_buf, codec, writer):
+        received = 0
+        while True:
+            kind, length = FRAME_HEADER.unpack(await sock_buf.recv_exact(FRAME_HEADER.size))
+            if length == 0:
+                return received
+            if length > BLOCK_SIZE:
+                raise ValueError("Frame too large.")
+            payload = await sock_buf.recv_exact(length)
+            if codec in CODECS:
+                # Decompression releases the GIL, so it runs on the thread pool
+                block = await self.loop.run_in_executor(None, decode_payload, codec, kind, payload)
+                sock_buf.write_file(writer, block)
+                received += len(block)
+
+    # Handle the resumable upload session commands
+    async def handle_session(self, sock_buf, username, data):
+        parts = data.split()
+        command = parts[0]
+        if command == "SESSION_CREATE" and len(parts) == 3:
+            _, filename, filesize = parts
+            filesize = int(filesize)
+            if filesize < 0:
+                await sock_buf.send_line("ERROR Invalid file size.")
+                return
+            if filesize > self.upload_sessions.max_size:
+                await sock_buf.send_line(f"ERROR Upload sessions are limited to {self.upload_sessions.max_size} bytes.")
+                return
+            session = self.upload_sessions.create(username, filename, filesize)
+            await sock_buf.send_line(f"RESPONSE:{session.session_id}")
+            self.log.info("Upload session for %s (%d bytes) opened by %s.", filename, filesize, username)
+            return
+        if command == "SESSION_PUT" and len(parts) == 4:
+            await self.handle_session_put(sock_buf, username, parts)
+            return
+        if command not in ("SESSION_STATUS", "SESSION_COMMIT", "SESSION_ABORT") or len(parts) != 2:
+            await sock_buf.send_line("ERROR Invalid session command.")
+            return
+        session = self.upload_sessions.get(parts[1])
+        if session is None or session.owner != username:
+            await sock_buf.send_line("ERROR Unknown upload session.")
+            return
+
+        session.refresh()  # Ranges may have arrived through other worker processes
+        if command == "SESSION_STATUS":
+            ranges = ",".join(f"{start}-{end}" for start, end in session.ranges) or "-"
+            await sock_buf.send_line(f"RESPONSE:{session.size} {ranges}")
+        elif command == "SESSION_ABORT":
+            session.discard()
+            self.upload_sessions.remove(session)
+            await sock_buf.send_line("RESPONSE:Upload session aborted.")
+            self.log.info("%s aborted the upload of %s.", username, session.filename)
+        elif not session.is_complete():
+            await sock_buf.send_line("ERROR Upload session is incomplete.")
+        else:
+            # Move the finished file into place and commit it like a normal upload
+            filename = session.filename
+            unique_filename = f"{username}_{filename}"
+            session.close()
+            checksum = await self.loop.run_in_executor(None, session.checksum)
+            await self.loop.run_in_executor(None, self.storage.ingest, session.part_path, unique_filename)
+            self.read_cache.invalidate(unique_filename)
+            committed = await self.shared(self.file_owner_map.put, (filename, username), unique_filename, checksum)
+            await self.wait_committed(committed)
+            session.discard()
+            self.upload_sessions.remove(session)
+            self.log.info("%s uploaded by %s.", filename, username)
+            await self.publish("upload", filename, username, username)
+            await sock_buf.send_line(self.uploaded_reply(sock_buf, filename, checksum))
+
+    # Receive one byte range of an upload session: SESSION_PUT <id> <offset> <length>
+    async def handle_session_put(self, sock_buf, username, parts):
+        _, session_id, offset, length = parts
+        offset, length = int(offset), int(length)
+        if length < 0:
+            raise ValueError("Invalid range length.")
+        session = self.upload_sessions.get(session_id)
+        if session is None or session.owner != username or offset < 0 or offset + length > session.size:
+            await sock_buf.discard(length)
+            await sock_buf.send_line("ERROR Invalid upload range.")
+            return
+        with self.bandwidth.transfer(sock_buf, username, "ingress", length):
+            await sock_buf.recv_to_file(session.writer(offset), length)
+        try:
+            await self.loop.run_in_executor(None, session.commit_range, offset, length)
+        except FileNotFoundError:
+            self.upload_sessions.get(session_id)  # Drops the closed session
+            await sock_buf.send_line("ERROR Unknown upload session.")
+            return
+        await sock_buf.send_line(f"RESPONSE:OK {session.committed_bytes()}")
+
+    # Serve an attached connection that only sends ranges for one upload session
+    async def serve_attached(self, sock_buf, session_id):
+        session = self.upload_sessions.get(session_id)
+        if session is None:
+            await sock_buf.send_line("ERROR Unknown upload session.")
+            return None
+        await sock_buf.send_line("OK")
+        while True:
+            try:
+                data = await sock_buf.recv_line()
+                if data.split(maxsplit=1)[0] == "SESSION_PUT":
+                    started = self.metrics.start(sock_buf)
+                    try:
+                        await self.handle_session(sock_buf, session.owner, data)
+                    finally:
+                        self.metrics.finish("SESSION_PUT", sock_buf, started)
+                elif data == "EXIT":
+                    break
+                else:
+                    await sock_buf.send_line("ERROR Unknown command.")
+            except Exception as e:
+                self.log.error("Error: %s", e)
+                break
+        return session.owner
+
+    # Serve a READER connection: it only downloads and does not take the username, so a
+    # client can fetch ranges of one file over several TCP connections at once
+    async def serve_reader(self, sock_buf, username):
+        while True:
+            try:
+                data = await sock_buf.recv_line()
+                command = data.split(maxsplit=1)[0] if data else "EXIT"
+                if command in ("FETCH", "DOWNLOAD"):
+                    started = self.metrics.start(sock_buf)
+                    try:
+                        if command == "FETCH":
+                            await self.handle_fetch(sock_buf, username, data)
+                        else:
+                            await self.handle_download(sock_buf, username, data)
+                    finally:
+                        self.metrics.finish(command, sock_buf, started)
+                elif command == "EXIT":
+                    break
+                else:
+                    await sock_buf.send_line("ERROR Unknown command.")
+            except Exception as e:
+                self.log.error("Error: %s", e)
+                break
+
+    # Handle deduplicated uploads: HAVE <hash>..., CHUNK_PUT <hash> <size>,
+    # UPLOAD_MANIFEST <filename> <size> <count> [checksum=<checksum>] followed by
+    # <hash> <size> lines. Chunks are verified by their hashes; the whole-file checksum
+    # comes from the client and is checked by the scrubber.
+    async def handle_dedup(self, sock_buf, username, data):
+        parts, options = split_options(data.split())
+        command = parts[0]
+        if command == "HAVE":
+            # One '1' or '0' per hash, telling the client which chunks it can skip
+            await sock_buf.send_line("RESPONSE:" + "".join("1" if self.storage.has_chunk(digest) else "0"
+                                                           for digest in parts[1:]))
+        elif command == "CHUNK_PUT" and len(parts) == 3:
+            digest, size = parts[1], int(parts[2])
+            if not 0 <= size <= MAX_CHUNK:
+                raise ValueError("Invalid chunk size.")
+            chunk = io.BytesIO()
+            with self.bandwidth.transfer(sock_buf, username, "ingress", size):
+                await sock_buf.recv_to_file(chunk, size)
+            stored = await self.loop.run_in_executor(None, self.storage.put_chunk, digest, chunk.getvalue())
+            if stored:
+                await sock_buf.send_line("RESPONSE:OK")
+            else:
+                await sock_buf.send_line("ERROR Chunk does not match its hash.")
+        elif command == "UPLOAD_MANIFEST" and len(parts) == 4:
+            _, filename, filesize, count = parts
+            chunks = []
+            for _ in range(int(count)):
+                digest, size = (await sock_buf.recv_line()).split()
+                chunks.append([digest, int(size)])
+            if sum(size for _, size in chunks) != int(filesize):
+                await sock_buf.send_line("ERROR Manifest does not match the file size.")
+                return
+            unique_filename = f"{username}_{filename}"
+            try:
+                # Makes the chunks and the manifest durable, so off the event loop
+                await self.loop.run_in_executor(None, self.storage.commit_manifest, unique_filename, int(filesize), chunks)
+            except FileNotFoundError as e:
+                await sock_buf.send_line(f"ERROR {e} Upload {filename} again.")
+                return
+            self.read_cache.invalidate(unique_filename)
+            checksum = options.get("checksum")
+            committed = await self.shared(self.file_owner_map.put, (filename, username), unique_filename, checksum)
+            await self.wait_committed(committed)
+            self.log.info("%s uploaded by %s (%d chunks).", filename, username, len(chunks))
+            await self.publish("upload", filename, username, username)
+            await sock_buf.send_line(self.uploaded_reply(sock_buf, filename, checksum))
+        else:
+            await sock_buf.send_line(f"ERROR Invalid {command} command.")
+
+    # List files: LIST [prefix] [owner] [cursor] [limit], with '-' for an unset argument
+    async def handle_list(self, sock_buf, username, data):
+        parts = data.split()
+        if parts[0] != "LIST" or len(parts) > 5:
+            await sock_buf.send_line("ERROR Invalid LIST command.")
+            return
+        if not self.metadata_loaded:
+            # Listings need the whole map; wait off the loop while it is still being read in
+            await self.loop.run_in_executor(None, self.file_owner_map.wait_loaded)
+            self.metadata_loaded = True
+        version = await self.shared(lambda: self.file_owner_map.version)
+        if (version != self.list_cache_version or len(self.list_cache) >= LIST_CACHE_SIZE
+                or self.list_cache_bytes > LIST_CACHE_BYTES - LIST_CACHE_ENTRY_LIMIT):
+            self.list_cache.clear()
+            self.list_cache_version = version
+            self.list_cache_bytes = 0
+        key = tuple(parts[1:])
+        payload = self.list_cache.get(key)
+        if payload is None:
+            try:
+                payload = await self.shared(self.encode_listing, parts[1:])
+            except ValueError:
+                await sock_buf.send_line("ERROR Invalid LIST command.")
+                return
+            if len(payload) <= LIST_CACHE_ENTRY_LIMIT:
+                self.list_cache[key] = payload
+                self.list_cache_bytes += len(payload)
+        await sock_buf.send_data(payload)  # Whole listing in one write
+        self.log.debug("Sent file list to %s.", username)
+
+    # Build the encoded response for a LIST command's arguments
+    def encode_listing(self, args):
+        if not args:
+            # Plain LIST keeps the original one RESPONSE: line per file format
+            keys, _ = self.file_owner_map.list_keys()
+            lines = [f"RESPONSE:{len(keys)}"] + [f"RESPONSE:{fname} (Owner: {owner})" for fname, owner in keys]
+            return ("\n".join(lines) + "\n").encode()
+        prefix, owner, cursor, limit = [None if arg == "-" else arg for arg in args + ["-"] * (4 - len(args))]
+        after = tuple(bytes.fromhex(cursor).decode().split("\0")) if cursor else None
+        limit = int(limit) if limit else None
+        if limit is not None and limit < 1:
+            raise ValueError("LIST limit must be positive.")
+        keys, more = self.file_owner_map.list_keys(prefix or "", owner, after, limit)
+        next_cursor = "\0".join(keys[-1]).encode().hex() if more else "-"
+        lines = [f"LISTING:{len(keys)} {next_cursor}"] + [f"{fname} (Owner: {owner})" for fname, owner in keys]
+        return ("\n".join(lines) + "\n").encode()
+
+    # Resolve a download request to a stored file name, reporting errors to the client
+    async def find_download(self, sock_buf, username, filename, owner):
+        unique_filename = await self.shared(self.file_owner_map.get, (filename, owner))
+        if not unique_filename:
+            await sock_buf.send_line("ERROR File not found.")
+            self.log.info("%s requested a non-existent file %s.", username, filename)
+            return None
+        if not self.read_cache.exists(unique_filename):
+            await sock_buf.send_line("ERROR File not found on server.")
+            self.log.warning("'%s' not found on server for %s.", filename, username)
+            return None
+        return unique_filename
+
+    # Answer a download whose file was deleted after find_download looked it up
+    async def file_vanished(self, sock_buf, username, filename):
+        await sock_buf.send_line("ERROR File not found.")
+        self.log.info("%s requested %s while it was being deleted.", username, filename)
+
+    # " checksum=<checksum>" for a download header, if the client asked for checksums and
+    # the file has one
+    async def checksum_option(self, sock_buf, filename, owner):
+        checksum = await self.shared(self.file_owner_map.checksum, (filename, owner)) if sock_buf.checksums else None
+        return f" checksum={checksum}" if checksum else ""
+
+    # Tell the owner and subscribers about an upload, delete or download; with several
+    # workers the event is also handed to the others for the users connected there
+    async def publish(self, kind, filename, owner, actor):
+        self.events.publish(kind, filename, owner, actor)
+        if self.worker is not None:
+            await self.shared(self.worker.registry.publish, (kind, filename, owner, actor), self.worker.worker_id)
+
+    # Subscribe to file events: SUBSCRIBE [events=upload,delete,download] [owner=<user>]
+    # [prefix=<prefix>]; they arrive as EVENT:<kind> <filename> <owner> lines (downloads
+    # add a count) wherever notifications go. UNSUBSCRIBE drops every subscription.
+    async def handle_subscribe(self, sock_buf, username, data):
+        parts, options = split_options(data.split())
+        if parts[0] == "UNSUBSCRIBE" and len(parts) == 1 and not options:
+            self.events.unsubscribe(username)
+            await sock_buf.send_line("RESPONSE:Unsubscribed.")
+            return
+        kinds = options.pop("events", ",".join(EVENT_KINDS)).split(",")
+        owner = options.pop("owner", None)
+        prefix = options.pop("prefix", "")
+        if parts[0] != "SUBSCRIBE" or len(parts) != 1 or options or not set(kinds) <= set(EVENT_KINDS):
+            await sock_buf.send_line(f"ERROR Invalid {parts[0]} command.")
+        elif not self.events.subscribe(username, kinds, owner, prefix):
+            await sock_buf.send_line("ERROR Too many subscriptions.")
+        else:
+            await sock_buf.send_line("RESPONSE:Subscribed.")
+            self.log.debug("%s subscribed to %s events.", username, ",".join(kinds))
+
+    # Show or change the transfer limits: BANDWIDTH answers RESPONSE:<name>=<value>...,
+    # and BANDWIDTH <name>=<value>... changes some of them when the server allows it.
+    # Rates are in bytes per second, 0 for no limit; see BandwidthScheduler. With several
+    # workers the change is handed to the others as well.
+    async def handle_bandwidth(self, sock_buf, username, data):
+        parts, options = split_options(data.split())
+        if len(parts) != 1:
+            await sock_buf.send_line("ERROR Invalid BANDWIDTH command.")
+            return
+        if options:
+            if not self.allow_bandwidth_control:
+                await sock_buf.send_line("ERROR Bandwidth control is disabled on this server.")
+                return
+            try:
+                self.bandwidth.configure(options)
+            except ValueError as e:
+                await sock_buf.send_line(f"ERROR {e}")
+                return
+            if self.worker is not None:
+                await self.shared(self.worker.registry.publish, ("bandwidth", options), self.worker.worker_id)
+            self.log.info("%s changed the bandwidth limits: %s", username, self.bandwidth.describe())
+        await sock_buf.send_line(f"RESPONSE:{self.bandwidth.describe()}")
+
+    # Handle file download with per-chunk DATA framing: DOWNLOAD <file> <owner> [offset] [length]
+    async def handle_download(self, sock_buf, username, data):
+        parts = data.split()
+        if not 3 <= len(parts) <= 5:
+            await sock_buf.send_line("ERROR Invalid DOWNLOAD command.")
+            return
+        _, filename, owner = parts[:3]
+        unique_filename = await self.find_download(sock_buf, username, filename, owner)
+        if unique_filename is None:
+            return
+        try:
+            f, filesize = self.read_cache.open(unique_filename)
+        except FileNotFoundError:
+            await self.file_vanished(sock_buf, username, filename)
+            return
+        with f:
+            span = byte_range(parts[3:], filesize)
+            if span is None:
+                await sock_buf.send_line("ERROR Invalid range.")
+                return
+            offset, remaining = span
+            # Send the length being sent, and for ranges where it lies in the file
+            header = f"RESPONSE:{remaining}" + (f" range={offset}/{filesize}" if len(parts) > 3 else "")
+            await sock_buf.send_line(header + await self.checksum_option(sock_buf, filename, owner))
+            self.log.debug("Sending '%s' (%d of %d bytes) to %s", filename, remaining, filesize, username)
+            # Send file data
+            skip_to(f, offset)
+            with self.bandwidth.transfer(sock_buf, username, "egress", remaining):
+                while remaining > 0:
+                    chunk = sock_buf.read_file(f, min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    await sock_buf.send_line(f"DATA:{len(chunk)}")  # Data length
+                    await sock_buf.send_data(chunk)  # Send data chunk
+                    remaining -= len(chunk)
+        await sock_buf.send_line("DATA:0")  # Indicate end of download
+        self.log.info("%s sent to %s.", filename, username)
+        if offset == 0 and span[1]:  # Ranges further in continue a download already reported
+            await self.publish("download", filename, owner, username)
+
+    # Handle file download as a single FILE:<size> frame streamed with sendfile, or as
+    # compressed frames when the client asks for a codec:
+    # FETCH <file> <owner> [offset] [length] [codec=<name>]. A range is answered with
+    # FILE:<length> followed by range=<offset>/<file size>.
+    async def handle_fetch(self, sock_buf, username, data):
+        parts, options = split_options(data.split())
+        if not 3 <= len(parts) <= 5:
+            await sock_buf.send_line("ERROR Invalid FETCH command.")
+            return
+        _, filename, owner = parts[:3]
+        ranged = len(parts) > 3
+        codec = options.get("codec")
+        if codec is not None and codec not in sock_buf.codecs:
+            await sock_buf.send_line("ERROR Compression codec was not negotiated.")
+            return
+        unique_filename = await self.find_download(sock_buf, username, filename, owner)
+        if unique_filename is None:
+            return
+        checksum = await self.checksum_option(sock_buf, filename, owner)
+        stored = plain = None
+        try:
+            if codec and not ranged and hasattr(self.storage, "open_frames"):
+                stored = self.storage.open_frames(unique_filename, codec)
+            if stored is None:
+                plain = self.read_cache.open(unique_filename)  # Size of the exact version being sent
+        except FileNotFoundError:
+            await self.file_vanished(sock_buf, username, filename)
+            return
+        offset, length = 0, None
+        if stored is not None:
+            # Already compressed at rest with this codec: send the stored frames untouched
+            f, offset, count, filesize = stored
+            with f:
+                self.log.debug("Sending '%s' (%d bytes, stored compressed) to %s", filename, filesize, username)
+                with self.bandwidth.transfer(sock_buf, username, "egress", count):
+                    await sock_buf.send_file(f"FILE:{filesize} {codec}{checksum}", f, count, offset)
+        else:
+            f, filesize = plain
+            with f:
+                span = byte_range(parts[3:], filesize)
+                if span is None:
+                    await sock_buf.send_line("ERROR Invalid range.")
+                    return
+                offset, length = span
+                header = f"FILE:{length}" + (f" {codec}" if codec else "")
+                header += (f" range={offset}/{filesize}" if ranged else "") + checksum
+                self.log.debug("Sending '%s' (%d of %d bytes) to %s", filename, length, filesize, username)
+                with self.bandwidth.transfer(sock_buf, username, "egress", length):
+                    if codec is None:
+                        await sock_buf.send_file(header, f, length, offset)
+                    else:
+                        skip_to(f, offset)
+                        await self.send_frames(sock_buf, header, codec, f, length)
+        self.log.info("%s sent to %s.", filename, username)
+        if offset == 0 and length != 0:  # Ranges further in continue a download already reported
+            await self.publish("download", filename, owner, username)
+
+    # Send a header line and then f compressed frame by frame, up to count bytes if given
+    async def send_frames(self, sock_buf, line, codec, f, count=None):
+        async with sock_buf.lock:
+            await sock_buf.sendall((line + '\n').encode())
+            while count is None or count > 0:
+                block = sock_buf.read_file(f, BLOCK_SIZE if count is None else min(BLOCK_SIZE, count))
+                if not block:
+                    break
+                if count is not None:
+                    count -= len(block)
+                # Compression releases the GIL, so it runs on the thread pool
+                frame = await self.loop.run_in_executor(None, encode_frame, codec, block)
+                await sock_buf.sendall(frame)
+            await sock_buf.sendall(END_FRAME)
+
+    # Report server metrics: STATS answers STATS:<count> followed by that many lines in
+    # the Prometheus text format; STATS profile=<seconds> profiles the event loop for that
+    # long and answers with the report instead
+    async def handle_stats(self, sock_buf, username, data):
+        parts, options = split_options(data.split())
+        if len(parts) != 1:
+            await sock_buf.send_line("ERROR Invalid STATS command.")
+            return
+        if "profile" not in options:
+            lines = self.render_metrics()
+        elif not self.allow_profiling:
+            await sock_buf.send_line("ERROR Profiling is disabled on this server.")
+            return
+        else:
+            seconds = float(options["profile"])
+            if not 0 < seconds <= MAX_PROFILE_SECONDS:
+                await sock_buf.send_line(f"ERROR Profile length must be between 0 and {MAX_PROFILE_SECONDS} seconds.")
+                return
+            lines = await self.profile(seconds)
+            if lines is None:
+                await sock_buf.send_line("ERROR A profile is already being taken.")
+                return
+            self.log.info("%s took a %g second profile.", username, seconds)
+        await sock_buf.send_data(("\n".join([f"STATS:{len(lines)}"] + lines) + "\n").encode())
+
+    # Check stored files against their checksums: VERIFY starts a throttled background
+    # scrub unless one is running, VERIFY status only reports; both answer with progress
+    async def handle_verify(self, sock_buf, username, data):
+        parts = data.split()
+        if parts[1:] not in ([], ["status"]):
+            await sock_buf.send_line("ERROR Invalid VERIFY command.")
+            return
+        if len(parts) == 1 and self.scrubber.start():
+            self.log.info("%s started a scrub.", username)
+        await sock_buf.send_line(f"RESPONSE:{self.scrubber.status()}")
+
+    # Start a scrub every scrub_interval seconds
+    async def scrub_periodically(self):
+        while True:
+            await asyncio.sleep(self.scrub_interval)
+            self.scrubber.start()
+
+    # Start a compaction pass every PACK_INTERVAL seconds
+    async def compact_periodically(self):
+        while True:
+            await asyncio.sleep(PACK_INTERVAL)
+            self.compactor.start()
+
+    # Discard abandoned upload sessions at startup and every EXPIRY_INTERVAL seconds
+    async def expire_sessions_periodically(self):
+        while True:
+            expired = await self.loop.run_in_executor(None, self.upload_sessions.expire)
+            if expired:
+                self.log.info("Discarded %d abandoned upload sessions.", expired)
+            await asyncio.sleep(EXPIRY_INTERVAL)
+
+    def render_metrics(self):
+        clients = len(self.connected_clients) if self.worker is None else self.worker.registry.count()
+        return (self.metrics.render(clients, self.file_owner_map.lock_wait_seconds())
+                + self.read_cache.render() + self.scrubber.render() + self.events.render() + self.bandwidth.render()
+                + (self.compactor.render() if self.compactor is not None else []))
+
+    # Profile everything the event loop runs for the given time, returning the report
+    # lines, or None if another profile is in progress
+    async def profile(self, seconds):
+        if not self.metrics.start_profile():
+            return None
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            lines = self.metrics.stop_profile()
+        return lines
+
+    # Serve one HTTP request on the local metrics endpoint: GET /metrics, or
+    # GET /profile?seconds=<n> when profiling is allowed
+    async def handle_metrics_request(self, reader, writer):
+        try:
+            request = (await reader.readline()).decode(errors="replace").split()
+            while (await reader.readline()).strip():
+                pass  # Headers are not needed
+            path = request[1] if len(request) >= 2 and request[0] == "GET" else ""
+            status, lines = "404 Not Found", ["Not found."]
+            if path == "/metrics":
+                status, lines = "200 OK", self.render_metrics()
+            elif path.startswith("/profile") and self.allow_profiling:
+                _, _, seconds = path.partition("seconds=")
+                seconds = float(seconds or 10)
+                if 0 < seconds <= MAX_PROFILE_SECONDS:
+                    report = await self.profile(seconds)
+                    status, lines = ("200 OK", report) if report is not None else ("409 Conflict", ["Profile already running."])
+                else:
+                    status, lines = "400 Bad Request", ["Invalid profile length."]
+            body = ("\n".join(lines) + "\n").encode()
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    # Handle file deletion
+    async def handle_delete(self, sock_buf, username, data):
+        parts = data.split()
+        if len(parts) != 2:
+            await sock_buf.send_line("ERROR Invalid DELETE command.")
+            return
+        _, filename = parts
+        unique_filename, committed = await self.shared(self.file_owner_map.pop, (filename, username))  # Remove from map
+        if unique_filename:
+            await self.wait_committed(committed)
+            await self.loop.run_in_executor(None, self.storage.delete, unique_filename)  # Delete the file
+            self.read_cache.invalidate(unique_filename)
+            await sock_buf.send_line(f"RESPONSE:{filename} deleted successfully.")
+            self.log.info("%s deleted file %s.", username, filename)
+            await self.publish("delete", filename, username, username)
+        else:
+            await sock_buf.send_line("ERROR You do not own this file or it does not exist.")
+            self.log.info("%s tried to delete a file %s that does not exist or is not owned by them.", username, filename)
+
+    # Accept connections and serve each one as a task on the event loop
+    async def serve_forever(self):
+        self.loop = asyncio.get_running_loop()
+        if self.worker is None:
+            self.storage.load()  # Create the upload directory and prepare the backend
+        self.file_owner_map.load()  # Load file-owner mapping from disk
+
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.worker is not None:
+            # The kernel spreads new connections over every worker listening on the port
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            threading.Thread(target=self.receive_relayed, daemon=True).start()
+        server.bind((self.host, self.port))
+        server.listen(self.backlog)
+        server.setblocking(False)
+        self.port = server.getsockname()[1]  # Resolve the real port when 0 was requested
+        self.listener = server
+        self.log.info("Server listening on port %d...", self.port)
+        if self.metrics_port is not None:
+            # Metrics are only served on the loopback interface
+            metrics_server = await asyncio.start_server(self.handle_metrics_request, "127.0.0.1", self.metrics_port)
+            self.metrics_port = metrics_server.sockets[0].getsockname()[1]
+            self.log.info("Metrics available at http://127.0.0.1:%d/metrics", self.metrics_port)
+        # Periodic scrubs run on the first worker only; the others share its files
+        if self.scrub_interval and (self.worker is None or self.worker.worker_id == 0):
+            self.scrub_task = self.loop.create_task(self.scrub_periodically())
+        if self.compactor is not None:
+            self.compact_task = self.loop.create_task(self.compact_periodically())
+        self.expiry_task = self.loop.create_task(self.expire_sessions_periodically())
+        self.ready.set()
+
+        tasks = set()  # Strong references so client tasks are not collected
+        try:
+            while True:
+                client_socket, client_address = await self.loop.sock_accept(server)
+                client_socket.setblocking(False)
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                task = self.loop.create_task(self.handle_client(client_socket, client_address))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            server.close()
+
+    # Hand events published on other workers over to this one's event bus, and apply
+    # bandwidth limits changed there
+    def receive_relayed(self):
+        while True:
+            try:
+                event = self.worker.registry.receive(self.worker.worker_id)
+            except (EOFError, OSError):
+                return  # Shared state is gone; the pool is shutting down
+            if event[0] == "bandwidth":
+                self.loop.call_soon_threadsafe(self.bandwidth.configure, event[1])
+            else:
+                self.loop.call_soon_threadsafe(self.events.publish, *event)
+
+    # Run the server on the calling thread until interrupted
+    def run(self):
+        asyncio.run(self.serve_forever())
+
+
+# Body of a worker process: serve the shared port until interrupted
+def run_worker(worker_id, workers, address, authkey, options, log_level, log_json):
+    server = FileServer(log=LogPipeline(log_level, log_json),
+                        worker=WorkerContext(worker_id, workers, address, authkey), **options)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        server.log.flush()
+
+
+# Serve with a pool of worker processes sharing one port through SO_REUSEPORT. The
+# file-owner map and the registry of connected users live in a separate shared state
+# process; a worker that dies is replaced. Needs a backend whose state is all on disk,
+# so deduplicated chunk storage, which counts chunk references in memory, and tiered
+# storage, which keeps its pack index in memory, are excluded.
+def run_workers(workers, options, log_level, log_json):
+    if options["storage"] in ("chunks", "tiered"):
+        raise ValueError(f"{options['storage'].capitalize()} storage cannot be shared by several worker processes.")
+    context = multiprocessing.get_context("fork")
+    reserved = reserve_port(options["host"], options["port"])
+    options = dict(options, port=reserved.getsockname()[1])
+    open_storage(options["upload_folder"], options["storage"], options["compress_at_rest"]).load()
+    authkey = secrets.token_bytes(32)
+    shared = SharedState(authkey=authkey, ctx=context)
+    shared.start(start_services, (options.pop("metadata_path"), options.pop("metadata_shards")))
+    registry = shared.registry()
+
+    def start(worker_id):
+        process = context.Process(target=run_worker, daemon=True,
+                                  args=(worker_id, workers, shared.address, authkey, options, log_level, log_json))
+        process.start()
+        return process
+
+    processes = {worker_id: start(worker_id) for worker_id in range(workers)}
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # Stop the workers as on Ctrl-C
+    try:
+        while processes:
+            multiprocessing.connection.wait([process.sentinel for process in processes.values()])
+            for worker_id, process in list(processes.items()):
+                if process.is_alive():
+                    continue
+                registry.drop_worker(worker_id)
+                if process.exitcode == 0:
+                    del processes[worker_id]  # Stopped on purpose
+                else:
+                    print(f"Worker {worker_id} exited with code {process.exitcode}; restarting it.", flush=True)
+                    processes[worker_id] = start(worker_id)
+    except KeyboardInterrupt:
+        pass  # Ctrl-C reaches the workers too
+    finally:
+        for process in processes.values():
+            process.terminate()
+            process.join()
+        reserved.close()
+        shared.shutdown()
+
+
+# Command-line entry point for running the server without a GUI
+def main():
+    parser = argparse.ArgumentParser(description="Headless cloud file storage server.")
+    parser.add_argument("--port", type=int, required=True, help="TCP port to listen on")
+    parser.add_argument("--folder", required=True, help="Storage folder for uploaded files")
+    parser.add_argument("--host", default="0.0.0.0", help="Interface to bind to")
+    parser.add_argument("--backlog", type=int, default=socket.SOMAXCONN, help="Listen queue length")
+    parser.add_argument("--storage", choices=("files", "chunks", "tiered"), default="files",
+                        help="Store uploads as loose files, as deduplicated chunks, or as loose files with "
+                             "cold small ones packed")
+    parser.add_argument("--pack-after-hours", type=float, default=PACK_AFTER / 3600,
+                        help="With tiered storage, pack small files not written or read for this many hours")
+    parser.add_argument("--compress-at-rest", action="store_true",
+                        help="Store loose files zlib-compressed instead of compressing on the fly")
+    parser.add_argument("--max-session-gb", type=float, default=MAX_SESSION_SIZE / 1024 ** 3,
+                        help="Largest file a resumable upload session may stage, in GB")
+    parser.add_argument("--session-expiry-hours", type=float, default=SESSION_EXPIRY / 3600,
+                        help="Discard upload sessions that received no range for this many hours")
+    parser.add_argument("--log-level", choices=("debug", "info", "warning", "error"), default="info",
+                        help="Lowest level of messages to log")
+    parser.add_argument("--log-json", help="Also append log records to this JSON-lines file")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this local port")
+    parser.add_argument("--allow-profiling", action="store_true",
+                        help="Let clients request cProfile reports (STATS profile=<seconds>, /profile)")
+    parser.add_argument("--metadata-shards", type=int, default=SHARDS,
+                        help="Number of independently locked slices of the file-owner map")
+    parser.add_argument("--read-cache-mb", type=int, default=CACHE_BYTES // (1024 * 1024),
+                        help="Memory for caching hot downloads (0 disables the cache)")
+    parser.add_argument("--scrub-rate-mb", type=float, default=SCRUB_RATE / (1024 * 1024),
+                        help="Disk read rate of a scrub (VERIFY) in MB/s")
+    parser.add_argument("--scrub-hours", type=float, help="Scrub the whole store every this many hours")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the port (SO_REUSEPORT); 1 serves in this process")
+    parser.add_argument("--egress-mb", type=float, default=0, help="Cap on all downloads together in MB/s (0: none)")
+    parser.add_argument("--ingress-mb", type=float, default=0, help="Cap on all uploads together in MB/s (0: none)")
+    parser.add_argument("--user-egress-mb", type=float, default=0, help="Cap on each user's downloads in MB/s (0: none)")
+    parser.add_argument("--user-ingress-mb", type=float, default=0, help="Cap on each user's uploads in MB/s (0: none)")
+    parser.add_argument("--allow-bandwidth-control", action="store_true",
+                        help="Let clients change the bandwidth limits at runtime (BANDWIDTH <name>=<value>)")
+    args = parser.parse_args()
+    levels = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+    options = dict(port=args.port, upload_folder=args.folder, host=args.host, backlog=args.backlog,
+                   storage=args.storage, compress_at_rest=args.compress_at_rest, metadata_path='file_owner_map',
+                   metadata_shards=args.metadata_shards, allow_profiling=args.allow_profiling,
+                   read_cache_bytes=args.read_cache_mb * 1024 * 1024, scrub_rate=args.scrub_rate_mb * 1024 * 1024,
+                   scrub_interval=args.scrub_hours * 3600 if args.scrub_hours else None,
+                   bandwidth_limits=dict(egress=args.egress_mb * 1024 * 1024, ingress=args.ingress_mb * 1024 * 1024,
+                                         user_egress=args.user_egress_mb * 1024 * 1024,
+                                         user_ingress=args.user_ingress_mb * 1024 * 1024),
+                   allow_bandwidth_control=args.allow_bandwidth_control, pack_after=args.pack_after_hours * 3600,
+                   max_session_size=int(args.max_session_gb * 1024 ** 3), session_expiry=args.session_expiry_hours * 3600)
+    if args.workers > 1:
+        if args.metrics_port is not None:
+            parser.error("--metrics-port needs a single worker; use STATS to read a worker's metrics")
+        try:
+            run_workers(args.workers, options, levels[args.log_level], args.log_json)
+        except ValueError as e:
+            parser.error(str(e))
+        return
+
+    server = FileServer(log=LogPipeline(levels[args.log_level], args.log_json),
+                        metrics_port=args.metrics_port, **options)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        server.log.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import json
+import sys
+import threading
+import time
+from collections import deque
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+FLUSH_INTERVAL = 0.05  # Seconds between batches written by the log thread
+MAX_BATCH = 5000  # Records handled per batch
+
+
+# Structured log pipeline. Producers only check the level and append the raw record to
+# a deque (append/popleft are atomic, so no lock is taken); a background thread does
+# the %-formatting and writes whole batches to the console, a JSON-lines file and any
+# bounded views polled by a GUI.
+class LogPipeline:
+    def __init__(self, level=INFO, json_path=None, console=True):
+        self.level = level
+        self.records = deque()
+        self.views = []  # Bounded deques of formatted lines for GUIs to poll
+        self.console = console
+        self.json_file = open(json_path, "a", encoding="utf-8") if json_path else None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # True if messages at level are recorded; lets callers skip building expensive arguments
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, message, *args):
+        if level >= self.level:
+            self.records.append((time.time(), level, message, args))
+
+    def debug(self, message, *args):
+        self.log(DEBUG, message, *args)
+
+    def info(self, message, *args):
+        self.log(INFO, message, *args)
+
+    def warning(self, message, *args):
+        self.log(WARNING, message, *args)
+
+    def error(self, message, *args):
+        self.log(ERROR, message, *args)
+
+    # Register a view keeping at most max_lines formatted lines not yet taken by its reader
+    def add_view(self, max_lines=1000):
+        view = deque(maxlen=max_lines)
+        self.views.append(view)
+        return view
+
+    # Log thread: format and write everything queued since the last batch
+    def run(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    # Format and write the queued records in batches
+    def flush(self):
+        while self.records:
+            batch = []
+            while self.records and len(batch) < MAX_BATCH:
+                batch.append(self.records.popleft())
+            lines = []
+            json_lines = []
+            for timestamp, level, message, args in batch:
+                text = message % args if args else message
+                lines.append(text)
+                if self.json_file is not None:
+                    json_lines.append(json.dumps({"time": timestamp, "level": LEVEL_NAMES[level], "message": text}) + "\n")
+            if self.console:
+                sys.stdout.write("\n".join(lines) + "\n")
+                sys.stdout.flush()
+            if self.json_file is not None:
+                self.json_file.write("".join(json_lines))
+                self.json_file.flush()
+            for view in self.views:
+                view.extend(lines)
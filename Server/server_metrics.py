@@ -0,0 +1,111 @@
+import bisect
+import cProfile
+import io
+import pstats
+import time
+
+# Upper bounds in seconds of the latency histogram buckets; a final +Inf bucket is implied
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+MAX_PROFILE_SECONDS = 60  # Longest profiling window a client may ask for
+PROFILE_LINES = 40  # Functions listed in a profile report
+
+
+# Histogram with fixed buckets, rendered cumulatively as Prometheus expects
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    # Exposition lines for this histogram under name with the given label text
+    def render(self, name, labels=""):
+        separator = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        braces = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{braces} {self.total:.6f}")
+        lines.append(f"{name}_count{braces} {self.count}")
+        return lines
+
+
+# Totals for one protocol command
+class CommandStats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.disk_seconds = 0.0
+        self.network_seconds = 0.0
+
+
+# Server instrumentation. Every method runs on the event loop thread, so no locking is
+# needed; per-command figures are the differences of a connection's socket counters
+# (see AsyncSocketBuffer) between the start and end of the command.
+class Metrics:
+    def __init__(self, commands):
+        self.commands = {command: CommandStats() for command in commands + ("OTHER",)}
+        self.connections_total = 0
+        self.connections_open = 0
+        self.metadata_commit = Histogram()  # Waits for metadata changes to reach disk
+        self.profiler = None  # Active cProfile.Profile while a profile is being taken
+
+    # Snapshot a connection's counters before running a command
+    def start(self, sock_buf):
+        return (time.perf_counter(), sock_buf.bytes_in, sock_buf.bytes_out,
+                sock_buf.disk_seconds, sock_buf.network_seconds)
+
+    # Record a finished command from the snapshot taken by start()
+    def finish(self, command, sock_buf, started):
+        stats = self.commands.get(command) or self.commands["OTHER"]
+        began, bytes_in, bytes_out, disk_seconds, network_seconds = started
+        stats.latency.observe(time.perf_counter() - began)
+        stats.bytes_in += sock_buf.bytes_in - bytes_in
+        stats.bytes_out += sock_buf.bytes_out - bytes_out
+        stats.disk_seconds += sock_buf.disk_seconds - disk_seconds
+        stats.network_seconds += sock_buf.network_seconds - network_seconds
+
+    # Prometheus text exposition of all metrics plus the gauges passed in by the server
+    def render(self, connected_clients, metadata_lock_seconds):
+        lines = ["# TYPE cfs_command_seconds histogram"]
+        for command, stats in self.commands.items():
+            lines += stats.latency.render("cfs_command_seconds", f'command="{command}"')
+        for name, field in (("cfs_command_received_bytes_total", "bytes_in"),
+                            ("cfs_command_sent_bytes_total", "bytes_out"),
+                            ("cfs_command_disk_seconds_total", "disk_seconds"),
+                            ("cfs_command_network_seconds_total", "network_seconds")):
+            lines.append(f"# TYPE {name} counter")
+            for command, stats in self.commands.items():
+                lines.append(f'{name}{{command="{command}"}} {round(getattr(stats, field), 6)}')
+        lines += ["# TYPE cfs_connected_clients gauge", f"cfs_connected_clients {connected_clients}",
+                  "# TYPE cfs_open_connections gauge", f"cfs_open_connections {self.connections_open}",
+                  "# TYPE cfs_connections_total counter", f"cfs_connections_total {self.connections_total}",
+                  "# TYPE cfs_metadata_lock_wait_seconds_total counter",
+                  f"cfs_metadata_lock_wait_seconds_total {metadata_lock_seconds:.6f}",
+                  "# TYPE cfs_metadata_commit_seconds histogram"]
+        lines += self.metadata_commit.render("cfs_metadata_commit_seconds")
+        return lines
+
+    # Start profiling the calling thread; returns False if a profile is already running
+    def start_profile(self):
+        if self.profiler is not None:
+            return False
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        return True
+
+    # Stop profiling and return the report lines, most expensive functions first
+    def stop_profile(self):
+        self.profiler.disable()
+        report = io.StringIO()
+        pstats.Stats(self.profiler, stream=report).sort_stats("cumulative").print_stats(PROFILE_LINES)
+        self.profiler = None
+        return report.getvalue().splitlines()
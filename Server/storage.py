@@ -0,0 +1,225 @@
+import os
+import secrets
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from compression import BLOCK_SIZE, END_FRAME, FRAME_HEADER, decode_payload, encode_frame
+
+COMPRESSED_MAGIC = b"CFSZ"  # Marks a file stored compressed at rest
+COMPRESSED_HEADER = struct.Struct("!4s8sQ")  # Magic, codec name, uncompressed size
+STAGING_FOLDER = ".staging"  # Uploads in progress, inside the upload folder so rename is atomic
+WRITE_BUFFER = 1024 * 1024  # Buffer of a staged upload, so the disk sees large writes
+
+
+# Reserve size bytes for a file about to be written, so it is laid out contiguously.
+# Where the file system cannot do that the file simply grows as it is written.
+def preallocate(fd, size):
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError:
+            pass
+
+
+# Write a file's buffered data through to the disk
+def sync_file(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+# Make the renames into a directory durable
+def sync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Writer for a new or replaced file. Data goes to a staging file that commit() renames
+# over the stored one, so readers see the old or the new version but never a partial
+# one, and downloads that already opened the old version finish reading it. The data
+# and the rename are on disk before commit() returns and the metadata records the file.
+class FileWriter:
+    def __init__(self, path, staging_dir, size=None):
+        self.path = path
+        self.temp_path = os.path.join(staging_dir, secrets.token_hex(16) + ".tmp")
+        self.file = open(self.temp_path, "wb", buffering=WRITE_BUFFER)
+        if size is not None:
+            preallocate(self.file.fileno(), size)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.truncate()  # Drop any preallocated space past the end of the data
+        sync_file(self.file)
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+        sync_directory(os.path.dirname(self.path))
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.temp_path)  # The stored version, if any, is untouched
+
+
+# Default storage backend: one loose file per upload in the upload folder
+class FileStorage:
+    def __init__(self, folder):
+        self.folder = folder
+        self.staging_dir = os.path.join(folder, STAGING_FOLDER)
+
+    # Create the folders and remove uploads left unfinished by a crash
+    def load(self):
+        os.makedirs(self.staging_dir, exist_ok=True)
+        for entry in os.scandir(self.staging_dir):
+            os.remove(entry.path)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def size(self, name):
+        return os.path.getsize(self.path(name))
+
+    # Open a stored file for reading, returning (file, size). touch=False marks a read
+    # that is not a use of the file, such as a scrub; only tiered storage tracks it.
+    def open(self, name, touch=True):
+        f = open(self.path(name), "rb")
+        return f, os.fstat(f.fileno()).st_size
+
+    # Start writing a file that becomes visible on commit; size, if known, is preallocated
+    def create(self, name, size=None):
+        return FileWriter(self.path(name), self.staging_dir, size)
+
+    # Take ownership of a complete file written elsewhere (e.g. an upload session)
+    def ingest(self, staged_path, name):
+        os.replace(staged_path, self.path(name))  # Its ranges were fsynced as they arrived
+        sync_directory(self.folder)
+
+    def delete(self, name):
+        if os.path.exists(self.path(name)):
+            os.remove(self.path(name))
+
+
+# Writer compressing a file into frames; the uncompressed size is filled in on commit
+class CompressedFileWriter(FileWriter):
+    def __init__(self, path, staging_dir, codec):
+        super().__init__(path, staging_dir)
+        self.codec = codec
+        self.pending = bytearray()
+        self.size = 0
+        self.file.write(COMPRESSED_HEADER.pack(COMPRESSED_MAGIC, codec.encode(), 0))
+
+    def write(self, data):
+        self.pending += data
+        self.size += len(data)
+        while len(self.pending) >= BLOCK_SIZE:
+            self.file.write(encode_frame(self.codec, self.pending[:BLOCK_SIZE]))
+            del self.pending[:BLOCK_SIZE]
+
+    def commit(self):
+        if self.pending:
+            self.file.write(encode_frame(self.codec, self.pending))
+        self.file.write(END_FRAME)
+        self.file.seek(0)
+        self.file.write(COMPRESSED_HEADER.pack(COMPRESSED_MAGIC, self.codec.encode(), self.size))
+        sync_file(self.file)
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+        sync_directory(os.path.dirname(self.path))
+
+
+# Reads the uncompressed contents of a file stored compressed at rest
+class DecompressingReader:
+    def __init__(self, f, codec):
+        self.file = f
+        self.codec = codec
+        self.current = b''
+        self.done = False  # Set once the end frame has been read
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0 and not self.done:
+            if not self.current:
+                kind, length = FRAME_HEADER.unpack(self.file.read(FRAME_HEADER.size))
+                if length == 0:
+                    self.done = True
+                    break
+                self.current = decode_payload(self.codec, kind, self.file.read(length))
+            piece = self.current if size < 0 else self.current[:size]
+            self.current = self.current[len(piece):]
+            parts.append(piece)
+            if size > 0:
+                size -= len(piece)
+        return b''.join(parts)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Loose-file storage that compresses new files at rest. Files already stored
+# uncompressed stay readable, and compressed files can be sent to clients using the
+# same codec without being decompressed.
+class CompressedFileStorage(FileStorage):
+    def __init__(self, folder, codec="zlib"):
+        super().__init__(folder)
+        self.codec = codec
+
+    # Read the header of a stored file: (codec, uncompressed size), or None if stored plain
+    def header(self, f):
+        header = f.read(COMPRESSED_HEADER.size)
+        if len(header) == COMPRESSED_HEADER.size:
+            magic, codec, size = COMPRESSED_HEADER.unpack(header)
+            if magic == COMPRESSED_MAGIC:
+                return codec.rstrip(b"\0").decode(), size
+        f.seek(0)
+        return None
+
+    def size(self, name):
+        with open(self.path(name), "rb") as f:
+            header = self.header(f)
+            return header[1] if header else os.fstat(f.fileno()).st_size
+
+    def open(self, name, touch=True):
+        f = open(self.path(name), "rb")
+        header = self.header(f)
+        if header is None:
+            return f, os.fstat(f.fileno()).st_size
+        return DecompressingReader(f, header[0]), header[1]
+
+    # Open the stored frames of a file compressed with codec, returning
+    # (file, offset of the first frame, byte count including the end frame, uncompressed size),
+    # or None if the file is not stored that way
+    def open_frames(self, name, codec):
+        f = open(self.path(name), "rb")
+        header = self.header(f)
+        if header is None or header[0] != codec:
+            f.close()
+            return None
+        return f, COMPRESSED_HEADER.size, os.fstat(f.fileno()).st_size - COMPRESSED_HEADER.size, header[1]
+
+    # The compressed size is not known in advance, so nothing is preallocated
+    def create(self, name, size=None):
+        return CompressedFileWriter(self.path(name), self.staging_dir, self.codec)
+
+    # Compress a complete file written elsewhere into place
+    def ingest(self, staged_path, name):
+        writer = self.create(name)
+        with open(staged_path, "rb") as f:
+            while True:
+                data = f.read(BLOCK_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+        writer.commit()
+        os.remove(staged_path)
@@ -0,0 +1,220 @@
+import fcntl
+import json
+import os
+import secrets
+import string
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from integrity import file_checksum
+from storage import preallocate
+
+SESSION_FOLDER = ".sessions"  # Staging area for resumable uploads inside the upload folder
+MAX_SESSION_SIZE = 64 * 1024 ** 3  # Largest file an upload session may stage
+SESSION_EXPIRY = 7 * 24 * 3600  # Seconds without a new range before a session is discarded
+EXPIRY_INTERVAL = 3600  # Seconds between two sweeps for expired sessions
+
+
+# File-like object writing consecutive bytes at an offset with pwrite
+class RangeWriter:
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, self.offset)
+            self.offset += written
+            view = view[written:]
+
+
+# Resumable upload whose byte ranges are written into a preallocated staging file.
+# The committed ranges are kept in a JSON file next to it so a session survives restarts,
+# and so worker processes serving ranges of the same session see each other's.
+class UploadSession:
+    def __init__(self, directory, session_id, owner, filename, size, ranges=None):
+        self.session_id = session_id
+        self.owner = owner
+        self.filename = filename
+        self.size = size
+        self.ranges = ranges or []  # Sorted, merged [start, end) pairs that are on disk
+        self.part_path = os.path.join(directory, session_id + ".part")
+        self.state_path = os.path.join(directory, session_id + ".json")
+        self.fd = None
+        self.lock = threading.Lock()  # Ranges from parallel connections commit concurrently
+
+    # Start a new session with a staging file of the final size, preallocated so that
+    # ranges arriving out of order still end up laid out in sequence
+    @classmethod
+    def create(cls, directory, owner, filename, size):
+        session = cls(directory, secrets.token_hex(16), owner, filename, size)
+        with open(session.part_path, "wb") as f:
+            preallocate(f.fileno(), size)
+            f.truncate(size)
+        session.save()
+        return session
+
+    # Load a session from disk, or return None if it does not exist
+    @classmethod
+    def load(cls, directory, session_id):
+        if len(session_id) != 32 or not all(c in string.hexdigits for c in session_id):
+            return None
+        try:
+            state = read_state(os.path.join(directory, session_id + ".json"))
+        except (OSError, ValueError):
+            return None
+        return cls(directory, session_id, state["owner"], state["filename"], state["size"], state["ranges"])
+
+    # Pick up ranges committed by other processes since the session was loaded
+    def refresh(self):
+        try:
+            self.ranges = read_state(self.state_path)["ranges"]
+        except (OSError, ValueError):
+            pass  # Committed or aborted elsewhere; the caller finds out from the files
+
+    # Persist the session state atomically
+    def save(self):
+        state = {"owner": self.owner, "filename": self.filename, "size": self.size, "ranges": self.ranges}
+        temp_path = self.state_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(temp_path, self.state_path)
+
+    # Writer for a range starting at offset
+    def writer(self, offset):
+        if self.fd is None:
+            self.fd = os.open(self.part_path, os.O_WRONLY)
+        return RangeWriter(self.fd, offset)
+
+    # True while the session is open; another worker process may have committed or
+    # aborted it since it was loaded
+    def is_open(self):
+        return os.path.exists(self.state_path)
+
+    # Make a fully received range durable and record it as committed. The staging file
+    # is flocked while the state is re-read and rewritten, since other worker processes
+    # may be committing ranges of the same session. Raises FileNotFoundError, without
+    # recreating the state, if the session was closed meanwhile.
+    def commit_range(self, offset, length):
+        os.fsync(self.fd)
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                if not self.is_open():
+                    raise FileNotFoundError("Upload session is closed.")
+                self.refresh()
+                self.merge_range(offset, length)
+                self.save()
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    # Add a range to the committed ones, merging it with its neighbours
+    def merge_range(self, offset, length):
+        ranges = sorted(self.ranges + [[offset, offset + length]])
+        merged = [ranges[0]]
+        for start, end in ranges[1:]:
+            if start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.ranges = merged
+
+    # Number of bytes covered by committed ranges
+    def committed_bytes(self):
+        return sum(end - start for start, end in self.ranges)
+
+    # True once every byte of the file has been committed
+    def is_complete(self):
+        return self.committed_bytes() == self.size
+
+    # Checksum of the assembled file. Ranges arrive out of order, so unlike a plain
+    # upload this takes one read of the staging file, which is normally still cached.
+    def checksum(self):
+        with open(self.part_path, "rb") as f:
+            return file_checksum(f)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    # Remove the staging and state files
+    def discard(self):
+        self.close()
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def read_state(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# Registry of open upload sessions, loading ones left on disk on first use. Sessions
+# may stage files of up to max_size bytes and are discarded after expiry seconds
+# without a new range.
+class SessionManager:
+    def __init__(self, upload_folder, max_size=MAX_SESSION_SIZE, expiry=SESSION_EXPIRY):
+        self.directory = os.path.join(upload_folder, SESSION_FOLDER)
+        self.max_size = max_size
+        self.expiry = expiry
+        self.sessions = {}
+
+    # Create a session for owner's filename
+    def create(self, owner, filename, size):
+        os.makedirs(self.directory, exist_ok=True)
+        session = UploadSession.create(self.directory, owner, filename, size)
+        self.sessions[session.session_id] = session
+        return session
+
+    # Look up a session by id, or return None. A cached session closed by another worker
+    # process is dropped, so its descriptor is never written through again: after a
+    # commit it refers to the stored file.
+    def get(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is not None and not session.is_open():
+            session.close()
+            self.sessions.pop(session_id, None)
+            return None
+        if session is None:
+            session = UploadSession.load(self.directory, session_id)
+            if session is not None:
+                self.sessions[session_id] = session
+        return session
+
+    # Forget a session once it has been committed or aborted
+    def remove(self, session):
+        self.sessions.pop(session.session_id, None)
+
+    # Delete the files of sessions abandoned for longer than expiry seconds, including
+    # any left half-created by a crash, and return how many were removed. A session's
+    # files are only deleted once none of them has changed within the expiry.
+    def expire(self):
+        if not os.path.isdir(self.directory):
+            return 0
+        newest = {}  # Session id -> latest modification time of its files
+        files = {}
+        for entry in os.scandir(self.directory):
+            session_id = entry.name.split(".")[0]
+            try:
+                modified = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue  # Committed or aborted meanwhile
+            newest[session_id] = max(newest.get(session_id, 0), modified)
+            files.setdefault(session_id, []).append(entry.path)
+        cutoff = time.time() - self.expiry
+        expired = [session_id for session_id, modified in newest.items() if modified < cutoff]
+        for session_id in expired:
+            session = self.sessions.pop(session_id, None)
+            if session is not None:
+                session.close()
+            for path in files[session_id]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # Another worker process got there first
+        return len(expired)
@@ -0,0 +1,197 @@
+import queue
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import BaseManager
+
+from metadata import MetadataStore
+
+COMMIT_THREADS = 8  # Threads per worker waiting for metadata changes to reach disk
+
+SERVICES = {}  # Objects served by the shared state process, created by start_services
+
+
+# The file-owner map as served to the workers. Changes are applied immediately and
+# made durable by the store's group commit; flush waits for that separately so a
+# worker's event loop never waits on the journal.
+class MetadataService:
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def checksum(self, key):
+        return self.store.checksum(key)
+
+    def items_with_checksums(self):
+        return self.store.items_with_checksums()
+
+    def list_keys(self, prefix='', owner=None, after=None, limit=None):
+        return self.store.list_keys(prefix, owner, after, limit)
+
+    def wait_loaded(self):
+        self.store.wait_loaded()
+
+    def version(self):
+        return self.store.version
+
+    def count(self):
+        return len(self.store)
+
+    def lock_wait_seconds(self):
+        return self.store.lock_wait_seconds()
+
+    def put(self, key, unique_filename, checksum=None):
+        self.store.put(key, unique_filename, checksum)
+
+    def pop(self, key):
+        return self.store.pop(key)[0]
+
+    def flush(self):
+        self.store.flush()
+
+
+# Which worker each connected user is on, with an inbox per worker for the file events
+# and bandwidth limit changes published on the others
+class ClientRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.owners = {}  # Username -> worker id
+        self.inboxes = {}  # Worker id -> queue of relayed messages
+
+    # Take a username for a connection on worker; False if it is already in use
+    def claim(self, username, worker):
+        with self.lock:
+            if username in self.owners:
+                return False
+            self.owners[username] = worker
+            return True
+
+    def release(self, username, worker):
+        with self.lock:
+            if self.owners.get(username) == worker:
+                del self.owners[username]
+
+    # Forget every user of a worker that exited
+    def drop_worker(self, worker):
+        with self.lock:
+            self.owners = {username: owner for username, owner in self.owners.items() if owner != worker}
+
+    def count(self):
+        return len(self.owners)
+
+    # Hand an event to every worker but the one that published it
+    def publish(self, event, sender):
+        with self.lock:
+            for worker, inbox in self.inboxes.items():
+                if worker != sender:
+                    inbox.put(event)
+
+    # Next event for worker, waiting until there is one
+    def receive(self, worker):
+        with self.lock:
+            inbox = self.inbox(worker)
+        return inbox.get()
+
+    # Inbox of a worker, created on first use; caller holds self.lock
+    def inbox(self, worker):
+        if worker not in self.inboxes:
+            self.inboxes[worker] = queue.Queue()
+        return self.inboxes[worker]
+
+
+# Manager process holding the state the workers share; every call is a round trip
+# over a local socket, served on a thread per worker connection
+class SharedState(BaseManager):
+    pass
+
+
+def metadata_service():
+    return SERVICES["metadata"]
+
+
+def client_registry():
+    return SERVICES["registry"]
+
+
+SharedState.register("metadata", callable=metadata_service)
+SharedState.register("registry", callable=client_registry)
+
+
+# Load the file-owner map in the shared state process
+def start_services(metadata_path, shards):
+    store = MetadataStore(metadata_path, shards=shards)
+    store.load()
+    SERVICES["metadata"] = MetadataService(store)
+    SERVICES["registry"] = ClientRegistry()
+
+
+# Worker-side stand-in for MetadataStore that forwards to the shared state process.
+# put and pop return futures like the store's, completed on a thread pool once the
+# change is on disk.
+class RemoteMetadata:
+    def __init__(self, service):
+        self.service = service
+        self.commits = ThreadPoolExecutor(max_workers=COMMIT_THREADS)
+
+    def load(self):
+        pass  # Loaded once by the shared state process
+
+    @property
+    def version(self):
+        return self.service.version()
+
+    def __len__(self):
+        return self.service.count()
+
+    def get(self, key, default=None):
+        unique_filename = self.service.get(key)
+        return default if unique_filename is None else unique_filename
+
+    def checksum(self, key):
+        return self.service.checksum(key)
+
+    def items_with_checksums(self):
+        return self.service.items_with_checksums()
+
+    def list_keys(self, prefix='', owner=None, after=None, limit=None):
+        return self.service.list_keys(prefix, owner, after, limit)
+
+    def wait_loaded(self):
+        self.service.wait_loaded()
+
+    def lock_wait_seconds(self):
+        return self.service.lock_wait_seconds()
+
+    def put(self, key, unique_filename, checksum=None):
+        self.service.put(key, unique_filename, checksum)
+        return self.commits.submit(self.service.flush)
+
+    def pop(self, key):
+        unique_filename = self.service.pop(key)
+        if unique_filename is None:
+            return None, None
+        return unique_filename, self.commits.submit(self.service.flush)
+
+
+# A worker process's view of the shared state: its id, the size of the pool, the
+# metadata map and the registry
+class WorkerContext:
+    def __init__(self, worker_id, workers, address, authkey):
+        manager = SharedState(address=address, authkey=authkey)
+        manager.connect()
+        self.worker_id = worker_id
+        self.workers = workers
+        self.metadata = RemoteMetadata(manager.metadata())
+        self.registry = manager.registry()
+
+
+# Bind a socket to the server port with SO_REUSEPORT so the workers can share it,
+# resolving port 0; it is never listened on, only holds the port for restarted workers
+def reserve_port(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
@@ -0,0 +1,38 @@
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server"))
+from bandwidth import BandwidthScheduler
+
+
+class SocketStub:
+    sending = None
+    receiving = None
+
+
+class LargeGrantTest(unittest.TestCase):
+    # Grants larger than the bucket's burst must still be issued, paced by the debt they leave
+    def test_grant_larger_than_burst(self):
+        rate = 1024 * 1024
+        scheduler = BandwidthScheduler({"ingress": rate})
+        link = scheduler.links["ingress"]
+        count = 4 * int(link.bucket.burst)
+
+        async def receive():
+            with scheduler.transfer(SocketStub(), "alice", "ingress", 3 * count) as transfer:
+                for _ in range(3):
+                    await transfer.acquire(count)
+
+        started = time.monotonic()
+        asyncio.run(asyncio.wait_for(receive(), 10))
+        elapsed = time.monotonic() - started
+        # The first grant goes out at once; the other two wait for the debt to be paid
+        self.assertGreater(elapsed, 2 * count / rate * 0.8)
+        self.assertLess(elapsed, 3 * count / rate + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from chunk_store import ChunkStore
+from chunking import MAX_CHUNK, MIN_CHUNK, Chunker, chunk_hash
+
+
+def chunks_of(data, piece=None):
+    chunker = Chunker()
+    piece = piece or len(data) or 1
+    chunks = []
+    for start in range(0, len(data), piece):
+        chunks += chunker.feed(data[start:start + piece])
+    last = chunker.finish()
+    return chunks + ([last] if last is not None else [])
+
+
+class ChunkerTest(unittest.TestCase):
+    def setUp(self):
+        self.data = random.Random(7).randbytes(1024 * 1024)
+
+    def test_chunks_cover_the_data_within_bounds(self):
+        chunks = chunks_of(self.data)
+        self.assertEqual(b"".join(chunks), self.data)
+        self.assertTrue(all(MIN_CHUNK <= len(chunk) <= MAX_CHUNK for chunk in chunks[:-1]))
+        self.assertLessEqual(len(chunks[-1]), MAX_CHUNK)
+
+    def test_cut_points_do_not_depend_on_how_data_arrives(self):
+        self.assertEqual(chunks_of(self.data, 1000), chunks_of(self.data))
+        self.assertEqual(chunks_of(self.data, 65537), chunks_of(self.data))
+
+    def test_edit_only_changes_nearby_chunks(self):
+        edited = self.data[:500000] + b"inserted" + self.data[500000:]
+        before, after = set(chunks_of(self.data)), set(chunks_of(edited))
+        self.assertLessEqual(len(after - before), 3)
+
+    def test_data_without_cut_points_is_cut_at_the_maximum(self):
+        chunks = chunks_of(bytes(3 * MAX_CHUNK + 10))
+        self.assertEqual([len(chunk) for chunk in chunks], [MAX_CHUNK] * 3 + [10])
+
+    def test_empty_data_has_no_chunks(self):
+        self.assertEqual(chunks_of(b""), [])
+
+
+class ChunkStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.store = self.open_store()
+        self.shared = random.Random(1).randbytes(300000)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def open_store(self):
+        store = ChunkStore(self.folder.name)
+        store.load()
+        return store
+
+    def write(self, name, data):
+        writer = self.store.create(name)
+        writer.write(data)
+        writer.commit()
+
+    def read(self, name):
+        reader, size = self.store.open(name)
+        with reader:
+            data = reader.read()
+        self.assertEqual(size, len(data))
+        return data
+
+    def chunk_files(self):
+        return {entry.name for folder in os.scandir(self.store.chunk_dir) for entry in os.scandir(folder.path)}
+
+    def test_shared_chunks_live_until_the_last_file_is_deleted(self):
+        self.write("a", self.shared + b"a" * 5000)
+        self.write("b", self.shared + b"b" * 5000)
+        both = self.chunk_files()
+        self.store.delete("a")
+        self.assertEqual(self.read("b"), self.shared + b"b" * 5000)
+        self.assertTrue(self.chunk_files() < both)
+        self.store.delete("b")
+        self.assertEqual(self.chunk_files(), set())
+        self.assertEqual(self.store.stats(), (0, 0))
+
+    def test_replacing_a_file_releases_its_old_chunks(self):
+        self.write("a", self.shared)
+        self.write("a", b"new contents")
+        self.assertEqual(self.read("a"), b"new contents")
+        self.assertEqual(self.chunk_files(), {chunk_hash(b"new contents")})
+
+    def test_reload_rebuilds_counts_and_sweeps_unreferenced_chunks(self):
+        self.write("a", self.shared)
+        self.write("b", self.shared)
+        self.assertTrue(self.store.put_chunk(chunk_hash(b"orphan"), b"orphan"))
+        self.store = self.open_store()
+        self.assertNotIn(chunk_hash(b"orphan"), self.chunk_files())
+        self.store.delete("a")
+        self.assertEqual(self.read("b"), self.shared)
+        self.assertEqual(self.store.stats(), (len(self.shared), len(self.shared)))
+
+    def test_bad_chunks_and_missing_chunks_are_refused(self):
+        self.assertFalse(self.store.put_chunk(chunk_hash(b"right"), b"wrong"))
+        with self.assertRaises(FileNotFoundError):
+            self.store.commit_manifest("a", 5, [[chunk_hash(b"right"), 5]])
+        self.assertFalse(self.store.exists("a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
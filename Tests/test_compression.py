@@ -0,0 +1,30 @@
+import os
+import sys
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from compression import BLOCK_SIZE, CODECS, COMPRESSED, decode_payload
+
+
+class BoundedDecompressionTest(unittest.TestCase):
+    def test_full_blocks_round_trip(self):
+        block = bytes(range(256)) * (BLOCK_SIZE // 256)
+        for codec, (compress, _) in CODECS.items():
+            with self.subTest(codec=codec):
+                self.assertEqual(decode_payload(codec, COMPRESSED, compress(block)), block)
+
+    # A small frame that expands past BLOCK_SIZE is refused instead of truncated or inflated
+    def test_frames_expanding_past_the_block_size_are_refused(self):
+        for codec, (compress, _) in CODECS.items():
+            with self.subTest(codec=codec):
+                with self.assertRaises(ValueError):
+                    decode_payload(codec, COMPRESSED, compress(bytes(4 * BLOCK_SIZE)))
+
+    def test_zlib_stream_just_past_the_block_size_is_refused(self):
+        with self.assertRaises(ValueError):
+            decode_payload("zlib", COMPRESSED, zlib.compress(bytes(BLOCK_SIZE + 1)))
+
+
+if __name__ == "__main__":
+    unittest.main()
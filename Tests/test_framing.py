@@ -0,0 +1,78 @@
+import io
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Client"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from client_core import SocketBuffer
+from framing import MAX_LINE, RecvBuffer
+
+
+class RecvBufferTest(unittest.TestCase):
+    def test_pipelined_lines_and_bodies_are_split_apart(self):
+        buffer = RecvBuffer()
+        buffer.feed(b"OK\nRESPONSE:3\nabcDATA:0\n")
+        self.assertEqual(buffer.take_line(), "OK")
+        self.assertEqual(buffer.take_line(), "RESPONSE:3")
+        self.assertEqual(buffer.take(3), b"abc")
+        self.assertEqual(buffer.take_line(), "DATA:0")
+        self.assertIsNone(buffer.take_line())
+        self.assertEqual(len(buffer), 0)
+
+    def test_line_split_across_receives(self):
+        buffer = RecvBuffer()
+        buffer.feed(b"HEL")
+        self.assertIsNone(buffer.take_line())
+        buffer.feed(b"LO\nnext")
+        self.assertEqual(buffer.take_line(), "HELLO")
+        self.assertEqual(buffer.take(10), b"next")
+
+    # A body bigger than the buffer grows it without losing the line that follows
+    def test_body_larger_than_the_buffer(self):
+        body = bytes(range(200))
+        buffer = RecvBuffer(64)
+        buffer.feed(b"UPLOAD x 200\n")
+        buffer.feed(body + b"LIST\n")
+        self.assertEqual(buffer.take_line(), "UPLOAD x 200")
+        self.assertEqual(buffer.take(200), body)
+        self.assertEqual(buffer.take_line(), "LIST")
+
+    # Compacting unread bytes to the front keeps them in order
+    def test_lines_survive_compaction(self):
+        buffer = RecvBuffer(64)
+        lines = []
+        for number in range(100):
+            buffer.feed(f"line {number}\n".encode()[:5])
+            buffer.feed(f"line {number}\n".encode()[5:])
+            lines.append(buffer.take_line())
+        self.assertEqual(lines, [f"line {number}" for number in range(100)])
+        self.assertEqual(len(buffer.data), 64)
+
+    def test_endless_line_is_refused(self):
+        buffer = RecvBuffer()
+        buffer.feed(bytes(MAX_LINE + 1))
+        with self.assertRaises(ValueError):
+            buffer.take_line()
+
+
+class SocketBufferTest(unittest.TestCase):
+    # A reply, its body and the next reply arriving in odd pieces read back as sent
+    def test_pipelined_replies_over_a_socket(self):
+        client, server = socket.socketpair()
+        with client, server:
+            sent = b"RESPONSE:5\nhelloDATA:0\nRESPONSE:Subscribed.\n"
+            for start in range(0, len(sent), 7):
+                server.sendall(sent[start:start + 7])
+            sock_buf = SocketBuffer(client)
+            self.assertEqual(sock_buf.recv_line(), "RESPONSE:5")
+            body = io.BytesIO()
+            sock_buf.recv_to_file(body, 5)
+            self.assertEqual(body.getvalue(), b"hello")
+            self.assertEqual(sock_buf.recv_line(), "DATA:0")
+            self.assertEqual(sock_buf.recv_line(), "RESPONSE:Subscribed.")
+
+
+if __name__ == "__main__":
+    unittest.main()
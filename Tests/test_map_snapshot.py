@@ -0,0 +1,105 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server"))
+from map_snapshot import BLOCK, SnapshotReader, is_binary, write_snapshot
+from metadata import MetadataStore
+from server_log import LogPipeline
+
+
+class SnapshotFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "map.snapshot")
+        # Several index blocks, some keys without checksums and non-ASCII names
+        self.entries = {(f"file{number:04d}.txt", f"user{number % 7}"): f"stored{number}" for number in range(5 * BLOCK + 3)}
+        self.entries[("résumé.pdf", "zoë")] = "zoë_résumé.pdf"
+        self.checksums = {key: f"blake2b:{number:02x}" for number, key in enumerate(self.entries) if number % 3}
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_every_key_is_found(self):
+        write_snapshot(self.path, self.entries, self.checksums)
+        self.assertTrue(is_binary(self.path))
+        reader = SnapshotReader(self.path)
+        self.assertEqual(len(reader), len(self.entries))
+        for key, unique_filename in self.entries.items():
+            self.assertEqual(reader.find(key), (unique_filename, self.checksums.get(key)))
+        reader.close()
+
+    def test_missing_keys_before_between_and_after(self):
+        write_snapshot(self.path, self.entries, self.checksums)
+        reader = SnapshotReader(self.path)
+        for key in [("a", "user0"), ("file0001.txt", "user0"), ("file0100.txt5", "user2"), ("zzz", "zoë")]:
+            self.assertIsNone(reader.find(key))
+        reader.close()
+
+    def test_records_come_back_in_key_order(self):
+        write_snapshot(self.path, self.entries, self.checksums)
+        reader = SnapshotReader(self.path)
+        expected = [(key, self.entries[key], self.checksums.get(key)) for key in sorted(self.entries)]
+        self.assertEqual(list(reader.records()), expected)
+        reader.close()
+
+    def test_empty_snapshot(self):
+        write_snapshot(self.path, {}, {})
+        reader = SnapshotReader(self.path)
+        self.assertEqual(len(reader), 0)
+        self.assertIsNone(reader.find(("a", "alice")))
+        self.assertEqual(list(reader.records()), [])
+        reader.close()
+
+    def test_truncated_and_foreign_files_are_refused(self):
+        write_snapshot(self.path, self.entries, self.checksums)
+        os.truncate(self.path, os.path.getsize(self.path) - 1)
+        with self.assertRaises(ValueError):
+            SnapshotReader(self.path)
+        with open(self.path, "w") as f:
+            f.write(json.dumps({"op": "put", "name": "a", "owner": "alice", "file": "alice_a"}) + "\n")
+        self.assertFalse(is_binary(self.path))
+        with self.assertRaises(ValueError):
+            SnapshotReader(self.path)
+
+
+class LazyLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.base = os.path.join(self.folder.name, "map")
+        self.log = LogPipeline(console=False)
+        write_snapshot(self.base + ".snapshot", {("a", "alice"): "alice_a", ("b", "alice"): "alice_b",
+                                                 ("c", "bob"): "bob_c"}, {("a", "alice"): "blake2b:0a"})
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    # Lookups are answered from the mapped snapshot and the journal before hydration
+    def test_lookups_before_and_after_hydration(self):
+        store = MetadataStore(self.base, log=self.log)
+        store.load()
+        store.pop(("b", "alice"))[1].result()
+        store.put(("c", "bob"), "bob_c2").result()
+        store.put(("d", "bob"), "bob_d").result()
+        store = MetadataStore(self.base, log=self.log)
+        with mock.patch.object(MetadataStore, "hydrate") as hydrate:
+            store.load()
+        self.assertFalse(store.loaded.is_set())
+        self.assertEqual(store.get(("a", "alice")), "alice_a")
+        self.assertEqual(store.checksum(("a", "alice")), "blake2b:0a")
+        self.assertIsNone(store.get(("b", "alice")))
+        self.assertEqual(store.get(("c", "bob")), "bob_c2")
+        self.assertEqual(store.get(("d", "bob")), "bob_d")
+        store.put(("e", "carol"), "carol_e").result()
+        MetadataStore.hydrate(store, *hydrate.call_args.args)
+        store.wait_loaded()
+        self.assertEqual(sorted(store.items()), [(("a", "alice"), "alice_a"), (("c", "bob"), "bob_c2"),
+                                                 (("d", "bob"), "bob_d"), (("e", "carol"), "carol_e")])
+        self.assertEqual(store.checksum(("a", "alice")), "blake2b:0a")
+
+
+if __name__ == "__main__":
+    unittest.main()
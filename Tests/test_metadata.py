@@ -0,0 +1,85 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server"))
+import metadata
+from metadata import MetadataStore
+from server_log import LogPipeline
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.base = os.path.join(self.folder.name, "map")
+        self.log = LogPipeline(console=False)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def open_store(self, compact_every=metadata.COMPACT_EVERY):
+        store = MetadataStore(self.base, compact_every=compact_every, log=self.log)
+        store.load()
+        store.wait_loaded()
+        return store
+
+    def test_changes_replay_after_restart(self):
+        store = self.open_store()
+        store.put(("a", "alice"), "alice_a", "blake2b:01").result()
+        store.put(("b", "alice"), "alice_b").result()
+        store.put(("a", "bob"), "bob_a").result()
+        store.pop(("b", "alice"))[1].result()
+        store.put(("a", "alice"), "alice_a2").result()
+        store = self.open_store()
+        self.assertEqual(sorted(store.items()), [(("a", "alice"), "alice_a2"), (("a", "bob"), "bob_a")])
+        self.assertIsNone(store.checksum(("a", "alice")))  # Replaced without a checksum
+
+    def test_compaction_folds_the_journal_into_the_snapshot(self):
+        store = self.open_store(compact_every=10)
+        for number in range(25):
+            store.put((f"f{number}", "alice"), f"alice_f{number}", f"blake2b:{number:02x}").result()
+        store.pop(("f3", "alice"))[1].result()
+        store.flush()
+        with open(self.base + ".journal", "rb") as f:
+            self.assertLess(len(f.readlines()), 10)
+        store = self.open_store()
+        self.assertEqual(len(store), 24)
+        self.assertIsNone(store.get(("f3", "alice")))
+        self.assertEqual(store.checksum(("f24", "alice")), "blake2b:18")
+
+    def test_torn_tail_is_cut_off_before_new_records(self):
+        store = self.open_store()
+        store.put(("a", "alice"), "alice_a").result()
+        with open(self.base + ".journal", "a") as f:
+            f.write('{"op": "put", "name": "torn", "ow')
+        store = self.open_store()
+        self.assertIsNone(store.get(("torn", "alice")))
+        store.put(("b", "alice"), "alice_b").result()
+        store = self.open_store()
+        self.assertEqual(store.get(("a", "alice")), "alice_a")
+        self.assertEqual(store.get(("b", "alice")), "alice_b")
+
+    # A batch that fails halfway must not leave a torn record in front of later ones
+    def test_failed_write_leaves_no_torn_record(self):
+        store = self.open_store()
+        store.put(("a", "alice"), "alice_a").result()
+        write = os.write
+
+        def short_write(fd, data):
+            write(fd, bytes(data[:len(data) // 2]))
+            raise OSError(28, "No space left on device")
+
+        with mock.patch.object(metadata.os, "write", short_write):
+            with self.assertRaises(OSError):
+                store.put(("lost", "alice"), "alice_lost").result()
+        store.put(("b", "alice"), "alice_b").result()
+        store = self.open_store()
+        self.assertEqual(store.get(("a", "alice")), "alice_a")
+        self.assertEqual(store.get(("b", "alice")), "alice_b")
+        self.assertIsNone(store.get(("lost", "alice")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Server"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Common"))
+from integrity import StreamChecksum
+from metadata import MetadataStore
+from pack_store import Compactor, TieredStorage
+from scrub import Scrubber
+from server_log import LogPipeline
+
+PACK_AFTER = 3600
+
+
+class TieredStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.log = LogPipeline(console=False)
+        self.storage = self.open_storage()
+
+    def tearDown(self):
+        self.storage.index_file.close()
+        self.folder.cleanup()
+
+    def open_storage(self):
+        storage = TieredStorage(self.folder.name)
+        storage.load()
+        return storage
+
+    # Store a file and make it look unwritten for longer than PACK_AFTER
+    def store(self, name, data, cold=True):
+        writer = self.storage.create(name, len(data))
+        writer.write(data)
+        writer.commit()
+        if cold:
+            past = time.time() - 2 * PACK_AFTER
+            os.utime(self.storage.path(name), (past, past))
+
+    def read(self, storage, name):
+        f, size = storage.open(name)
+        with f:
+            data = f.read()
+        self.assertEqual(size, len(data))
+        return data
+
+    def compact(self):
+        Compactor(self.storage, self.log, PACK_AFTER).run()
+
+    def test_packed_files_read_back(self):
+        self.store("a", b"alpha" * 1000)
+        self.store("b", b"")
+        self.store("hot", b"hot", cold=False)
+        self.compact()
+        self.assertEqual(set(self.storage.index), {"a", "b"})
+        self.assertFalse(os.path.exists(self.storage.path("a")))
+        self.assertTrue(os.path.exists(self.storage.path("hot")))
+        self.assertEqual(self.read(self.storage, "a"), b"alpha" * 1000)
+        self.assertEqual(self.read(self.storage, "b"), b"")
+        self.assertEqual(self.storage.size("a"), 5000)
+
+    def test_tombstones_survive_reload(self):
+        self.store("gone", b"gone")
+        self.store("replaced", b"old")
+        self.store("kept", b"kept")
+        self.compact()
+        self.storage.delete("gone")
+        self.store("replaced", b"new", cold=False)
+        self.assertFalse(self.storage.exists("gone"))
+        self.assertEqual(self.read(self.storage, "replaced"), b"new")
+        self.storage.index_file.close()
+        self.storage = self.open_storage()
+        self.assertEqual(set(self.storage.index), {"kept"})
+        self.assertFalse(self.storage.exists("gone"))
+        self.assertEqual(self.read(self.storage, "replaced"), b"new")
+        self.assertEqual(self.read(self.storage, "kept"), b"kept")
+
+    # A scrub reads every file but must not make cold files look recently used
+    def test_scrub_does_not_keep_files_loose(self):
+        data = b"scrubbed" * 100
+        self.store("alice_a", data)
+        checksum = StreamChecksum()
+        checksum.update(data)
+        metadata = MetadataStore(os.path.join(self.folder.name, "map"), log=self.log)
+        metadata.load()
+        metadata.put(("a", "alice"), "alice_a", checksum.value()).result()
+        scrubber = Scrubber(metadata, self.storage, self.log)
+        scrubber.run()
+        self.assertEqual((scrubber.checked, scrubber.corrupt), (1, 0))
+        self.compact()
+        self.assertIn("alice_a", self.storage.index)
+        self.assertEqual(self.read(self.storage, "alice_a"), data)
+
+
+if __name__ == "__main__":
+    unittest.main()